@@ -13,11 +13,13 @@
 # limitations under the License.
 
 
+from contextlib import ExitStack
 import logging
 import os
 import subprocess
 import tempfile
 
+from buildgrid.bot.output_capture import OutputCapture, log_output
 from buildgrid.client.cas import download, upload
 from buildgrid._exceptions import BotError
 from buildgrid._protos.build.bazel.remote.execution.v2 import remote_execution_pb2
@@ -66,7 +68,7 @@ def work_buildbox(lease, context, event):
         write_file(input_digest_file.name, action.input_root_digest.SerializeToString())
 
         with tempfile.NamedTemporaryFile(dir=tempdir) as output_digest_file:
-            with tempfile.NamedTemporaryFile(dir=tempdir) as timestamps_file:
+            with tempfile.NamedTemporaryFile(dir=tempdir) as timestamps_file, ExitStack() as stack:
                 command_line = ['buildbox',
                                 '--remote={}'.format(context.remote_cas_url),
                                 '--input-digest={}'.format(input_digest_file.name),
@@ -94,11 +96,20 @@ def work_buildbox(lease, context, event):
                 logger.info("Starting execution: [{}...]".format(command.arguments[0]))
 
                 command_line = subprocess.Popen(command_line,
-                                                stdin=subprocess.PIPE,
+                                                stdin=subprocess.DEVNULL,
                                                 stdout=subprocess.PIPE,
                                                 stderr=subprocess.PIPE)
-                stdout, stderr = command_line.communicate()
-                returncode = command_line.returncode
+
+                # Outputs are spooled to disk, next to the local CAS:
+                stdout, stderr = [
+                    stack.enter_context(OutputCapture(
+                        stream, name, directory=tempdir, max_size=context.max_output_size,
+                        callback=log_output(logger, name) if context.live_output else None))
+                    for stream, name in ((command_line.stdout, 'stdout'), (command_line.stderr, 'stderr'))]
+
+                returncode = command_line.wait()
+                stdout.wait()
+                stderr.wait()
 
                 action_result = remote_execution_pb2.ActionResult()
                 action_result.exit_code = returncode
@@ -116,8 +127,8 @@ def work_buildbox(lease, context, event):
                 action_result.execution_metadata.ParseFromString(metadata)
 
                 if len(output_digest.hash) != HASH_LENGTH:
-                    raise BotError(
-                        stdout, detail=stderr, reason="Output root digest too small.")
+                    raise BotError(stdout.read(MAX_REQUEST_SIZE), detail=stderr.read(MAX_REQUEST_SIZE),
+                                   reason="Output root digest too small.")
 
                 # TODO: Have BuildBox helping us creating the Tree instance here
                 # See https://gitlab.com/BuildStream/buildbox/issues/7 for details
@@ -133,19 +144,19 @@ def work_buildbox(lease, context, event):
 
                     action_result.output_directories.extend([output_directory])
 
-                    if action_result.ByteSize() + len(stdout) > MAX_REQUEST_SIZE:
-                        stdout_digest = uploader.put_blob(stdout)
+                    if action_result.ByteSize() + stdout.size > MAX_REQUEST_SIZE:
+                        stdout_digest = uploader.upload_file(stdout.path, digest=stdout.digest)
                         action_result.stdout_digest.CopyFrom(stdout_digest)
 
                     else:
-                        action_result.stdout_raw = stdout
+                        action_result.stdout_raw = stdout.read()
 
-                    if action_result.ByteSize() + len(stderr) > MAX_REQUEST_SIZE:
-                        stderr_digest = uploader.put_blob(stderr)
+                    if action_result.ByteSize() + stderr.size > MAX_REQUEST_SIZE:
+                        stderr_digest = uploader.upload_file(stderr.path, digest=stderr.digest)
                         action_result.stderr_digest.CopyFrom(stderr_digest)
 
                     else:
-                        action_result.stderr_raw = stderr
+                        action_result.stderr_raw = stderr.read()
 
                 lease.result.Pack(action_result)
 
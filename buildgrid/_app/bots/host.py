@@ -13,12 +13,14 @@
 # limitations under the License.
 
 
+from contextlib import ExitStack
 import itertools
 import logging
 import os
 import subprocess
 import tempfile
 
+from buildgrid.bot.output_capture import OutputCapture, log_output
 from buildgrid.client.cas import download, upload
 from buildgrid._protos.build.bazel.remote.execution.v2 import remote_execution_pb2
 from buildgrid.settings import MAX_REQUEST_SIZE
@@ -40,7 +42,16 @@ def work_host_tools(lease, context, event):
 
     action_result.execution_metadata.worker = get_hostname()
 
-    with tempfile.TemporaryDirectory() as temp_directory:
+    # Inputs are staged next to the local CAS cache, if any, so that cached
+    # blobs can be hardlinked:
+    local_cas_cache = context.local_cas_cache
+    staging_path = local_cas_cache.staging_path if local_cas_cache is not None else None
+
+    with ExitStack() as stack:
+        temp_directory = stack.enter_context(tempfile.TemporaryDirectory(dir=staging_path))
+        if local_cas_cache is not None:
+            stack.callback(local_cas_cache.release_directory, temp_directory)
+
         with download(context.cas_channel, instance=instance_name) as downloader:
             action = downloader.get_message(action_digest,
                                             remote_execution_pb2.Action())
@@ -52,7 +63,18 @@ def work_host_tools(lease, context, event):
 
             action_result.execution_metadata.input_fetch_start_timestamp.GetCurrentTime()
 
-            downloader.download_directory(action.input_root_digest, temp_directory)
+            if local_cas_cache is not None:
+                # The working directory and outputs must not end-up in
+                # trees shared with other actions:
+                working_path = os.path.join(temp_directory, command.working_directory)
+                writable_paths = [working_path]
+                for output_path in itertools.chain(command.output_files, command.output_directories):
+                    writable_paths.append(os.path.join(working_path, output_path))
+
+                local_cas_cache.stage_directory(downloader, action.input_root_digest,
+                                                temp_directory, writable_paths=writable_paths)
+            else:
+                downloader.download_directory(action.input_root_digest, temp_directory)
 
         logger.debug("Command digest: [{}/{}]"
                      .format(action.command_digest.hash, action.command_digest.size_bytes))
@@ -91,12 +113,20 @@ def work_host_tools(lease, context, event):
         process = subprocess.Popen(command_line,
                                    cwd=working_directory,
                                    env=environment,
-                                   stdin=subprocess.PIPE,
+                                   stdin=subprocess.DEVNULL,
                                    stdout=subprocess.PIPE,
                                    stderr=subprocess.PIPE)
 
-        stdout, stderr = process.communicate()
-        returncode = process.returncode
+        # Outputs are spooled to disk, next to the staged inputs:
+        stdout, stderr = [
+            stack.enter_context(OutputCapture(
+                stream, name, directory=staging_path, max_size=context.max_output_size,
+                callback=log_output(logger, name) if context.live_output else None))
+            for stream, name in ((process.stdout, 'stdout'), (process.stderr, 'stderr'))]
+
+        returncode = process.wait()
+        stdout.wait()
+        stderr.wait()
 
         action_result.execution_metadata.execution_completed_timestamp.GetCurrentTime()
 
@@ -109,13 +139,21 @@ def work_host_tools(lease, context, event):
         with upload(context.cas_channel, instance=instance_name) as uploader:
             output_files, output_directories = [], []
 
+            file_paths = []
             for output_path in command.output_files:
                 file_path = os.path.join(working_directory, output_path)
                 # Missing outputs should simply be omitted in ActionResult:
                 if not os.path.isfile(file_path):
                     continue
 
-                file_digest = uploader.upload_file(file_path, queue=True)
+                file_paths.append(file_path)
+
+            # Output files are hashed and sent concurrently, the ones already
+            # in CAS being skipped:
+            file_digests = uploader.upload_files(file_paths, queue=True)
+
+            for file_path in file_paths:
+                file_digest = file_digests[file_path]
                 output_file = output_file_maker(file_path, working_directory,
                                                 file_digest)
                 output_files.append(output_file)
@@ -141,19 +179,19 @@ def work_host_tools(lease, context, event):
 
             action_result.output_directories.extend(output_directories)
 
-            if action_result.ByteSize() + len(stdout) > MAX_REQUEST_SIZE:
-                stdout_digest = uploader.put_blob(stdout)
+            if action_result.ByteSize() + stdout.size > MAX_REQUEST_SIZE:
+                stdout_digest = uploader.upload_file(stdout.path, digest=stdout.digest)
                 action_result.stdout_digest.CopyFrom(stdout_digest)
 
             else:
-                action_result.stdout_raw = stdout
+                action_result.stdout_raw = stdout.read()
 
-            if action_result.ByteSize() + len(stderr) > MAX_REQUEST_SIZE:
-                stderr_digest = uploader.put_blob(stderr)
+            if action_result.ByteSize() + stderr.size > MAX_REQUEST_SIZE:
+                stderr_digest = uploader.upload_file(stderr.path, digest=stderr.digest)
                 action_result.stderr_digest.CopyFrom(stderr_digest)
 
             else:
-                action_result.stderr_raw = stderr
+                action_result.stderr_raw = stderr.read()
 
         action_result.execution_metadata.output_upload_completed_timestamp.GetCurrentTime()
 
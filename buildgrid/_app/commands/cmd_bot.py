@@ -26,6 +26,7 @@ import sys
 import click
 
 from buildgrid.bot import bot, interface, session
+from buildgrid.bot.cas_cache import LocalCASCache
 from buildgrid.bot.hardware.interface import HardwareInterface
 from buildgrid.bot.hardware.device import Device
 from buildgrid.bot.hardware.worker import Worker
@@ -59,17 +60,22 @@ from ..cli import pass_context, setup_logging
               help="Time period for bot updates to the server in seconds.")
 @click.option('--executing-update-period', type=click.FLOAT, default=5, show_default=True,
               help="Time period for bot updates to the server whilst execution is happening, "
-                   "in seconds.")
+                   "in seconds. Completed leases are reported straight away.")
 @click.option('--parent', type=click.STRING, default=None, show_default=True,
               help="Targeted farm resource.")
 @click.option('-w', '--worker-property', nargs=2, type=(click.STRING, click.STRING), multiple=True,
               help="List of key-value pairs of worker properties.")
+@click.option('--max-output-size', type=click.IntRange(min=0), default=None,
+              help="Maximum size, in bytes, of the stdout and stderr kept for every action. "
+                   "Output past that size is discarded. Unlimited if not set.")
+@click.option('--live-output', is_flag=True,
+              help="Forward actions' stdout and stderr to the bot's log as they run.")
 @click.option('-v', '--verbose', count=True,
               help='Increase log verbosity level.')
 @pass_context
 def cli(context, parent, update_period, executing_update_period, remote, auth_token,
         client_key, client_cert, server_cert, remote_cas, cas_client_key, cas_client_cert,
-        cas_server_cert, worker_property, verbose):
+        cas_server_cert, worker_property, max_output_size, live_output, verbose):
     setup_logging(verbosity=verbose)
     # Setup the remote execution server channel:
     try:
@@ -96,6 +102,8 @@ def cli(context, parent, update_period, executing_update_period, remote, auth_to
         sys.exit(-1)
 
     context.parent = parent
+    context.max_output_size = max_output_size
+    context.live_output = live_output
 
     bot_interface = interface.BotInterface(
         context.channel, update_period, executing_update_period)
@@ -127,12 +135,39 @@ def run_dummy(context):
 
 
 @cli.command('host-tools', short_help="Runs commands using the host's tools.")
+@click.option('--local-cas', type=click.Path(file_okay=False), default=None,
+              help="Local CAS cache directory, inputs are staged from. Inputs are "
+                   "downloaded for every action if not set. Input files are hardlinks to "
+                   "read-only cached blobs, which actions can still modify: cached blobs "
+                   "are checked for changes before being staged again, and fetched again "
+                   "if modified. Use --local-cas-copy-files to stage copies instead.")
+@click.option('--local-cas-size', type=click.INT, default=10 * 2 ** 30, show_default=True,
+              help="Maximum size of the local CAS cache, in bytes.")
+@click.option('--local-cas-copy-files', is_flag=True,
+              help="Stage input files as copies of the blobs in the local CAS cache rather "
+                   "than as hardlinks to them, so that actions cannot modify cached blobs.")
+@click.option('--local-cas-link-trees', is_flag=True,
+              help="Stage unchanged input subtrees as symlinks to read-only directory trees "
+                   "kept in the local CAS cache, rather than file by file. Actions then see "
+                   "these subtrees as symlinks resolving outside of their input root, to "
+                   "directories shared with other actions, which cannot be written to.")
+@click.option('--local-cas-trees', type=click.IntRange(min=0), default=16, show_default=True,
+              help="Maximum number of input directory trees to keep materialised in the "
+                   "local CAS cache, with --local-cas-link-trees.")
 @pass_context
-def run_host_tools(context):
+def run_host_tools(context, local_cas, local_cas_size, local_cas_copy_files, local_cas_link_trees,
+                   local_cas_trees):
     """
     Downloads inputs from CAS, runs build commands using host-tools and uploads
     result back to CAS.
     """
+    context.local_cas_cache = None
+    if local_cas is not None:
+        context.local_cas_cache = LocalCASCache(local_cas, local_cas_size,
+                                                max_trees=local_cas_trees,
+                                                link_trees=local_cas_link_trees,
+                                                link_files=not local_cas_copy_files)
+
     bot_session = session.BotSession(context.parent, context.bot_interface, context.hardware_interface,
                                      host.work_host_tools, context)
     b = bot.Bot(bot_session)
@@ -141,12 +141,16 @@ def upload_directory(context, directory_path, verify):
     sent_digests = []
     try:
         with upload(context.channel, instance=context.instance_name) as uploader:
-            for node, blob, path in merkle_tree_maker(directory_path):
+            for node, blob, path in merkle_tree_maker(directory_path, file_blobs=False):
                 if not os.path.isabs(directory_path):
                     path = os.path.relpath(path)
                 click.echo("Queueing path=[{}]".format(path))
 
-                node_digest = uploader.put_blob(blob, digest=node.digest, queue=True)
+                if blob is None:
+                    # Files are read again, chunk by chunk, for upload:
+                    node_digest = uploader.upload_file(path, queue=True, digest=node.digest)
+                else:
+                    node_digest = uploader.put_blob(blob, digest=node.digest, queue=True)
                 sent_digests.append((node_digest, path))
     except ConnectionError as e:
         click.echo('Error: Uploading directory: {}'.format(e), err=True)
@@ -231,7 +235,7 @@ def download_directory(context, digest_string, directory_path, verify):
 
     if verify:
         last_directory_node = None
-        for node, _, _ in merkle_tree_maker(directory_path):
+        for node, _, _ in merkle_tree_maker(directory_path, file_blobs=False):
             if node.DESCRIPTOR is remote_execution_pb2.DirectoryNode.DESCRIPTOR:
                 last_directory_node = node
         if last_directory_node.digest != digest:
@@ -20,13 +20,24 @@ Server command
 Create a BuildGrid server.
 """
 
+import logging
+import os
+import signal
 import sys
 
 import click
 
 from buildgrid._exceptions import PermissionDeniedError
 from buildgrid.server._authentication import AuthMetadataMethod, AuthMetadataAlgorithm
+from buildgrid.server.actioncache.cachingaction import CachingActionCache
+from buildgrid.server.actioncache.writeonceaction import WriteOnceActionCache
+from buildgrid.server.bots.instance import BotsInterface
+from buildgrid.server.controller import ExecutionController
+from buildgrid.server.execution.instance import ExecutionInstance
 from buildgrid.server.instance import Server
+from buildgrid.server.operations.instance import OperationsInstance
+from buildgrid.server.referencestorage.storage import ReferenceCache
+from buildgrid.server.cas.storage.lru_memory_cache import LRUMemoryCache
 from buildgrid.server._monitoring import MonitoringOutputType, MonitoringOutputFormat
 from buildgrid.utils import read_file
 
@@ -34,6 +45,18 @@ from ..cli import pass_context, setup_logging
 from ..settings import parser
 
 
+# Services owning a scheduler, which must all be served by a single process:
+_SCHEDULER_SERVICE_TYPES = (ExecutionController, ExecutionInstance,
+                            BotsInterface, OperationsInstance)
+
+# Services keeping their entries in memory, which cannot be shared between
+# processes either (``ActionCache`` being a ``ReferenceCache``):
+_IN_MEMORY_SERVICE_TYPES = (ReferenceCache,)
+
+# Action caches wrapping another one, which may be kept in memory:
+_WRAPPER_SERVICE_TYPES = (CachingActionCache, WriteOnceActionCache)
+
+
 @click.group(name='server', short_help="Start a local server instance.")
 @pass_context
 def cli(context):
@@ -45,16 +68,31 @@ def cli(context):
                 type=click.Path(file_okay=True, dir_okay=False, exists=True, writable=False))
 @click.option('-v', '--verbose', count=True,
               help='Increase log verbosity level.')
+@click.option('--workers', type=click.IntRange(min=1), default=1, show_default=True,
+              help="Number of server processes sharing the listening ports. Only "
+                   "CAS, ByteStream and ActionCache services can be served by "
+                   "several processes, using storage and action caches shared "
+                   "between them.")
 @pass_context
-def start(context, config, verbose):
+def start(context, config, verbose, workers):
     """Entry point for the bgd-server CLI command group."""
     setup_logging(verbosity=verbose)
 
+    if workers > 1:
+        sys.exit(_start_workers(config, workers))
+
+    _serve(config)
+
+
+def _serve(config, workers=1):
+    """Parses configuration then runs a server until it gets stopped."""
+    # Parsing instantiates storage backends, which must not be shared
+    # between forked worker processes:
     with open(config) as f:
         settings = parser.get_parser().safe_load(f)
 
     try:
-        server = _create_server_from_config(settings)
+        server = _create_server_from_config(settings, workers)
 
     except KeyError as e:
         click.echo("ERROR: Could not parse config: {}.\n".format(str(e)), err=True)
@@ -70,7 +108,61 @@ def start(context, config, verbose):
         server.stop()
 
 
-def _create_server_from_config(configuration):
+def _start_workers(config, workers):
+    """Forks worker processes serving the same configuration, then waits for
+    them to terminate, returning the exit code of the first failing one.
+    """
+    logger = logging.getLogger(__name__)
+
+    worker_pids = set()
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                _serve(config, workers)
+
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else 1
+
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Server worker process failed")
+                exit_code = 1
+
+            finally:
+                os._exit(exit_code)
+
+        worker_pids.add(pid)
+
+    logger.info("Started [%s] server worker processes: %s", workers, sorted(worker_pids))
+
+    def __stop_workers(signum=signal.SIGTERM, frame=None):
+        for worker_pid in worker_pids:
+            try:
+                os.kill(worker_pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    # Workers get SIGINT from the terminal on their own:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, __stop_workers)
+
+    exit_code = 0
+    while worker_pids:
+        pid, status = os.wait()
+        worker_pids.discard(pid)
+
+        worker_exit_code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
+        if worker_exit_code and not exit_code:
+            logger.error("Server worker process [%s] exited with status [%s], "
+                         "stopping the other ones", pid, worker_exit_code)
+            exit_code = worker_exit_code
+            __stop_workers()
+
+    return exit_code
+
+
+def _create_server_from_config(configuration, workers=1):
     """Parses configuration and setup a fresh server instance."""
     kargs = {}
 
@@ -131,7 +223,53 @@ def _create_server_from_config(configuration):
             click.echo("Error: Configuration, {}.".format(e), err=True)
             sys.exit(-1)
 
-    server = Server(**kargs)
+    if 'concurrency-limits' in configuration:
+        try:
+            kargs['concurrency_limits'] = {name: int(max_requests) for name, max_requests
+                                           in configuration['concurrency-limits'].items()}
+
+        except (AttributeError, ValueError) as e:
+            click.echo("Error: Configuration, {}.".format(e), err=True)
+            sys.exit(-1)
+
+    if 'grpc-aio' in configuration:
+        kargs['grpc_aio'] = bool(configuration['grpc-aio'])
+
+    if workers > 1:
+        for instance in instances:
+            for service in instance['services']:
+                if isinstance(service, _SCHEDULER_SERVICE_TYPES):
+                    click.echo("Error: Configuration, service [{}] of instance [{}] cannot be "
+                               "served by multiple workers. Serve it from a separate, single "
+                               "worker server.".format(type(service).__name__, instance['name']),
+                               err=True)
+                    sys.exit(-1)
+
+                wrapped_service = service
+                while isinstance(wrapped_service, _WRAPPER_SERVICE_TYPES):
+                    wrapped_service = wrapped_service._action_cache
+
+                if isinstance(wrapped_service, _IN_MEMORY_SERVICE_TYPES):
+                    click.echo("Error: Configuration, service [{}] of instance [{}] keeps its "
+                               "entries in memory and cannot be served by multiple workers. Use "
+                               "a shared backend like !sql-action-cache or !redis-action-cache."
+                               .format(type(wrapped_service).__name__, instance['name']), err=True)
+                    sys.exit(-1)
+
+            for storage in instance.get('storages', []):
+                if isinstance(storage, LRUMemoryCache):
+                    click.echo("Warning: Configuration, in-memory storage of instance [{}] is not "
+                               "shared between workers, only use it as the cache of a "
+                               "!with-cache-storage.".format(instance['name']), err=True)
+
+        kargs['reuse_port'] = True
+
+    try:
+        server = Server(**kargs)
+
+    except ValueError as e:
+        click.echo("Error: Configuration, {}.".format(e), err=True)
+        sys.exit(-1)
 
     try:
         for channel in network:
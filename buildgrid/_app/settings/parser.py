@@ -23,9 +23,11 @@ import grpc
 import yaml
 
 from buildgrid.server.controller import ExecutionController
+from buildgrid.server.actioncache.cachingaction import CachingActionCache
 from buildgrid.server.actioncache.instance import ActionCache
 from buildgrid.server.actioncache.remote import RemoteActionCache
 from buildgrid.server.actioncache.s3storage import S3ActionCache
+from buildgrid.server.actioncache.sqlstorage import SQLActionCache
 from buildgrid.server.actioncache.writeonceaction import WriteOnceActionCache
 from buildgrid.server.referencestorage.storage import ReferenceCache
 from buildgrid.server.cas.instance import ByteStreamInstance, ContentAddressableStorageInstance
@@ -33,8 +35,10 @@ from buildgrid.server.cas.storage.disk import DiskStorage
 from buildgrid.server.cas.storage.lru_memory_cache import LRUMemoryCache
 from buildgrid.server.cas.storage.remote import RemoteStorage
 from buildgrid.server.cas.storage.s3 import S3Storage
+from buildgrid.server.cas.storage.sharded import ShardedStorage
 from buildgrid.server.cas.storage.with_cache import WithCacheStorage
 from buildgrid.server.cas.storage.index.sql import SQLIndex
+from buildgrid.server.cas.tree_cache import TreeCache
 from buildgrid.server.persistence.mem.impl import MemoryDataStore
 from buildgrid.server.persistence.sql.impl import SQLDataStore
 
@@ -267,19 +271,89 @@ class WithCache(YamlFactory):
     using the tag ``!with-cache-storage``.
 
     Args:
-      url (str): URL to remote storage. If used with ``https``, needs credentials.
-      instance_name (str): Instance of the remote to connect to.
-      credentials (dict, optional): A dictionary in the form::
-
-           tls-client-key: /path/to/certs
-           tls-client-cert: /path/to/certs
-           tls-server-cert: /path/to/certs
+      cache (:class:`buildgrid.server.cas.storage.storage_abc.StorageABC`): Instance of storage to use as the
+        fast, caching tier.
+      fallback (:class:`buildgrid.server.cas.storage.storage_abc.StorageABC`): Instance of storage to use as the
+        slow, authoritative tier.
+      write_back (bool): Acknowledge writes as soon as they are committed to the cache and upload them to the
+        fallback in the background. The cache must be durable (e.g. ``!disk-storage``). Defaults to ``False``.
+      write_back_threads (int): Number of background threads uploading to the fallback. Defaults to ``1``.
+      write_back_queue_size (int): Maximum number of uploads waiting for the fallback before writers are
+        blocked. Defaults to ``1000``.
+      write_back_retries (int): Number of retries in a row for a failed upload to the fallback. Defaults
+        to ``3``.
+      write_back_backoff (float): Base delay in seconds between retries, doubled on every attempt.
+        Defaults to ``1.0``.
+      write_back_retry_period (float): Time in seconds after which uploads that failed every retry are
+        attempted again, failed uploads never being dropped. Defaults to ``60``.
+      write_back_journal (str): File recording pending uploads, for them to resume after a restart.
+        Optional, pending uploads are only kept in memory if not set.
+      trust_cache (bool): Answer presence checks from the cache for the blobs it holds, only querying the
+        fallback for the others. Defaults to ``False``.
+      background_promotion (bool): Copy partially read blobs, and blobs fetched in bulk, into the cache
+        from background threads. Defaults to ``False``.
+      promotion_threads (int): Number of background promotion threads. Defaults to ``2``.
     """
 
     yaml_tag = u'!with-cache-storage'
 
-    def __new__(cls, cache, fallback):
-        return WithCacheStorage(cache, fallback)
+    def __new__(cls, cache, fallback, write_back=False, write_back_threads=1,
+                write_back_queue_size=1000, write_back_retries=3, write_back_backoff=1.0,
+                write_back_retry_period=60, write_back_journal=None,
+                trust_cache=False, background_promotion=False, promotion_threads=2):
+        return WithCacheStorage(cache, fallback, write_back=write_back,
+                                write_back_threads=write_back_threads,
+                                write_back_queue_size=write_back_queue_size,
+                                write_back_retries=write_back_retries,
+                                write_back_backoff=write_back_backoff,
+                                write_back_retry_period=write_back_retry_period,
+                                write_back_journal=write_back_journal,
+                                trust_cache=trust_cache,
+                                background_promotion=background_promotion,
+                                promotion_threads=promotion_threads)
+
+
+class Sharded(YamlFactory):
+    """Generates :class:`buildgrid.server.cas.storage.sharded.ShardedStorage`
+    using the tag ``!sharded-storage``.
+
+    Args:
+      shards (dict): A dictionary mapping shard names to instances of storage to use, in the form::
+
+           shard-a: *disk-storage-a
+           shard-b: *redis-storage-b
+
+        Blob placement depends on the shard names, which must remain stable across restarts.
+      replication_factor (int): Number of shards each blob is stored on. Defaults to ``1``.
+      max_workers (int, optional): Number of threads used to query shards in parallel. Defaults to the
+        number of shards.
+    """
+
+    yaml_tag = u'!sharded-storage'
+
+    def __new__(cls, shards, replication_factor=1, max_workers=None):
+        try:
+            return ShardedStorage(shards, replication_factor=replication_factor,
+                                  max_workers=max_workers)
+        except ValueError as value_error:
+            click.echo("ERROR: {}.".format(value_error), err=True)
+            sys.exit(-1)
+
+
+class TreeCacheConfig(YamlFactory):
+    """Generates :class:`buildgrid.server.cas.tree_cache.TreeCache`
+    using the tag ``!tree-cache``.
+
+    The same tree cache can be shared by several services using a YAML anchor.
+
+    Args:
+      max_digests (int): Maximum total number of blob digests kept in cache, over all trees.
+    """
+
+    yaml_tag = u'!tree-cache'
+
+    def __new__(cls, max_digests):
+        return TreeCache(max_digests)
 
 
 class SQLDataStoreConfig(YamlFactory):
@@ -346,12 +420,17 @@ class Execution(YamlFactory):
       property_keys The allowed property keys for jobs
       bot_session_keepalive_timeout: The longest time (in seconds) we'll wait for a bot to send an update
     before it assumes it's dead. Defaults to 600s (10 minutes).
+      cache_check_workers: Number of threads looking up new jobs in the action cache in the background.
+    Defaults to 0, looking jobs up while handling Execute requests.
+      cache_check_batch_size: Maximum number of jobs each cache check thread looks up at once. Defaults
+    to 100.
     """
 
     yaml_tag = u'!execution'
 
     def __new__(cls, storage, action_cache=None, action_browser_url=None, data_store=None,
-                property_keys=None, bot_session_keepalive_timeout=600):
+                property_keys=None, bot_session_keepalive_timeout=600, cache_check_workers=0,
+                cache_check_batch_size=100):
         # If the configuration doesn't define a data store type, fallback to the
         # in-memory data store implementation from the old scheduler.
         if not data_store:
@@ -361,7 +440,9 @@ class Execution(YamlFactory):
 
         return ExecutionController(data_store, storage=storage, action_cache=action_cache,
                                    action_browser_url=action_browser_url, property_keys=property_keys,
-                                   bot_session_keepalive_timeout=bot_session_keepalive_timeout)
+                                   bot_session_keepalive_timeout=bot_session_keepalive_timeout,
+                                   cache_check_workers=cache_check_workers,
+                                   cache_check_batch_size=cache_check_batch_size)
 
 
 class Action(YamlFactory):
@@ -373,12 +454,26 @@ class Action(YamlFactory):
       max_cached_refs(int): Max number of cached actions.
       allow_updates(bool): Allow updates pushed to CAS. Defaults to ``True``.
       cache_failed_actions(bool): Whether to store failed (non-zero exit code) actions. Default to ``True``.
+      tree_cache(:class:`buildgrid.server.cas.tree_cache.TreeCache`): Tree cache used to validate
+        cached results (see ``!tree-cache``). Optional.
+      freshness_window(float): Time in seconds during which a cached result whose outputs were found in CAS
+        is served without checking CAS again. Defaults to ``0`` (check on every request).
+      snapshot_path(str): File to periodically save cache entries to, and to restore them from on startup.
+        Optional, entries are only kept in memory if not set.
+      snapshot_period(float): Time in seconds between two snapshots. Defaults to ``300``.
+      snapshot_journal(bool): Whether to also log every update made between two snapshots, so that no entry
+        is lost on restart. Defaults to ``True``.
     """
 
     yaml_tag = u'!action-cache'
 
-    def __new__(cls, storage, max_cached_refs, allow_updates=True, cache_failed_actions=True):
-        return ActionCache(storage, max_cached_refs, allow_updates, cache_failed_actions)
+    def __new__(cls, storage, max_cached_refs, allow_updates=True, cache_failed_actions=True,
+                tree_cache=None, freshness_window=0, snapshot_path=None, snapshot_period=300,
+                snapshot_journal=True):
+        return ActionCache(storage, max_cached_refs, allow_updates, cache_failed_actions,
+                           tree_cache=tree_cache, freshness_window=freshness_window,
+                           snapshot_path=snapshot_path, snapshot_period=snapshot_period,
+                           snapshot_journal=snapshot_journal)
 
 
 class S3Action(YamlFactory):
@@ -393,15 +488,92 @@ class S3Action(YamlFactory):
       endpoint (str): URL of endpoint.
       access-key (str): S3-ACCESS-KEY
       secret-key (str): S3-SECRET-KEY
+      tree_cache(:class:`buildgrid.server.cas.tree_cache.TreeCache`): Tree cache used to validate
+        cached results (see ``!tree-cache``). Optional.
+      max_inline_size(int): Size in bytes of the largest ActionResult stored in the S3 object itself
+        rather than in CAS. Defaults to ``0`` (always store results in CAS), as servers not supporting
+        this option can't read such objects.
 
     """
 
     yaml_tag = u'!s3action-cache'
 
     def __new__(cls, storage, allow_updates=True, cache_failed_actions=True,
-                bucket=None, endpoint=None, access_key=None, secret_key=None):
+                bucket=None, endpoint=None, access_key=None, secret_key=None, tree_cache=None,
+                max_inline_size=0):
         return S3ActionCache(storage, allow_updates=allow_updates, cache_failed_actions=cache_failed_actions,
-                             bucket=bucket, endpoint=endpoint, access_key=access_key, secret_key=secret_key)
+                             bucket=bucket, endpoint=endpoint, access_key=access_key, secret_key=secret_key,
+                             tree_cache=tree_cache, max_inline_size=max_inline_size)
+
+
+class SQLAction(YamlFactory):
+    """Generates :class:`buildgrid.server.actioncache.sqlstorage.SQLActionCache`
+    using the tag ``!sql-action-cache``.
+
+    Args:
+      storage(:class:`buildgrid.server.cas.storage.storage_abc.StorageABC`): Instance of storage to use.
+      max_cached_refs(int): Max number of cached actions, least recently used ones being evicted first.
+      connection_string (str): SQLAlchemy connection string
+      allow_updates(bool): Allow updates pushed to CAS. Defaults to ``True``.
+      cache_failed_actions(bool): Whether to store failed (non-zero exit code) actions. Default to ``True``.
+      automigrate (bool): Attempt to automatically upgrade an existing DB schema to the newest version.
+      tree_cache(:class:`buildgrid.server.cas.tree_cache.TreeCache`): Tree cache used to validate
+        cached results (see ``!tree-cache``). Optional.
+      access_batch_size(int): Number of cache hits to buffer before refreshing their access time in
+        the database. Defaults to ``100``.
+      access_flush_period(float): Maximum time in seconds a cache hit's access time refresh is buffered
+        for. Defaults to ``10``.
+      eviction_interval(int): Number of updates between two checks for entries to evict, the cache
+        holding up to that many entries over ``max_cached_refs`` in between. Defaults to ``100``.
+      inclause_limit (int): If nonnegative, overrides the default number of variables permitted per "in"
+        clause. See the buildgrid.server.persistence.sql.utils comments for more details.
+    """
+
+    yaml_tag = u'!sql-action-cache'
+
+    def __new__(cls, storage, max_cached_refs, connection_string, allow_updates=True,
+                cache_failed_actions=True, automigrate=False, tree_cache=None,
+                access_batch_size=100, access_flush_period=10, eviction_interval=100,
+                inclause_limit=-1, **kwargs):
+        return SQLActionCache(storage, max_cached_refs, connection_string,
+                              allow_updates=allow_updates, cache_failed_actions=cache_failed_actions,
+                              automigrate=automigrate, tree_cache=tree_cache,
+                              access_batch_size=access_batch_size,
+                              access_flush_period=access_flush_period,
+                              eviction_interval=eviction_interval,
+                              inclause_limit=inclause_limit, **kwargs)
+
+
+class RedisAction(YamlFactory):
+    """Generates :class:`buildgrid.server.actioncache.redisstorage.RedisActionCache`
+    using the tag ``!redis-action-cache``.
+
+    Args:
+      storage(:class:`buildgrid.server.cas.storage.storage_abc.StorageABC`): Instance of storage to use.
+      host (str): hostname of endpoint.
+      port (int): port on host.
+      password (str): redis database password
+      db (int) : db number
+      allow_updates(bool): Allow updates pushed to CAS. Defaults to ``True``.
+      cache_failed_actions(bool): Whether to store failed (non-zero exit code) actions. Default to ``True``.
+      ttl(int): Time in seconds after which entries that have not been accessed expire. Optional, entries
+        never expire if not set.
+      max_inline_size(int): Size in bytes of the largest ActionResult stored in redis itself, larger ones
+        being stored in CAS. Defaults to ``65536``.
+      tree_cache(:class:`buildgrid.server.cas.tree_cache.TreeCache`): Tree cache used to validate
+        cached results (see ``!tree-cache``). Optional.
+    """
+
+    yaml_tag = u'!redis-action-cache'
+
+    def __new__(cls, storage, host, port, password=None, db=None, allow_updates=True,
+                cache_failed_actions=True, ttl=None, max_inline_size=64 * 1024, tree_cache=None):
+        # Import here so there is no global buildgrid dependency on redis
+        from buildgrid.server.actioncache.redisstorage import RedisActionCache
+        return RedisActionCache(storage, allow_updates=allow_updates,
+                                cache_failed_actions=cache_failed_actions, ttl=ttl,
+                                max_inline_size=max_inline_size, tree_cache=tree_cache,
+                                host=host, port=port, password=password, db=db)
 
 
 class RemoteAction(YamlFactory):
@@ -477,6 +649,24 @@ class WriteOnceAction(YamlFactory):
         return WriteOnceActionCache(action_cache)
 
 
+class CachingAction(YamlFactory):
+    """Generates :class:`buildgrid.server.actioncache.cachingaction.CachingActionCache`
+    using the tag ``!caching-action-cache``.
+
+    Args:
+      action_cache(:class:`Action`): Instance of action cache whose lookups are cached.
+      max_cached_refs(int): Max number of lookups kept in memory.
+      ttl(float): Time in seconds a found result is served from memory for. Defaults to ``60``.
+      negative_ttl(float): Time in seconds a missing result is reported from memory for. Defaults to
+        ``5``, ``0`` disables caching of misses.
+    """
+
+    yaml_tag = u'!caching-action-cache'
+
+    def __new__(cls, action_cache, max_cached_refs, ttl=60, negative_ttl=5):
+        return CachingActionCache(action_cache, max_cached_refs, ttl=ttl, negative_ttl=negative_ttl)
+
+
 class Reference(YamlFactory):
     """Generates :class:`buildgrid.server.referencestorage.service.ReferenceStorageService`
     using the tag ``!reference-cache``.
@@ -485,12 +675,24 @@ class Reference(YamlFactory):
       storage(:class:`buildgrid.server.cas.storage.storage_abc.StorageABC`): Instance of storage to use.
       max_cached_refs(int): Max number of cached actions.
       allow_updates(bool): Allow updates pushed to CAS. Defauled to ``True``.
+      tree_cache(:class:`buildgrid.server.cas.tree_cache.TreeCache`): Tree cache used to validate
+        cached results (see ``!tree-cache``). Optional.
+      freshness_window(float): Time in seconds during which a cached result whose outputs were found in CAS
+        is served without checking CAS again. Defaults to ``0`` (check on every request).
+      snapshot_path(str): File to periodically save cache entries to, and to restore them from on startup.
+        Optional, entries are only kept in memory if not set.
+      snapshot_period(float): Time in seconds between two snapshots. Defaults to ``300``.
+      snapshot_journal(bool): Whether to also log every update made between two snapshots, so that no entry
+        is lost on restart. Defaults to ``True``.
     """
 
     yaml_tag = u'!reference-cache'
 
-    def __new__(cls, storage, max_cached_refs, allow_updates=True):
-        return ReferenceCache(storage, max_cached_refs, allow_updates)
+    def __new__(cls, storage, max_cached_refs, allow_updates=True, tree_cache=None, freshness_window=0,
+                snapshot_path=None, snapshot_period=300, snapshot_journal=True):
+        return ReferenceCache(storage, max_cached_refs, allow_updates, tree_cache=tree_cache,
+                              freshness_window=freshness_window, snapshot_path=snapshot_path,
+                              snapshot_period=snapshot_period, snapshot_journal=snapshot_journal)
 
 
 class CAS(YamlFactory):
@@ -499,12 +701,14 @@ class CAS(YamlFactory):
 
     Args:
       storage(:class:`buildgrid.server.cas.storage.storage_abc.StorageABC`): Instance of storage to use.
+      tree_cache(:class:`buildgrid.server.cas.tree_cache.TreeCache`): Tree cache used to speed up
+        GetTree requests (see ``!tree-cache``). Optional.
     """
 
     yaml_tag = u'!cas'
 
-    def __new__(cls, storage):
-        return ContentAddressableStorageInstance(storage)
+    def __new__(cls, storage, tree_cache=None):
+        return ContentAddressableStorageInstance(storage, tree_cache=tree_cache)
 
 
 class ByteStream(YamlFactory):
@@ -513,12 +717,22 @@ class ByteStream(YamlFactory):
 
     Args:
       storage(:class:`buildgrid.server.cas.storage.storage_abc.StorageABC`): Instance of storage to use.
+      max_write_sessions(int): Max number of interrupted writes kept for clients to resume them, the oldest
+        ones being dropped first. Defaults to ``16``.
+      max_write_sessions_size(str): Max amount of data received for the kept writes altogether, e.g ``1G``,
+        the oldest ones being dropped first. Size parsed with
+        :meth:`buildgrid._app.settings.parser._parse_size`. Defaults to ``1G``.
+      write_session_timeout(float): Time in seconds an interrupted write is kept for if not resumed.
+        Defaults to ``600``.
     """
 
     yaml_tag = u'!bytestream'
 
-    def __new__(cls, storage):
-        return ByteStreamInstance(storage)
+    def __new__(cls, storage, max_write_sessions=16, max_write_sessions_size='1G',
+                write_session_timeout=600):
+        return ByteStreamInstance(storage, max_write_sessions=max_write_sessions,
+                                  max_write_sessions_size=_parse_size(max_write_sessions_size),
+                                  write_session_timeout=write_session_timeout)
 
 
 def _parse_size(size):
@@ -542,7 +756,10 @@ def get_parser():
     yaml.SafeLoader.add_constructor(Action.yaml_tag, Action.from_yaml)
     yaml.SafeLoader.add_constructor(RemoteAction.yaml_tag, RemoteAction.from_yaml)
     yaml.SafeLoader.add_constructor(S3Action.yaml_tag, S3Action.from_yaml)
+    yaml.SafeLoader.add_constructor(SQLAction.yaml_tag, SQLAction.from_yaml)
+    yaml.SafeLoader.add_constructor(RedisAction.yaml_tag, RedisAction.from_yaml)
     yaml.SafeLoader.add_constructor(WriteOnceAction.yaml_tag, WriteOnceAction.from_yaml)
+    yaml.SafeLoader.add_constructor(CachingAction.yaml_tag, CachingAction.from_yaml)
     yaml.SafeLoader.add_constructor(Reference.yaml_tag, Reference.from_yaml)
     yaml.SafeLoader.add_constructor(Disk.yaml_tag, Disk.from_yaml)
     yaml.SafeLoader.add_constructor(LRU.yaml_tag, LRU.from_yaml)
@@ -550,7 +767,9 @@ def get_parser():
     yaml.SafeLoader.add_constructor(Redis.yaml_tag, Redis.from_yaml)
     yaml.SafeLoader.add_constructor(Remote.yaml_tag, Remote.from_yaml)
     yaml.SafeLoader.add_constructor(WithCache.yaml_tag, WithCache.from_yaml)
+    yaml.SafeLoader.add_constructor(Sharded.yaml_tag, Sharded.from_yaml)
     yaml.SafeLoader.add_constructor(SQL_Index.yaml_tag, SQL_Index.from_yaml)
+    yaml.SafeLoader.add_constructor(TreeCacheConfig.yaml_tag, TreeCacheConfig.from_yaml)
     yaml.SafeLoader.add_constructor(CAS.yaml_tag, CAS.from_yaml)
     yaml.SafeLoader.add_constructor(ByteStream.yaml_tag, ByteStream.from_yaml)
     yaml.SafeLoader.add_constructor(SQLDataStoreConfig.yaml_tag, SQLDataStoreConfig.from_yaml)
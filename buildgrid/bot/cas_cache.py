@@ -0,0 +1,611 @@
+# Copyright (C) 2019 Bloomberg LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  <http://www.apache.org/licenses/LICENSE-2.0>
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Local CAS Cache
+===============
+
+Keeps the blobs bots download from CAS on local disk, so that the inputs of
+an action can be staged from previous actions' ones.
+
+Cached blobs are stored read-only, one file per digest hash, and are staged
+by hardlinking them in place, or by copying them if requested. Executable
+files get their own copy of a blob, as hardlinks share permissions. The cache
+is bounded in size, the least recently used blobs being evicted first.
+
+Read-only permissions do not prevent actions running as the bot's user from
+changing them, then modifying a hardlinked input, and the cached blob with
+it. Cached blobs are thus checked before being staged again: their size and
+modification time must not have changed since they were added, and the
+content of blobs cached by previous runs is hashed the first time they get
+staged. Blobs failing these checks are fetched again. Staging by copy avoids
+the issue altogether, at the cost of copying every input file.
+
+Directory trees can also be kept materialised, keyed by :obj:`Directory`
+digest. If explicitly enabled, an unchanged subtree of an input root, a
+toolchain for example, is then staged as a single symlink to its read-only
+materialised copy rather than file by file. Subtrees leading to paths actions
+write to are always staged for real. This changes what actions see: reused
+subtrees are symlinks resolving outside of the input root, to directories
+shared with other actions, which cannot be written to.
+"""
+
+from collections import Counter, OrderedDict
+from contextlib import suppress
+import logging
+import os
+import shutil
+import threading
+import uuid
+
+from buildgrid.utils import create_digest_from_file
+
+
+_EXECUTABLE_SUFFIX = '.x'
+
+
+class LocalCASCache:
+
+    def __init__(self, path, max_size, max_trees=0, link_trees=False, link_files=True):
+        """Initialises a new local CAS cache, picking up blobs already cached
+        in `path` by previous runs.
+
+        Args:
+            path (str): directory to store cached blobs in. Input roots
+                should be staged on the same filesystem so that blobs can be
+                hardlinked rather than copied.
+            max_size (int): maximum total size, in bytes, of the cached blobs.
+            max_trees (int): maximum number of directory trees to keep
+                materialised. Materialised trees hold links to cached blobs,
+                which only free their disk space once the trees referencing
+                them get evicted too.
+            link_trees (bool): whether to stage unchanged subtrees as symlinks
+                to shared, read-only materialised trees. Subtrees are not
+                reused if ``False`` or if `max_trees` is ``0``.
+            link_files (bool): whether to stage files as hardlinks to the
+                cached blobs, rather than as copies of them. Actions can then
+                modify cached blobs through their inputs, which only gets
+                detected the next time these blobs are staged.
+        """
+        self.__logger = logging.getLogger(__name__)
+
+        self.__path = os.path.abspath(path)
+        self.__objects_path = os.path.join(self.__path, 'objects')
+        self.__temp_path = os.path.join(self.__path, 'tmp')
+        self.__staging_path = os.path.join(self.__path, 'staging')
+        self.__trees_path = os.path.join(self.__path, 'trees')
+
+        self._max_size = max_size
+        self._max_trees = max_trees
+        self._link_trees = link_trees
+        self._link_files = link_files
+
+        # {object name: size in bytes}, least recently used first:
+        self.__objects = OrderedDict()
+        # {object name: modification time, in ns}, for the objects whose
+        # content is known to be right, not the ones found on startup:
+        self.__verified_objects = {}
+        self.__size = 0
+        # Objects that must not be evicted, in use by an ongoing staging:
+        self.__pinned = Counter()
+
+        # {root directory hash: hashes of the directories in the tree},
+        # least recently used first:
+        self.__trees = OrderedDict()
+        # {directory hash: (root directory hash, materialised path)}:
+        self.__tree_paths = {}
+        # {staged directory path: root hashes of the trees it links to}:
+        self.__staged_trees = {}
+        # Trees that must not be evicted, linked to from staged directories:
+        self.__pinned_trees = Counter()
+
+        self.__lock = threading.Lock()
+
+        # Incomplete downloads, staged directories and trees (which
+        # aren't indexed) are left-overs:
+        for left_over_path in (self.__temp_path, self.__staging_path, self.__trees_path):
+            _remove_tree(left_over_path)
+            os.makedirs(left_over_path)
+        os.makedirs(self.__objects_path, exist_ok=True)
+
+        self._load_objects()
+
+    # --- Public API ---
+
+    @property
+    def path(self):
+        return self.__path
+
+    @property
+    def staging_path(self):
+        """Directory to create input roots in, so that they live on the same
+        filesystem as the cached blobs.
+        """
+        return self.__staging_path
+
+    @property
+    def size(self):
+        return self.__size
+
+    def stage_directory(self, downloader, digest, directory_path, writable_paths=()):
+        """Materialises a :obj:`Directory` tree, downloading only the blobs
+        that are not cached yet.
+
+        If trees are linked, unchanged subtrees are staged as symlinks to
+        read-only copies. These remain in use until
+        :meth:`release_directory` gets called for `directory_path`.
+
+        Args:
+            downloader (Downloader): CAS downloader for missing blobs.
+            digest (:obj:`Digest`): the tree's root directory digest.
+            directory_path (str): path to the local directory to populate.
+            writable_paths (list): paths actions may write to, which must not
+                be part of a reused subtree. Their parent directories are
+                staged for real too.
+
+        Raises:
+            FileNotFoundError: if `digest`, or some of the blobs it
+                references, are not present in the remote CAS server.
+        """
+        if not os.path.isabs(directory_path):
+            directory_path = os.path.abspath(directory_path)
+        writable_paths = [os.path.abspath(path) for path in writable_paths]
+
+        directories = downloader.get_tree(digest)
+
+        staged_trees = set()
+        with self.__lock:
+            self.__staged_trees[directory_path] = staged_trees
+
+        # Blobs of the subtrees already materialised aren't needed:
+        file_nodes = {}
+        self._walk_directory(directories, digest.hash, directory_path, writable_paths,
+                             staged_trees, file_nodes)
+
+        with self.__lock:
+            self.__pinned.update(file_nodes.keys())
+            missing_names = [name for name in file_nodes if name not in self.__objects]
+            cached_names = [name for name in file_nodes if name in self.__objects]
+            for name in cached_names:
+                self.__objects.move_to_end(name)
+
+        try:
+            # Blobs modified through staged hardlinks, or corrupted on disk,
+            # get fetched again:
+            missing_names.extend(name for name in cached_names
+                                 if not self._check_object(name, file_nodes[name].digest))
+
+            self.__logger.debug("Staging [%s] files, [%s] missing from the cache",
+                                len(file_nodes), len(missing_names))
+
+            self._fetch_objects(downloader, [file_nodes[name] for name in missing_names])
+
+            os.makedirs(directory_path, exist_ok=True)
+            self._write_directory(directories, digest.hash, directory_path,
+                                  directory_path, writable_paths, staged_trees)
+
+        finally:
+            with self.__lock:
+                self.__pinned.subtract(file_nodes.keys())
+                self.__pinned += Counter()  # Drops non-positive counts
+
+            self._evict_objects()
+
+    def release_directory(self, directory_path):
+        """Lets the materialised trees a staged directory links to be evicted.
+
+        Args:
+            directory_path (str): path to a directory previously staged with
+                :meth:`stage_directory`.
+        """
+        if not os.path.isabs(directory_path):
+            directory_path = os.path.abspath(directory_path)
+
+        with self.__lock:
+            staged_trees = self.__staged_trees.pop(directory_path, set())
+            self.__pinned_trees.subtract(staged_trees)
+            self.__pinned_trees += Counter()  # Drops non-positive counts
+
+        self._evict_trees()
+
+    # --- Private API ---
+
+    def _object_name(self, digest_hash, is_executable):
+        if is_executable:
+            return digest_hash + _EXECUTABLE_SUFFIX
+        return digest_hash
+
+    def _object_path(self, name):
+        return os.path.join(self.__objects_path, name[:2], name)
+
+    def _load_objects(self):
+        """Indexes the blobs cached by previous runs, oldest first."""
+        objects = []
+        for entry in os.scandir(self.__objects_path):
+            if not entry.is_dir():
+                continue
+            for object_entry in os.scandir(entry.path):
+                object_stat = object_entry.stat()
+                objects.append((object_stat.st_mtime, object_entry.name, object_stat.st_size))
+
+        # Their content only gets checked the first time they are staged:
+        for _, name, size in sorted(objects):
+            self.__objects[name] = size
+            self.__size += size
+
+        self.__logger.info("Found [%s] cached blobs, [%s] bytes, in [%s]",
+                           len(self.__objects), self.__size, self.__path)
+
+    def _add_object(self, name, source_path, is_executable):
+        """Moves a complete blob into the cache, making it read-only."""
+        os.chmod(source_path, 0o555 if is_executable else 0o444)
+
+        object_path = self._object_path(name)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        os.replace(source_path, object_path)
+        object_stat = os.stat(object_path)
+
+        with self.__lock:
+            # May replace a modified copy of the blob:
+            self.__size += object_stat.st_size - self.__objects.get(name, 0)
+            self.__objects[name] = object_stat.st_size
+            self.__verified_objects[name] = object_stat.st_mtime_ns
+
+    def _check_object(self, name, digest):
+        """Tells whether a cached blob still matches its digest, hashing it
+        if it was cached by a previous run, only checking that it was not
+        modified since it was added otherwise.
+        """
+        object_path = self._object_path(name)
+        try:
+            object_stat = os.stat(object_path)
+        except FileNotFoundError:
+            return False
+
+        if object_stat.st_size != digest.size_bytes:
+            self.__logger.warning("Cached blob [%s] has been modified, fetching it again", name)
+            return False
+
+        with self.__lock:
+            verified_mtime = self.__verified_objects.get(name)
+
+        if verified_mtime is not None:
+            if object_stat.st_mtime_ns != verified_mtime:
+                self.__logger.warning("Cached blob [%s] has been modified, fetching it again", name)
+                return False
+            return True
+
+        if create_digest_from_file(object_path).hash != digest.hash:
+            self.__logger.warning("Cached blob [%s] is corrupted, fetching it again", name)
+            return False
+
+        with self.__lock:
+            self.__verified_objects[name] = object_stat.st_mtime_ns
+        return True
+
+    def _fetch_objects(self, downloader, file_nodes):
+        """Adds the blobs of the given file nodes to the cache, copying the
+        other executable variant of a blob if cached, fetching it otherwise.
+        """
+        download_paths = {}
+        for file_node in file_nodes:
+            name = self._object_name(file_node.digest.hash, file_node.is_executable)
+            temp_path = os.path.join(self.__temp_path, '{}.{}'.format(name, uuid.uuid4()))
+
+            other_name = self._object_name(file_node.digest.hash, not file_node.is_executable)
+            with self.__lock:
+                other_cached = other_name in self.__objects
+                if other_cached:
+                    self.__pinned[other_name] += 1
+
+            if other_cached:
+                try:
+                    other_cached = self._check_object(other_name, file_node.digest)
+                    if other_cached:
+                        shutil.copyfile(self._object_path(other_name), temp_path)
+                finally:
+                    with self.__lock:
+                        self.__pinned[other_name] -= 1
+
+            if other_cached:
+                self._add_object(name, temp_path, file_node.is_executable)
+
+            elif file_node.digest.size_bytes == 0:
+                open(temp_path, 'wb').close()
+                self._add_object(name, temp_path, file_node.is_executable)
+
+            else:
+                downloader.download_file(file_node.digest, temp_path, queue=True)
+                download_paths[name] = (temp_path, file_node.is_executable)
+
+        downloader.flush()
+
+        for name, (temp_path, is_executable) in download_paths.items():
+            self._add_object(name, temp_path, is_executable)
+
+    def _stage_file(self, name, file_path, is_executable, link=True):
+        """Hardlinks a cached blob in place, copying it if not linking or if
+        that fails.
+        """
+        object_path = self._object_path(name)
+        if link:
+            try:
+                os.link(object_path, file_path)
+                return
+
+            except OSError:
+                # Different filesystems, too many links...
+                pass
+
+        shutil.copyfile(object_path, file_path)
+        os.chmod(file_path, 0o755 if is_executable else 0o644)
+
+    def _reuses_tree(self, directories, directory_hash, directory_path, writable_paths):
+        """Tells whether a subtree is to be staged as a link to a materialised
+        copy: when trees are kept, when no path it contains is written to and
+        when its symlinks do not point outside of it.
+        """
+        if not self._link_trees or self._max_trees <= 0:
+            return False
+
+        for writable_path in writable_paths:
+            if os.path.commonpath([directory_path, writable_path]) == directory_path:
+                return False
+
+        return _is_self_contained(directories, directory_hash)
+
+    def _pin_tree(self, directory_hash, staged_trees):
+        """Returns the path to a materialised copy of a directory, if any,
+        pinning the tree it belongs to. Must be called with the lock held.
+        """
+        if directory_hash not in self.__tree_paths:
+            return None
+
+        root_hash, tree_path = self.__tree_paths[directory_hash]
+        self.__trees.move_to_end(root_hash)
+        if root_hash not in staged_trees:
+            staged_trees.add(root_hash)
+            self.__pinned_trees[root_hash] += 1
+
+        return tree_path
+
+    def _walk_directory(self, directories, directory_hash, directory_path, writable_paths,
+                        staged_trees, file_nodes):
+        """Lists the file nodes needed to stage a directory, pinning the
+        materialised trees it can reuse.
+        """
+        directory = directories[directory_hash]
+
+        for file_node in directory.files:
+            name = self._object_name(file_node.digest.hash, file_node.is_executable)
+            file_nodes[name] = file_node
+
+        for directory_node in directory.directories:
+            child_hash = directory_node.digest.hash
+            child_path = os.path.join(directory_path, directory_node.name)
+
+            if self._reuses_tree(directories, child_hash, child_path, writable_paths):
+                with self.__lock:
+                    if self._pin_tree(child_hash, staged_trees) is not None:
+                        continue
+
+            self._walk_directory(directories, child_hash, child_path, writable_paths,
+                                 staged_trees, file_nodes)
+
+    def _write_directory(self, directories, directory_hash, directory_path, root_barrier,
+                         writable_paths=(), staged_trees=None):
+        """Generates a local directory structure from cached blobs."""
+        directory = directories[directory_hash]
+
+        for file_node in directory.files:
+            name = self._object_name(file_node.digest.hash, file_node.is_executable)
+            self._stage_file(name, os.path.join(directory_path, file_node.name),
+                             file_node.is_executable, link=self._link_files)
+
+        for directory_node in directory.directories:
+            child_hash = directory_node.digest.hash
+            child_path = os.path.join(directory_path, directory_node.name)
+
+            if (staged_trees is not None and
+                    self._reuses_tree(directories, child_hash, child_path, writable_paths)):
+                tree_path = self._materialise_tree(directories, child_hash, staged_trees)
+                os.symlink(tree_path, child_path)
+                continue
+
+            os.makedirs(child_path, exist_ok=True)
+
+            self._write_directory(directories, child_hash, child_path, root_barrier,
+                                  writable_paths, staged_trees)
+
+        for symlink_node in directory.symlinks:
+            symlink_path = os.path.join(directory_path, symlink_node.name)
+            if not os.path.isabs(symlink_node.target):
+                target_path = os.path.join(directory_path, symlink_node.target)
+            else:
+                target_path = symlink_node.target
+            target_path = os.path.normpath(target_path)
+
+            # Do not create links pointing outside the barrier:
+            if os.path.commonpath([root_barrier, target_path]) != root_barrier:
+                continue
+
+            os.symlink(symlink_node.target, symlink_path)
+
+    def _write_tree(self, directories, directory_hash, directory_path):
+        """Generates a materialised copy of a tree, reusing the materialised
+        copies of its subtrees, if any.
+        """
+        directory = directories[directory_hash]
+
+        for file_node in directory.files:
+            name = self._object_name(file_node.digest.hash, file_node.is_executable)
+            self._stage_file(name, os.path.join(directory_path, file_node.name),
+                             file_node.is_executable)
+
+        for directory_node in directory.directories:
+            child_hash = directory_node.digest.hash
+            child_path = os.path.join(directory_path, directory_node.name)
+
+            with self.__lock:
+                source_path = None
+                if child_hash in self.__tree_paths:
+                    source_root_hash, source_path = self.__tree_paths[child_hash]
+                    # Prevents eviction while copying:
+                    self.__pinned_trees[source_root_hash] += 1
+
+            if source_path is not None:
+                try:
+                    shutil.copytree(source_path, child_path, symlinks=True,
+                                    copy_function=_link_or_copy)
+                finally:
+                    with self.__lock:
+                        self.__pinned_trees[source_root_hash] -= 1
+                continue
+
+            os.makedirs(child_path)
+            self._write_tree(directories, child_hash, child_path)
+
+        for symlink_node in directory.symlinks:
+            os.symlink(symlink_node.target, os.path.join(directory_path, symlink_node.name))
+
+    def _materialise_tree(self, directories, directory_hash, staged_trees):
+        """Returns the path to a materialised copy of a directory, creating
+        it if needed, and pins the tree it belongs to.
+        """
+        with self.__lock:
+            tree_path = self._pin_tree(directory_hash, staged_trees)
+        if tree_path is not None:
+            return tree_path
+
+        temp_path = os.path.join(self.__temp_path, '{}.{}'.format(directory_hash, uuid.uuid4()))
+        os.makedirs(temp_path)
+        self._write_tree(directories, directory_hash, temp_path)
+
+        # Materialised trees are shared, prevent actions from modifying them:
+        for dir_path, _, _ in os.walk(temp_path, topdown=False):
+            os.chmod(dir_path, 0o555)
+
+        tree_path = os.path.join(self.__trees_path, directory_hash)
+        with self.__lock:
+            if directory_hash not in self.__tree_paths:
+                os.replace(temp_path, tree_path)
+                temp_path = None
+
+                contained_hashes = []
+                for contained_hash, relative_path in _walk_tree(directories, directory_hash):
+                    if contained_hash not in self.__tree_paths:
+                        self.__tree_paths[contained_hash] = (
+                            directory_hash, os.path.join(tree_path, relative_path))
+                        contained_hashes.append(contained_hash)
+                self.__trees[directory_hash] = contained_hashes
+
+            tree_path = self._pin_tree(directory_hash, staged_trees)
+
+        if temp_path is not None:
+            # Materialised concurrently by another staging:
+            _remove_tree(temp_path)
+
+        self._evict_trees()
+
+        return tree_path
+
+    def _evict_objects(self):
+        """Removes the least recently used blobs beyond the size limit."""
+        with self.__lock:
+            if self.__size <= self._max_size:
+                return
+
+            evicted_count = 0
+            for name in list(self.__objects):
+                if self.__size <= self._max_size:
+                    break
+                if self.__pinned[name] > 0:
+                    continue
+
+                # Removing under lock, as the blob could otherwise get
+                # fetched again in the meantime:
+                try:
+                    os.remove(self._object_path(name))
+                except FileNotFoundError:
+                    pass
+
+                self.__size -= self.__objects.pop(name)
+                self.__verified_objects.pop(name, None)
+                evicted_count += 1
+
+        self.__logger.debug("Evicted [%s] blobs from the cache", evicted_count)
+
+    def _evict_trees(self):
+        """Removes the least recently used trees beyond the count limit."""
+        evicted_paths = []
+        with self.__lock:
+            for root_hash in list(self.__trees):
+                if len(self.__trees) <= self._max_trees:
+                    break
+                if self.__pinned_trees[root_hash] > 0:
+                    continue
+
+                for contained_hash in self.__trees.pop(root_hash):
+                    del self.__tree_paths[contained_hash]
+                evicted_paths.append(os.path.join(self.__trees_path, root_hash))
+
+        # No longer indexed, nothing can start using these anymore:
+        for tree_path in evicted_paths:
+            _remove_tree(tree_path)
+
+        if evicted_paths:
+            self.__logger.debug("Evicted [%s] trees from the cache", len(evicted_paths))
+
+
+def _link_or_copy(source_path, destination_path):
+    """Hardlinks a file, copying it if that fails."""
+    try:
+        os.link(source_path, destination_path)
+    except OSError:
+        shutil.copy2(source_path, destination_path)
+
+
+def _remove_tree(path):
+    """Removes a directory tree, including read-only directories."""
+    def __make_parent_writable(function, failed_path, _):
+        os.chmod(os.path.dirname(failed_path), 0o755)
+        function(failed_path)
+
+    with suppress(FileNotFoundError):
+        shutil.rmtree(path, onerror=__make_parent_writable)
+
+
+def _walk_tree(directories, directory_hash, relative_path=''):
+    """Yields `(directory hash, relative path)` pairs for every directory of
+    a tree, starting with its root.
+    """
+    yield directory_hash, relative_path
+    for directory_node in directories[directory_hash].directories:
+        yield from _walk_tree(directories, directory_node.digest.hash,
+                              os.path.join(relative_path, directory_node.name))
+
+
+def _is_self_contained(directories, directory_hash):
+    """Tells whether none of the symlinks of a tree point outside of it."""
+    for contained_hash, relative_path in _walk_tree(directories, directory_hash):
+        for symlink_node in directories[contained_hash].symlinks:
+            if os.path.isabs(symlink_node.target):
+                return False
+
+            target_path = os.path.normpath(os.path.join(relative_path, symlink_node.target))
+            if target_path == os.pardir or target_path.startswith(os.pardir + os.sep):
+                return False
+
+    return True
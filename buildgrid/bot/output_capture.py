@@ -0,0 +1,176 @@
+# Copyright (C) 2019 Bloomberg LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  <http://www.apache.org/licenses/LICENSE-2.0>
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Disable broad exception catch
+# pylint: disable=broad-except
+
+
+"""
+Output Capture
+==============
+
+Captures the output streams of the processes bots run, stdout and stderr,
+without holding them in memory.
+
+Captured data is spooled to a file on disk and hashed as it is read, so that
+it can be uploaded to CAS straight away once the process exits. Captures can
+be capped in size, data past the cap being discarded, and can forward data
+to a callback as it comes, for live monitoring.
+"""
+
+import logging
+import tempfile
+import threading
+
+from buildgrid._protos.build.bazel.remote.execution.v2 import remote_execution_pb2
+from buildgrid.settings import HASH, MAX_REQUEST_SIZE
+
+
+class OutputCapture:
+
+    def __init__(self, stream, name, directory=None, max_size=None, callback=None):
+        """Starts capturing a stream in a background thread, until EOF.
+
+        Args:
+            stream (io.BufferedReader): the stream to capture, a process' stdout
+                pipe for example.
+            name (str): the stream's name, for logging.
+            directory (str, optional): directory to spool captured data in.
+                Defaults to the system's temporary directory.
+            max_size (int, optional): maximum number of bytes to keep. Data
+                past that size is discarded. Defaults to no limit.
+            callback (callable, optional): function called with every chunk of
+                data as it is read, including discarded ones.
+        """
+        self.__logger = logging.getLogger(__name__)
+
+        self.__stream = stream
+        self.__name = name
+        self.__max_size = max_size
+        self.__callback = callback
+
+        self.__spool_file = tempfile.NamedTemporaryFile(dir=directory, prefix=name + '-')
+        self.__hasher = HASH()
+        self.__size = 0
+        self.__discarded_size = 0
+
+        self.__thread = threading.Thread(target=self.__capture, name='capture-' + name, daemon=True)
+        self.__thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    @property
+    def path(self):
+        """str: path to the file captured data is spooled to."""
+        return self.__spool_file.name
+
+    @property
+    def size(self):
+        """int: number of bytes captured so far."""
+        return self.__size
+
+    @property
+    def truncated(self):
+        """bool: whether or not data got discarded, the size cap being hit."""
+        return self.__discarded_size > 0
+
+    @property
+    def digest(self):
+        """:obj:`Digest`: the digest of the captured data.
+
+        Only meaningful once :meth:`wait` has returned.
+        """
+        return remote_execution_pb2.Digest(hash=self.__hasher.hexdigest(),
+                                           size_bytes=self.__size)
+
+    def wait(self, timeout=None):
+        """Waits for the stream to be entirely captured.
+
+        Args:
+            timeout (float, optional): maximum time to wait for, in seconds.
+
+        Returns:
+            bool: ``True`` if the stream has reached EOF.
+        """
+        self.__thread.join(timeout=timeout)
+
+        return not self.__thread.is_alive()
+
+    def read(self, max_size=None):
+        """Loads captured data in memory.
+
+        Args:
+            max_size (int, optional): maximum number of bytes to read.
+
+        Returns:
+            bytes: the captured data, up to `max_size`.
+        """
+        with open(self.path, 'rb') as byte_file:
+            return byte_file.read(-1 if max_size is None else max_size)
+
+    def close(self):
+        """Deletes the spool file."""
+        self.__spool_file.close()
+
+    def __capture(self):
+        try:
+            while True:
+                # Returns as soon as some data is available:
+                chunk = self.__stream.read1(MAX_REQUEST_SIZE)
+                if not chunk:
+                    break
+
+                kept_chunk = chunk
+                if self.__max_size is not None:
+                    kept_chunk = chunk[:max(self.__max_size - self.__size, 0)]
+                    self.__discarded_size += len(chunk) - len(kept_chunk)
+
+                if kept_chunk:
+                    self.__spool_file.write(kept_chunk)
+                    self.__hasher.update(kept_chunk)
+                    self.__size += len(kept_chunk)
+
+                if self.__callback is not None:
+                    try:
+                        self.__callback(chunk)
+                    except Exception:
+                        self.__logger.exception("Output callback failed for [%s]", self.__name)
+
+            self.__spool_file.flush()
+
+        finally:
+            self.__stream.close()
+
+        if self.truncated:
+            self.__logger.warning("Discarded [%s] bytes of [%s] past the [%s] bytes limit",
+                                  self.__discarded_size, self.__name, self.__max_size)
+
+
+def log_output(logger, name):
+    """Returns an :class:`OutputCapture` callback forwarding captured data to
+    a logger, line by line.
+
+    Args:
+        logger (logging.Logger): the logger to forward data to.
+        name (str): the captured stream's name, prefixed to every line.
+    """
+    def __log_output(chunk):
+        for line in chunk.decode(errors='replace').splitlines():
+            logger.info("[%s] %s", name, line)
+
+    return __log_output
@@ -20,6 +20,8 @@ Bot Session
 Allows connections
 """
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import logging
 import platform
 import grpc
@@ -71,12 +73,26 @@ class BotSession:
     async def run(self):
         interval = self._bots_interface.interval
         executing_interval = self._bots_interface.executing_interval
+
+        loop = asyncio.get_event_loop()
+        # Server calls are blocking, and may long-poll for work: they get
+        # their own thread so that the loop keeps tracking tenants meanwhile.
+        executor = ThreadPoolExecutor(max_workers=1)
         try:
             while True:
                 if not self.connected:
-                    self.create_bot_session()
+                    self.__logger.debug("Creating bot session")
+                    session = await loop.run_in_executor(
+                        executor, partial(self._bots_interface.create_bot_session,
+                                          self.__parent, self.get_pb2()))
+                    self._on_bot_session_created(session)
+
                 else:
-                    self.update_bot_session()
+                    self.__logger.debug("Updating bot session: [%s]", self.__bot_id)
+                    session = await loop.run_in_executor(
+                        executor, partial(self._bots_interface.update_bot_session,
+                                          self.get_pb2()))
+                    self._on_bot_session_updated(session)
 
                 if not self.connected:
                     await asyncio.sleep(interval)
@@ -84,11 +100,22 @@ class BotSession:
                     await self._tenant_manager.wait_on_tenants(executing_interval)
         except asyncio.CancelledError:
             pass
+        finally:
+            executor.shutdown(wait=False)
 
     def create_bot_session(self):
         self.__logger.debug("Creating bot session")
 
         session = self._bots_interface.create_bot_session(self.__parent, self.get_pb2())
+        self._on_bot_session_created(session)
+
+    def update_bot_session(self):
+        self.__logger.debug("Updating bot session: [%s]", self.__bot_id)
+
+        session = self._bots_interface.update_bot_session(self.get_pb2())
+        self._on_bot_session_updated(session)
+
+    def _on_bot_session_created(self, session):
         if session in list(grpc.StatusCode):
             self.__connected = False
             return
@@ -100,10 +127,7 @@ class BotSession:
         for lease in session.leases:
             self._register_lease(lease)
 
-    def update_bot_session(self):
-        self.__logger.debug("Updating bot session: [%s]", self.__bot_id)
-
-        session = self._bots_interface.update_bot_session(self.get_pb2())
+    def _on_bot_session_updated(self, session):
         if session in list(grpc.StatusCode):
             self.__connected = False
             return
@@ -17,6 +17,7 @@
 
 
 import asyncio
+from contextlib import suppress
 import logging
 from functools import partial
 
@@ -41,6 +42,8 @@ class TenantManager:
         self._tenants = {}
         self._tasks = {}
 
+        self.__lease_completed = asyncio.Event()
+
     def create_tenancy(self, lease):
         """Create a new :class:`Tenant`.
 
@@ -140,6 +143,8 @@ class TenantManager:
 
             self._update_lease_state(lease_id, LeaseState.COMPLETED)
 
+        self.__lease_completed.set()
+
     def create_work(self, lease_id, work, context):
         """Creates work to do.
 
@@ -176,11 +181,19 @@ class TenantManager:
         return self._tenants[lease_id].tenant_completed
 
     async def wait_on_tenants(self, timeout):
-        if self._tasks:
-            tasks = self._tasks.values()
-            await asyncio.wait(tasks,
-                               timeout=timeout,
-                               return_when=asyncio.FIRST_COMPLETED)
+        """Waits for a lease to complete.
+
+        Returns straight away if a lease completed since the last call, so
+        that completions can be reported without delay.
+
+        Args:
+            timeout (float) : Maximum time to wait for, in seconds.
+        """
+        if self._tasks and not self.__lease_completed.is_set():
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.__lease_completed.wait(), timeout)
+
+        self.__lease_completed.clear()
 
     def _update_lease_result(self, lease_id, result):
         """Updates the lease with the result."""
@@ -16,10 +16,15 @@
 
 
 from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from contextlib import contextmanager
+import logging
+from operator import attrgetter
 import os
+import shutil
 import uuid
 import sys
+import time
 
 import grpc
 
@@ -29,11 +34,24 @@ from buildgrid._protos.google.bytestream import bytestream_pb2, bytestream_pb2_g
 from buildgrid._protos.google.rpc import code_pb2
 from buildgrid.client.capabilities import CapabilitiesInterface
 from buildgrid.settings import HASH, MAX_REQUEST_SIZE, MAX_REQUEST_COUNT, BATCH_REQUEST_SIZE_THRESHOLD
-from buildgrid.utils import create_digest, merkle_tree_maker
+from buildgrid.utils import create_digest, create_digest_from_file, merkle_tree_maker, read_file
 
 
 _FileRequest = namedtuple('FileRequest', ['digest', 'output_paths'])
 
+# Maximum number of digests per FindMissingBlobs() request, keeping requests
+# below MAX_REQUEST_SIZE:
+_FIND_MISSING_BLOBS_BATCH_COUNT = 40000
+
+# Status codes for which interrupted ByteStream transfers get resumed:
+_RETRIABLE_STATUS_CODES = frozenset([
+    grpc.StatusCode.UNAVAILABLE,
+    grpc.StatusCode.ABORTED,
+    grpc.StatusCode.INTERNAL,
+    grpc.StatusCode.DEADLINE_EXCEEDED,
+    grpc.StatusCode.RESOURCE_EXHAUSTED,
+])
+
 
 class _CallCache:
     """Per remote grpc.StatusCode.UNIMPLEMENTED call cache."""
@@ -114,9 +132,9 @@ class _CasBatchRequestSizesCache:
 
 
 @contextmanager
-def download(channel, instance=None, u_uid=None):
+def download(channel, instance=None, u_uid=None, retries=3, backoff=1.0):
     """Context manager generator for the :class:`Downloader` class."""
-    downloader = Downloader(channel, instance=instance)
+    downloader = Downloader(channel, instance=instance, retries=retries, backoff=backoff)
     try:
         yield downloader
     finally:
@@ -135,17 +153,27 @@ class Downloader:
             downloader.get_message(message_digest)
     """
 
-    def __init__(self, channel, instance=None):
+    def __init__(self, channel, instance=None, retries=3, backoff=1.0):
         """Initializes a new :class:`Downloader` instance.
 
         Args:
             channel (grpc.Channel): A gRPC channel to the CAS endpoint.
             instance (str, optional): the targeted instance's name.
+            retries (int, optional): number of times an interrupted
+                ByteStream read is resumed before being given up on, not
+                counting the attempts that made progress. Defaults to 3.
+            backoff (float, optional): base delay, in seconds, between two
+                attempts, doubled after each failed one. Defaults to 1.0.
         """
+        self.__logger = logging.getLogger(__name__)
+
         self.channel = channel
 
         self.instance_name = instance
 
+        self._retries = retries
+        self._backoff = backoff
+
         self.__bytestream_stub = bytestream_pb2_grpc.ByteStreamStub(self.channel)
         self.__cas_stub = remote_execution_pb2_grpc.ContentAddressableStorageStub(self.channel)
 
@@ -232,6 +260,65 @@ class Downloader:
 
         return messages
 
+    def get_tree(self, digest):
+        """Retrieves every :obj:`Directory` of a tree from the remote CAS server.
+
+        Args:
+            digest (:obj:`Digest`): the tree's root directory digest.
+
+        Returns:
+            dict: the tree's :obj:`Directory` messages, keyed by digest hash.
+
+        Raises:
+            FileNotFoundError: if `digest` is not present in the remote CAS server.
+        """
+        directories = {}
+        # First, try GetTree() if not known to be unimplemented yet:
+        if not _CallCache.unimplemented(self.channel, 'GetTree'):
+            tree_request = remote_execution_pb2.GetTreeRequest()
+            tree_request.root_digest.CopyFrom(digest)
+            tree_request.page_size = MAX_REQUEST_COUNT
+            if self.instance_name is not None:
+                tree_request.instance_name = self.instance_name
+
+            try:
+                for tree_response in self.__cas_stub.GetTree(tree_request):
+                    for directory in tree_response.directories:
+                        directory_blob = directory.SerializeToString()
+                        directories[HASH(directory_blob).hexdigest()] = directory
+
+                if digest.hash in directories:
+                    return directories
+
+            except grpc.RpcError as e:
+                status_code = e.code()
+                if status_code == grpc.StatusCode.UNIMPLEMENTED:
+                    _CallCache.mark_unimplemented(self.channel, 'GetTree')
+
+                elif status_code == grpc.StatusCode.NOT_FOUND:
+                    raise FileNotFoundError("Requested directory does not exist on the remote.")
+
+                else:
+                    raise ConnectionError(e.details())
+
+        # Otherwise, fetch the tree level by level:
+        pending_digests = [digest]
+        while pending_digests:
+            next_digests = {}
+            for directory_blob in self._fetch_blob_batch(pending_digests):
+                directory = remote_execution_pb2.Directory()
+                directory.ParseFromString(directory_blob)
+                # Blobs may not be returned in the requested order:
+                directories[HASH(directory_blob).hexdigest()] = directory
+
+                for directory_node in directory.directories:
+                    if directory_node.digest.hash not in directories:
+                        next_digests[directory_node.digest.hash] = directory_node.digest
+
+            pending_digests = list(next_digests.values())
+
+        return directories
+
     def download_file(self, digest, file_path, is_executable=False, queue=True):
         """Retrieves a file from the remote CAS server.
 
@@ -259,21 +346,52 @@ class Downloader:
         else:
             self._queue_file(digest, file_path, is_executable=is_executable)
 
-    def download_directory(self, digest, directory_path):
+    def download_directory(self, digest, directory_path, max_workers=None):
         """Retrieves a :obj:`Directory` from the remote CAS server.
 
+        The whole tree is resolved first, then its files are fetched
+        concurrently, identical content being fetched only once and small
+        files being packed into batch requests regardless of the directory
+        they belong to.
+
         Args:
             digest (:obj:`Digest`): the directory's digest to fetch.
+            directory_path (str): absolute or relative path to the local
+                folder to write.
+            max_workers (int, optional): maximum number of requests to send
+                at the same time. Defaults to the :class:`ThreadPoolExecutor`
+                default.
 
         Raises:
-            NotFoundError: if `digest` is not present in the remote CAS server.
+            FileNotFoundError: if `digest` is not present in the remote CAS server.
             FileExistsError: if `directory_path` already contains parts of their
                 fetched directory's content.
         """
         if not os.path.isabs(directory_path):
             directory_path = os.path.abspath(directory_path)
 
-        self._fetch_directory(digest, directory_path)
+        # Better fail early if the local root path cannot be created:
+        os.makedirs(directory_path, exist_ok=True)
+
+        directories = self.get_tree(digest)
+
+        file_requests, symlinks = _make_directory_tree(directories, digest.hash,
+                                                       directory_path)
+
+        self._fetch_files(list(file_requests.values()), max_workers=max_workers)
+
+        for symlink_node, symlink_path in symlinks:
+            if not os.path.isabs(symlink_node.target):
+                target_path = os.path.join(os.path.dirname(symlink_path), symlink_node.target)
+            else:
+                target_path = symlink_node.target
+            target_path = os.path.normpath(target_path)
+
+            # Do not create links pointing outside the fetched directory:
+            if os.path.commonpath([directory_path, target_path]) != directory_path:
+                continue
+
+            os.symlink(symlink_node.target, symlink_path)
 
     def flush(self):
         """Ensures any queued request gets sent."""
@@ -303,30 +421,9 @@ class Downloader:
         """Fetches a blob using ByteStream.Read()"""
         read_blob = bytearray()
 
-        if self.instance_name:
-            resource_name = '/'.join([self.instance_name, 'blobs',
-                                      digest.hash, str(digest.size_bytes)])
-        else:
-            resource_name = '/'.join(['blobs', digest.hash, str(digest.size_bytes)])
-
-        read_request = bytestream_pb2.ReadRequest()
-        read_request.resource_name = resource_name
-        read_request.read_offset = 0
+        self._read_blob(digest, read_blob.extend)
 
-        try:
-            # TODO: Handle connection loss/recovery
-            for read_response in self.__bytestream_stub.Read(read_request):
-                read_blob += read_response.data
-
-            assert len(read_blob) == digest.size_bytes
-
-        except grpc.RpcError as e:
-            status_code = e.code()
-            if status_code == grpc.StatusCode.NOT_FOUND:
-                raise FileNotFoundError("Requested data does not exist on the remote.")
-
-            else:
-                raise ConnectionError(e.details())
+        assert len(read_blob) == digest.size_bytes
 
         return read_blob
 
@@ -343,18 +440,25 @@ class Downloader:
                 batch_request.instance_name = self.instance_name
 
             try:
+                read_blobs_by_hash = {}
                 batch_response = self.__cas_stub.BatchReadBlobs(batch_request)
                 for response in batch_response.responses:
                     assert response.digest in digests
 
-                    read_blobs.append(response.data)
-
                     if response.status.code == code_pb2.NOT_FOUND:
                         raise FileNotFoundError('Requested blob does not exist '
                                                 'on the remote.')
                     if response.status.code != code_pb2.OK:
                         raise ConnectionError('Error in CAS reply while fetching blob.')
 
+                    read_blobs_by_hash[response.digest.hash] = response.data
+
+                if not all(digest.hash in read_blobs_by_hash for digest in digests):
+                    raise ConnectionError('Missing blobs in CAS reply.')
+
+                # Blobs may not be returned in the requested order:
+                read_blobs.extend(read_blobs_by_hash[digest.hash] for digest in digests)
+
                 batch_fetched = True
 
             except grpc.RpcError as e:
@@ -363,7 +467,6 @@ class Downloader:
                     _CallCache.mark_unimplemented(self.channel, 'BatchReadBlobs')
 
                 elif status_code == grpc.StatusCode.INVALID_ARGUMENT:
-                    read_blobs.clear()
                     batch_fetched = False
 
                 else:
@@ -378,6 +481,22 @@ class Downloader:
 
     def _fetch_file(self, digest, file_path, is_executable=False):
         """Fetches a file using ByteStream.Read()"""
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        with open(file_path, 'wb') as byte_file:
+            self._read_blob(digest, byte_file.write)
+
+            assert byte_file.tell() == digest.size_bytes
+
+        if is_executable:
+            os.chmod(file_path, 0o755)  # rwxr-xr-x / 755
+
+    def _read_blob(self, digest, write):
+        """Reads a blob using ByteStream.Read(), passing its data chunk by
+        chunk to `write`.
+
+        Interrupted reads are resumed from the last received offset.
+        """
         if self.instance_name:
             resource_name = '/'.join([self.instance_name, 'blobs',
                                       digest.hash, str(digest.size_bytes)])
@@ -386,19 +505,32 @@ class Downloader:
 
         read_request = bytestream_pb2.ReadRequest()
         read_request.resource_name = resource_name
-        read_request.read_offset = 0
 
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        read_offset, attempt = 0, 0
+        while True:
+            read_request.read_offset = read_offset
+            try:
+                for read_response in self.__bytestream_stub.Read(read_request):
+                    write(read_response.data)
+                    read_offset += len(read_response.data)
 
-        with open(file_path, 'wb') as byte_file:
-            # TODO: Handle connection loss/recovery
-            for read_response in self.__bytestream_stub.Read(read_request):
-                byte_file.write(read_response.data)
+                return
 
-            assert byte_file.tell() == digest.size_bytes
+            except grpc.RpcError as e:
+                status_code = e.code()
+                if status_code == grpc.StatusCode.NOT_FOUND:
+                    raise FileNotFoundError("Requested data does not exist on the remote.")
 
-        if is_executable:
-            os.chmod(file_path, 0o755)  # rwxr-xr-x / 755
+                # Attempts making progress are not counted as failures:
+                attempt = 1 if read_offset > read_request.read_offset else attempt + 1
+                if status_code not in _RETRIABLE_STATUS_CODES or attempt > self._retries:
+                    raise ConnectionError(e.details())
+
+                self.__logger.warning("Read of blob [%s/%s] interrupted at offset [%s], "
+                                      "resuming (attempt %s/%s): %s", digest.hash, digest.size_bytes,
+                                      read_offset, attempt, self._retries, e.details())
+
+                time.sleep(_retry_delay(e, attempt, self._backoff))
 
     def _queue_file(self, digest, file_path, is_executable=False):
         """Queues a file for later batch download"""
@@ -447,127 +579,58 @@ class Downloader:
                 if is_executable:
                     os.chmod(file_path, 0o755)  # rwxr-xr-x / 755
 
-    def _fetch_directory(self, digest, directory_path):
-        """Fetches a file using ByteStream.GetTree()"""
-        # Better fail early if the local root path cannot be created:
-        os.makedirs(directory_path, exist_ok=True)
+    def _fetch_files(self, requests, max_workers=None):
+        """Fetches files concurrently, small ones using
+        ContentAddressableStorage.BatchReadBlobs(), others using
+        ByteStream.Read().
 
-        directories = {}
-        directory_fetched = False
-        # First, try GetTree() if not known to be unimplemented yet:
-        if not _CallCache.unimplemented(self.channel, 'GetTree'):
-            tree_request = remote_execution_pb2.GetTreeRequest()
-            tree_request.root_digest.CopyFrom(digest)
-            tree_request.page_size = MAX_REQUEST_COUNT
-            if self.instance_name is not None:
-                tree_request.instance_name = self.instance_name
-
-            try:
-                for tree_response in self.__cas_stub.GetTree(tree_request):
-                    for directory in tree_response.directories:
-                        directory_blob = directory.SerializeToString()
-                        directory_hash = HASH(directory_blob).hexdigest()
-
-                        directories[directory_hash] = directory
-
-                assert digest.hash in directories
-
-                directory = directories[digest.hash]
-                self._write_directory(directory, directory_path,
-                                      directories=directories, root_barrier=directory_path)
-
-                directory_fetched = True
-            except grpc.RpcError as e:
-                status_code = e.code()
-                if status_code == grpc.StatusCode.UNIMPLEMENTED:
-                    _CallCache.mark_unimplemented(self.channel, 'GetTree')
-
-                elif status_code == grpc.StatusCode.NOT_FOUND:
-                    raise FileNotFoundError("Requested directory does not exist on the remote.")
-
-                else:
-                    raise ConnectionError(e.details())
-
-        # If no GetTree(), _write_directory() will use BatchReadBlobs()
-        # if available or Read() if not.
-        if not directory_fetched:
-            directory = remote_execution_pb2.Directory()
-            directory.ParseFromString(self._fetch_blob(digest))
-
-            self._write_directory(directory, directory_path,
-                                  root_barrier=directory_path)
-
-    def _write_directory(self, root_directory, root_path, directories=None,
-                         root_barrier=None):
-        """Generates a local directory structure"""
-
-        # i) Files:
-        for file_node in root_directory.files:
-            file_path = os.path.join(root_path, file_node.name)
-
-            self.download_file(file_node.digest, file_path,
-                               is_executable=file_node.is_executable)
-        self.flush()
-
-        # ii) Directories:
-        pending_directory_digests = []
-        pending_directory_paths = {}
-        for directory_node in root_directory.directories:
-            directory_hash = directory_node.digest.hash
+        Args:
+            requests (list): the :class:`_FileRequest`\ s to fetch, one per
+                distinct digest.
+            max_workers (int): maximum number of requests to send at the
+                same time.
+        """
+        batch_size_limit = self._max_effective_batch_size_bytes() - 1024*128
+        queueable_size_limit = self._queueable_file_size_threshold()
 
-            directory_path = os.path.join(root_path, directory_node.name)
-            os.makedirs(directory_path, exist_ok=True)
+        # Largest files first, so that streams overlap with batches:
+        requests = sorted(requests, key=lambda request: request.digest.size_bytes,
+                          reverse=True)
 
-            if directories and directory_node.digest.hash in directories:
-                # We already have the directory; just write it:
-                directory = directories[directory_hash]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            fetches = []
 
-                self._write_directory(directory, directory_path,
-                                      directories=directories,
-                                      root_barrier=root_barrier)
-            else:
-                # Gather all the directories that we need to get to
-                # try fetching them in a single batch request:
-                pending_directory_digests.append(directory_node.digest)
-                pending_directory_paths[directory_hash] = directory_path
+            batch, batch_size = {}, 0
+            for request in requests:
+                if request.digest.size_bytes > queueable_size_limit:
+                    fetches.append(executor.submit(self._fetch_file_copies, request))
+                    continue
 
-        if pending_directory_paths:
-            fetched_blobs = self._fetch_blob_batch(pending_directory_digests)
+                if (batch_size + request.digest.size_bytes > batch_size_limit or
+                        len(batch) >= MAX_REQUEST_COUNT):
+                    fetches.append(executor.submit(self._fetch_file_batch, batch))
+                    batch, batch_size = {}, 0
 
-            for directory_blob in fetched_blobs:
-                directory = remote_execution_pb2.Directory()
-                directory.ParseFromString(directory_blob)
+                batch[request.digest.hash] = request
+                batch_size += request.digest.size_bytes
 
-                # Assuming that the server might not return the blobs in
-                # the same order than they were asked for, we read
-                # the hashes of the returned blobs:
-                directory_hash = create_digest(directory_blob).hash
-                # Guarantees for the reply orderings might change in
-                # the specification at some point.
-                # See: github.com/bazelbuild/remote-apis/issues/52
+            if batch:
+                fetches.append(executor.submit(self._fetch_file_batch, batch))
 
-                directory_path = pending_directory_paths[directory_hash]
+            for fetch in fetches:
+                fetch.result()
 
-                self._write_directory(directory, directory_path,
-                                      directories=directories,
-                                      root_barrier=root_barrier)
+    def _fetch_file_copies(self, request):
+        """Fetches a file using ByteStream.Read(), once for all its output paths"""
+        (file_path, is_executable), *other_output_paths = request.output_paths
 
-        # iii) Symlinks:
-        for symlink_node in root_directory.symlinks:
-            symlink_path = os.path.join(root_path, symlink_node.name)
-            if not os.path.isabs(symlink_node.target):
-                target_path = os.path.join(root_path, symlink_node.target)
-            else:
-                target_path = symlink_node.target
-            target_path = os.path.normpath(target_path)
+        self._fetch_file(request.digest, file_path, is_executable=is_executable)
 
-            # Do not create links pointing outside the barrier:
-            if root_barrier is not None:
-                common_path = os.path.commonprefix([root_barrier, target_path])
-                if not common_path.startswith(root_barrier):
-                    continue
+        for other_file_path, other_is_executable in other_output_paths:
+            shutil.copyfile(file_path, other_file_path)
 
-            os.symlink(symlink_path, target_path)
+            if other_is_executable:
+                os.chmod(other_file_path, 0o755)  # rwxr-xr-x / 755
 
     def _max_effective_batch_size_bytes(self):
         """Returns the effective maximum number of bytes that can be
@@ -585,9 +648,9 @@ class Downloader:
 
 
 @contextmanager
-def upload(channel, instance=None, u_uid=None):
+def upload(channel, instance=None, u_uid=None, retries=3, backoff=1.0):
     """Context manager generator for the :class:`Uploader` class."""
-    uploader = Uploader(channel, instance=instance, u_uid=u_uid)
+    uploader = Uploader(channel, instance=instance, u_uid=u_uid, retries=retries, backoff=backoff)
     try:
         yield uploader
     finally:
@@ -606,14 +669,21 @@ class Uploader:
             uploader.upload_file('/path/to/local/file')
     """
 
-    def __init__(self, channel, instance=None, u_uid=None):
+    def __init__(self, channel, instance=None, u_uid=None, retries=3, backoff=1.0):
         """Initializes a new :class:`Uploader` instance.
 
         Args:
             channel (grpc.Channel): A gRPC channel to the CAS endpoint.
             instance (str, optional): the targeted instance's name.
             u_uid (str, optional): a UUID for CAS transactions.
+            retries (int, optional): number of times an interrupted
+                ByteStream write is resumed before being given up on, not
+                counting the attempts that made progress. Defaults to 3.
+            backoff (float, optional): base delay, in seconds, between two
+                attempts, doubled after each failed one. Defaults to 1.0.
         """
+        self.__logger = logging.getLogger(__name__)
+
         self.channel = channel
 
         self.instance_name = instance
@@ -622,6 +692,9 @@ class Uploader:
         else:
             self.u_uid = str(uuid.uuid4())
 
+        self._retries = retries
+        self._backoff = backoff
+
         self.__bytestream_stub = bytestream_pb2_grpc.ByteStreamStub(self.channel)
         self.__cas_stub = remote_execution_pb2_grpc.ContentAddressableStorageStub(self.channel)
 
@@ -682,18 +755,23 @@ class Uploader:
 
         return message_digest
 
-    def upload_file(self, file_path, queue=True):
+    def upload_file(self, file_path, queue=True, digest=None):
         """Stores a local file into the remote CAS storage.
 
         If queuing is allowed (`queue=True`), the upload request **may** be
         defer. An explicit call to :func:`~flush` can force the request to be
         send immediately (allong with the rest of the queued batch).
 
+        Files too large to be queued are sent chunk by chunk, never loaded in
+        memory as a whole.
+
         Args:
             file_path (str): absolute or relative path to a local file.
             queue (bool, optional): whether or not the upload request may be
                 queued and submitted as part of a batch upload request. Defaults
                 to True.
+            digest (:obj:`Digest`, optional): the file's content digest, if
+                already known.
 
         Returns:
             :obj:`Digest`: The digest of the file's content.
@@ -705,28 +783,32 @@ class Uploader:
         if not os.path.isabs(file_path):
             file_path = os.path.abspath(file_path)
 
-        with open(file_path, 'rb') as bytes_steam:
-            file_bytes = bytes_steam.read()
-
-        if not queue or len(file_bytes) > self._queueable_file_size_threshold():
-            file_digest = self._send_blob(file_bytes)
+        if not queue or os.path.getsize(file_path) > self._queueable_file_size_threshold():
+            if digest is None:
+                digest = create_digest_from_file(file_path)
+            file_digest = self._send_file(file_path, digest)
         else:
-            file_digest = self._queue_blob(file_bytes)
+            file_digest = self._queue_blob(read_file(file_path), digest=digest)
 
         return file_digest
 
-    def upload_directory(self, directory_path, queue=True):
+    def upload_directory(self, directory_path, queue=True, max_workers=None):
         """Stores a local folder into the remote CAS storage.
 
-        If queuing is allowed (`queue=True`), the upload request **may** be
-        defer. An explicit call to :func:`~flush` can force the request to be
-        send immediately (allong with the rest of the queued batch).
+        Only the blobs missing from the remote CAS storage are sent,
+        concurrently. Files are hashed chunk by chunk, and only read again if
+        they need sending.
+
+        If queuing is allowed (`queue=True`), small blobs are sent as part of
+        batch upload requests.
 
         Args:
             directory_path (str): absolute or relative path to a local folder.
             queue (bool, optional): wheter or not the upload requests may be
-                queued and submitted as part of a batch upload request. Defaults
-                to True.
+                batched. Defaults to True.
+            max_workers (int, optional): maximum number of requests to send
+                at the same time. Defaults to the :class:`ThreadPoolExecutor`
+                default.
 
         Returns:
             :obj:`Digest`: The digest of the top :obj:`Directory`.
@@ -740,56 +822,23 @@ class Uploader:
 
         last_directory_node = None
 
-        stub = remote_execution_pb2_grpc.ContentAddressableStorageStub(self.channel)
-
-        blobs = []
-        for node, blob, _ in merkle_tree_maker(directory_path):
+        # {hash: (digest, Directory blob or file path)}, identical content
+        # appearing only once:
+        sources = {}
+        for node, blob, path in merkle_tree_maker(directory_path, file_blobs=False):
             if node.DESCRIPTOR is remote_execution_pb2.DirectoryNode.DESCRIPTOR:
                 last_directory_node = node
-            blobs.append((node.digest, blob, node.name,))
-        i = 0
-        fmb_response_list = []
-        max_chunk = 40000
-        print("Nodes count "+str(len(blobs)))
-        while i < len(blobs):
-            print("Sending {} batch of FMB".format(i//max_chunk))
-            blobchunk = []
-            if i < len(blobs):
-                blobchunk = blobs[i:i+max_chunk]
+                sources.setdefault(node.digest.hash, (node.digest, blob))
             else:
-                blobchunk = blobs[i:]
-
-            only_digests = []
-            for el in blobchunk:
-                only_digests.append(el[0])
-
-            request = remote_execution_pb2.FindMissingBlobsRequest(instance_name=self.instance_name,
-                blob_digests=only_digests)
-            fmb_response = stub.FindMissingBlobs(request)
-            fmb_response_list.extend(fmb_response.missing_blob_digests)
-            i = i + max_chunk
-
-        if not queue:
-            j = 0
-            for iterable in blobs:
-                j += 1
-                if j%10000 == 0:
-                    print("Nodes checked "+str(j))
-                if iterable[0] in fmb_response_list:
-                    print("Uploading '%s'..." % iterable[2])
-                    self._send_blob(iterable[1], digest=iterable[0])
-                    fmb_response_list.remove(iterable[0])
+                sources.setdefault(node.digest.hash, (node.digest, path))
 
-        else:
-            j = 0
-            for iterable in blobs:
-                j += 1
-                if j%10000 == 0:
-                    print("Nodes checked "+str(j))
-                if iterable[0] in fmb_response_list:
-                    print("Uploading '%s'..." % iterable[2])
-                    self._queue_blob(iterable[1], digest=iterable[0])
-                    fmb_response_list.remove(iterable[0])
+        missing_digests = self.find_missing_blobs([digest for digest, _ in sources.values()])
+
+        self.__logger.debug("Uploading [%s] of the [%s] blobs of [%s]",
+                            len(missing_digests), len(sources), directory_path)
+
+        self._upload_missing([sources[digest.hash] for digest in missing_digests],
+                             queue=queue, max_workers=max_workers)
 
         return last_directory_node.digest
 
@@ -816,27 +865,18 @@ class Uploader:
         if not os.path.isabs(directory_path):
             directory_path = os.path.abspath(directory_path)
 
-        directories = []
+        # The tree is scanned first so that all its files get sent at once:
+        directory_scan = _scan_directory(directory_path)
 
-        if not queue:
-            for node, blob, _ in merkle_tree_maker(directory_path):
-                if node.DESCRIPTOR is remote_execution_pb2.DirectoryNode.DESCRIPTOR:
-                    # TODO: Get the Directory object from merkle_tree_maker():
-                    directory = remote_execution_pb2.Directory()
-                    directory.ParseFromString(blob)
-                    directories.append(directory)
+        file_paths = []
+        _list_scanned_files(directory_scan, file_paths)
+        file_digests = self.upload_files(file_paths, queue=queue)
 
-                self._send_blob(blob, digest=node.digest)
-
-        else:
-            for node, blob, _ in merkle_tree_maker(directory_path):
-                if node.DESCRIPTOR is remote_execution_pb2.DirectoryNode.DESCRIPTOR:
-                    # TODO: Get the Directory object from merkle_tree_maker():
-                    directory = remote_execution_pb2.Directory()
-                    directory.ParseFromString(blob)
-                    directories.append(directory)
+        directories = []
+        _complete_scanned_directory(directory_scan, file_digests, directories)
 
-                self._queue_blob(blob, digest=node.digest)
+        for directory in directories:
+            self.put_message(directory, queue=queue)
 
         tree = remote_execution_pb2.Tree()
         tree.root.CopyFrom(directories[-1])
@@ -844,6 +884,83 @@ class Uploader:
 
         return self.put_message(tree, queue=queue)
 
+    def upload_files(self, file_paths, queue=True, max_workers=None):
+        """Stores local files into the remote CAS storage, skipping the ones
+        already present there.
+
+        Files are hashed and sent concurrently, reading them chunk by chunk,
+        so that memory usage does not depend on their size.
+
+        If queuing is allowed (`queue=True`), small files are sent as part of
+        batch upload requests.
+
+        Args:
+            file_paths (list): absolute or relative paths to local files.
+            queue (bool, optional): whether or not the upload requests may be
+                batched. Defaults to True.
+            max_workers (int, optional): maximum number of files to hash or
+                send at the same time. Defaults to the
+                :class:`ThreadPoolExecutor` default.
+
+        Returns:
+            dict: The :obj:`Digest` of each file's content, keyed by path.
+
+        Raises:
+            FileNotFoundError: If one of `file_paths` does not exist.
+            PermissionError: If one of `file_paths` is not readable.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            file_digests = dict(zip(file_paths, executor.map(create_digest_from_file, file_paths)))
+
+        # Only one copy of each content needs sending:
+        file_paths_by_hash = {}
+        for file_path, file_digest in file_digests.items():
+            file_paths_by_hash.setdefault(file_digest.hash, file_path)
+
+        missing_digests = self.find_missing_blobs(
+            [file_digests[file_path] for file_path in file_paths_by_hash.values()])
+
+        self.__logger.debug("Uploading [%s] of [%s] files",
+                            len(missing_digests), len(file_paths_by_hash))
+
+        self._upload_missing([(file_digest, file_paths_by_hash[file_digest.hash])
+                              for file_digest in missing_digests],
+                             queue=queue, max_workers=max_workers)
+
+        return file_digests
+
+    def find_missing_blobs(self, digests):
+        """Checks for blobs missing from the remote CAS server.
+
+        Args:
+            digests (list): list of :obj:`Digest`\ s to look for.
+
+        Returns:
+            list: The :obj:`Digest`\ s missing from the remote CAS server.
+        """
+        def __find_missing_blobs(digests_batch):
+            request = remote_execution_pb2.FindMissingBlobsRequest(
+                instance_name=self.instance_name, blob_digests=digests_batch)
+
+            try:
+                return self.__cas_stub.FindMissingBlobs(request).missing_blob_digests
+            except grpc.RpcError as e:
+                raise ConnectionError(e.details())
+
+        digests_batches = [digests[index:index + _FIND_MISSING_BLOBS_BATCH_COUNT]
+                           for index in range(0, len(digests), _FIND_MISSING_BLOBS_BATCH_COUNT)]
+
+        missing_digests = []
+        if len(digests_batches) > 1:
+            with ThreadPoolExecutor() as executor:
+                for missing_digests_batch in executor.map(__find_missing_blobs, digests_batches):
+                    missing_digests.extend(missing_digests_batch)
+
+        elif digests_batches:
+            missing_digests.extend(__find_missing_blobs(digests_batches[0]))
+
+        return missing_digests
+
     def flush(self):
         """Ensures any queued request gets sent."""
         if self.__requests:
@@ -867,6 +984,59 @@ class Uploader:
 
     # --- Private API ---
 
+    def _upload_missing(self, sources, queue=True, max_workers=None):
+        """Sends blobs or local files concurrently.
+
+        Args:
+            sources (list): `(digest, blob or file path)` pairs.
+            queue (bool): whether or not small blobs may be batched.
+            max_workers (int): maximum number of requests to send at the
+                same time.
+        """
+        if max_workers is None:
+            # Same default as ThreadPoolExecutor's:
+            max_workers = min(32, (os.cpu_count() or 1) + 4)
+
+        batch_size_limit = self._max_effective_batch_size_bytes()
+        queueable_size_limit = self._queueable_file_size_threshold()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending_requests = set()
+
+            def __submit(function, *args):
+                nonlocal pending_requests
+                # Bounds the amount of data read ahead of being sent:
+                while len(pending_requests) >= 2 * max_workers:
+                    done_requests, pending_requests = wait(pending_requests,
+                                                           return_when=FIRST_COMPLETED)
+                    for done_request in done_requests:
+                        done_request.result()
+
+                pending_requests.add(executor.submit(function, *args))
+
+            batch, batch_size = {}, 0
+            for digest, source in sources:
+                if queue and digest.size_bytes <= queueable_size_limit:
+                    if (batch_size + digest.size_bytes > batch_size_limit or
+                            len(batch) >= MAX_REQUEST_COUNT):
+                        __submit(self._send_blob_batch, batch)
+                        batch, batch_size = {}, 0
+
+                    blob = source if isinstance(source, bytes) else read_file(source)
+                    batch[digest.hash] = (blob, digest)
+                    batch_size += digest.size_bytes
+
+                elif isinstance(source, bytes):
+                    __submit(self._send_blob, source, digest)
+                else:
+                    __submit(self._send_file, source, digest)
+
+            if batch:
+                __submit(self._send_blob_batch, batch)
+
+            for pending_request in pending_requests:
+                pending_request.result()
+
     def _send_blob(self, blob, digest=None):
         """Sends a memory block using ByteStream.Write()"""
         blob_digest = remote_execution_pb2.Digest()
@@ -875,42 +1045,126 @@ class Uploader:
         else:
             blob_digest.hash = HASH(blob).hexdigest()
             blob_digest.size_bytes = len(blob)
-        if self.instance_name:
-            resource_name = '/'.join([self.instance_name, 'uploads', self.u_uid, 'blobs',
-                                      blob_digest.hash, str(blob_digest.size_bytes)])
-        else:
-            resource_name = '/'.join(['uploads', self.u_uid, 'blobs',
-                                      blob_digest.hash, str(blob_digest.size_bytes)])
 
-        def __write_request_stream(resource, content):
-            offset = 0
-            finished = False
-            remaining = len(content)
-            while not finished:
-                chunk_size = min(remaining, MAX_REQUEST_SIZE)
-                remaining -= chunk_size
+        def __read_chunks(offset):
+            for chunk_offset in range(offset, len(blob), MAX_REQUEST_SIZE):
+                yield blob[chunk_offset:chunk_offset + MAX_REQUEST_SIZE]
+
+        self._write_blob(blob_digest, __read_chunks)
+
+        return blob_digest
+
+    def _send_file(self, file_path, digest):
+        """Sends a local file using ByteStream.Write(), reading it chunk by chunk"""
+        with open(file_path, 'rb') as byte_file:
+            def __read_chunks(offset):
+                # Positional reads, an interrupted request may still be
+                # iterating over its own chunks:
+                while True:
+                    chunk = os.pread(byte_file.fileno(), MAX_REQUEST_SIZE, offset)
+                    if not chunk:
+                        break
+
+                    yield chunk
+
+                    offset += len(chunk)
+
+            self._write_blob(digest, __read_chunks)
+
+        return digest
+
+    def _write_blob(self, digest, read_chunks):
+        """Writes a blob using ByteStream.Write().
+
+        Interrupted writes are resumed from the size committed by the server,
+        as reported by ByteStream.QueryWriteStatus().
+
+        Args:
+            digest (:obj:`Digest`): the blob's digest.
+            read_chunks (callable): function returning an iterator over the
+                blob's data, chunk by chunk, from the offset it is given.
+        """
+        resource_name = self._write_resource_name(digest)
+
+        def __write_request_stream(write_offset):
+            chunks = read_chunks(write_offset)
+            # An empty request is still needed to finish empty writes:
+            chunk = next(chunks, b'')
+            while chunk is not None:
+                next_chunk = next(chunks, None)
 
                 request = bytestream_pb2.WriteRequest()
-                request.resource_name = resource
-                request.data = content[offset:offset + chunk_size]
-                request.write_offset = offset
-                request.finish_write = remaining <= 0
+                request.resource_name = resource_name
+                request.data = chunk
+                request.write_offset = write_offset
+                request.finish_write = next_chunk is None
 
                 yield request
 
-                offset += chunk_size
-                finished = request.finish_write
+                write_offset += len(chunk)
+                chunk = next_chunk
+
+        write_offset, attempt = 0, 0
+        while True:
+            try:
+                write_response = self.__bytestream_stub.Write(__write_request_stream(write_offset))
+
+                assert write_response.committed_size == digest.size_bytes
+
+                return
 
-        write_resquests = __write_request_stream(resource_name, blob)
-        # TODO: Handle connection loss/recovery using QueryWriteStatus()
+            except grpc.RpcError as e:
+                status_code = e.code()
+                # Servers may not be able to resume from the expected offset:
+                resumable = write_offset > 0 and status_code == grpc.StatusCode.INVALID_ARGUMENT
+
+                attempt += 1
+                if (not resumable and status_code not in _RETRIABLE_STATUS_CODES or
+                        attempt > self._retries):
+                    raise ConnectionError(e.details())
+
+                time.sleep(_retry_delay(e, attempt, self._backoff))
+
+                write_status = self._query_write_status(resource_name)
+                if write_status.complete:
+                    return
+
+                self.__logger.warning("Write of blob [%s/%s] interrupted, resuming at offset [%s] "
+                                      "(attempt %s/%s): %s", digest.hash, digest.size_bytes,
+                                      write_status.committed_size, attempt, self._retries, e.details())
+
+                # Attempts making progress are not counted as failures:
+                if write_status.committed_size > write_offset:
+                    attempt = 0
+
+                write_offset = write_status.committed_size
+
+    def _query_write_status(self, resource_name):
+        """Retrieves the state of an interrupted write using
+        ByteStream.QueryWriteStatus(), nothing being committed if unknown.
+        """
+        write_status = bytestream_pb2.QueryWriteStatusResponse()
+
+        if _CallCache.unimplemented(self.channel, 'QueryWriteStatus'):
+            return write_status
+
+        request = bytestream_pb2.QueryWriteStatusRequest(resource_name=resource_name)
         try:
-            write_response = self.__bytestream_stub.Write(write_resquests)
+            write_status.CopyFrom(self.__bytestream_stub.QueryWriteStatus(request))
+
         except grpc.RpcError as e:
-            raise ConnectionError(e.details())
+            if e.code() == grpc.StatusCode.UNIMPLEMENTED:
+                _CallCache.mark_unimplemented(self.channel, 'QueryWriteStatus')
 
-        assert write_response.committed_size == blob_digest.size_bytes
+        return write_status
 
-        return blob_digest
+    def _write_resource_name(self, digest):
+        """Returns the ByteStream resource name to write a blob to"""
+        if self.instance_name:
+            return '/'.join([self.instance_name, 'uploads', self.u_uid, 'blobs',
+                             digest.hash, str(digest.size_bytes)])
+        return '/'.join(['uploads', self.u_uid, 'blobs',
+                         digest.hash, str(digest.size_bytes)])
 
     def _queue_blob(self, blob, digest=None):
         """Queues a memory block for later batch upload"""
@@ -927,10 +1181,10 @@ class Uploader:
         batch_size_limit = self._max_effective_batch_size_bytes()
 
         if self.__request_size + blob_digest.size_bytes > batch_size_limit:
-            print("Request size limit reached, flushing.")
+            self.__logger.debug("Request size limit reached, flushing.")
             self.flush()
         elif self.__request_count >= (MAX_REQUEST_COUNT):
-            print("Request count limit reached, flushing.")
+            self.__logger.debug("Request count limit reached, flushing.")
             self.flush()
 
         self.__requests[blob_digest.hash] = (blob, blob_digest)
@@ -998,3 +1252,127 @@ class Uploader:
         """
         return _CasBatchRequestSizesCache.batch_request_size_threshold(self.channel,
                                                                        self.instance_name)
+
+
+def _scan_directory(directory_path):
+    """Walks a local folder tree, listing its content.
+
+    Returns:
+        tuple: a :obj:`Directory` message, whose file and directory nodes have
+        no digest yet, the paths to its files and the scans of its
+        subdirectories, in the same order as the nodes.
+    """
+    directory = remote_execution_pb2.Directory()
+
+    files, directories, symlinks = [], [], []
+    for directory_entry in os.scandir(directory_path):
+        if directory_entry.is_file(follow_symlinks=False):
+            node = remote_execution_pb2.FileNode(name=directory_entry.name)
+            node.is_executable = os.access(directory_entry.path, os.X_OK)
+            files.append((node, directory_entry.path))
+
+        elif directory_entry.is_dir(follow_symlinks=False):
+            node = remote_execution_pb2.DirectoryNode(name=directory_entry.name)
+            directories.append((node, _scan_directory(directory_entry.path)))
+
+        elif directory_entry.is_symlink():
+            node = remote_execution_pb2.SymlinkNode(name=directory_entry.name)
+            node.target = os.readlink(directory_entry.path)
+            symlinks.append(node)
+
+    files.sort(key=lambda entry: entry[0].name)
+    directories.sort(key=lambda entry: entry[0].name)
+    symlinks.sort(key=attrgetter('name'))
+
+    directory.files.extend([node for node, _ in files])
+    directory.directories.extend([node for node, _ in directories])
+    directory.symlinks.extend(symlinks)
+
+    return directory, [path for _, path in files], [scan for _, scan in directories]
+
+
+def _list_scanned_files(directory_scan, file_paths):
+    """Appends the paths to the files of a scanned folder tree to `file_paths`."""
+    _, directory_file_paths, subdirectory_scans = directory_scan
+
+    file_paths.extend(directory_file_paths)
+    for subdirectory_scan in subdirectory_scans:
+        _list_scanned_files(subdirectory_scan, file_paths)
+
+
+def _complete_scanned_directory(directory_scan, file_digests, directories):
+    """Fills in the node digests of a scanned folder tree.
+
+    Completed :obj:`Directory` messages are appended to `directories`,
+    children first.
+
+    Returns:
+        :obj:`Digest`: the digest of the folder's :obj:`Directory`.
+    """
+    directory, file_paths, subdirectory_scans = directory_scan
+
+    for node, file_path in zip(directory.files, file_paths):
+        node.digest.CopyFrom(file_digests[file_path])
+    for node, subdirectory_scan in zip(directory.directories, subdirectory_scans):
+        node.digest.CopyFrom(_complete_scanned_directory(subdirectory_scan, file_digests, directories))
+
+    directories.append(directory)
+
+    return create_digest(directory.SerializeToString())
+
+
+def _retry_delay(rpc_error, attempt, backoff):
+    """Returns the time to wait for, in seconds, before retrying a failed
+    request, honouring the server's ``grpc-retry-pushback-ms`` hint, if any.
+    """
+    retry_delay = backoff * 2 ** (attempt - 1)
+
+    if isinstance(rpc_error, grpc.Call):
+        for key, value in rpc_error.trailing_metadata() or ():
+            if key == 'grpc-retry-pushback-ms' and value.isdigit():
+                retry_delay = max(retry_delay, int(value) / 1000)
+
+    return retry_delay
+
+
+def _make_directory_tree(directories, directory_hash, directory_path):
+    """Creates the folders of a tree and lists the files and symlinks to
+    write into them.
+
+    Args:
+        directories (dict): the tree's :obj:`Directory` messages, keyed by
+            digest hash.
+        directory_hash (str): the tree's root directory digest hash.
+        directory_path (str): path to the local folder to write the tree to.
+
+    Returns:
+        tuple: a `{hash: _FileRequest}` dictionary, identical content being
+            listed only once, and a list of `(SymlinkNode, path)` pairs.
+    """
+    file_requests, symlinks = {}, []
+
+    pending_directories = [(directory_hash, directory_path)]
+    while pending_directories:
+        directory_hash, directory_path = pending_directories.pop()
+        directory = directories[directory_hash]
+
+        for file_node in directory.files:
+            output_path = (os.path.join(directory_path, file_node.name),
+                           file_node.is_executable)
+
+            if file_node.digest.hash not in file_requests:
+                file_requests[file_node.digest.hash] = _FileRequest(
+                    digest=file_node.digest, output_paths=[output_path])
+            else:
+                file_requests[file_node.digest.hash].output_paths.append(output_path)
+
+        for directory_node in directory.directories:
+            child_path = os.path.join(directory_path, directory_node.name)
+            os.makedirs(child_path, exist_ok=True)
+
+            pending_directories.append((directory_node.digest.hash, child_path))
+
+        for symlink_node in directory.symlinks:
+            symlinks.append((symlink_node, os.path.join(directory_path, symlink_node.name)))
+
+    return file_requests, symlinks
@@ -0,0 +1,54 @@
+# Copyright (C) 2019 Bloomberg LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  <http://www.apache.org/licenses/LICENSE-2.0>
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Wraps async generators, a Python 3.6 feature: only import this module for
+# grpc.aio servers.
+
+import functools
+
+import grpc
+
+from buildgrid.server._authentication import is_authorized
+
+
+def authorize_async(auth_context):
+    """Streaming RPC method decorator for authorization validations, for
+    async generator methods served by a :mod:`grpc.aio` server.
+
+    See :func:`buildgrid.server._authentication.authorize`.
+
+    Args:
+        auth_context(AuthContext): Authorization context holder.
+    """
+    def __authorize_decorator(behavior):
+        """RPC authorization async generator decorator."""
+        @functools.wraps(behavior)
+        async def __authorize_async_wrapper(self, request, context):
+            """RPC authorization async generator wrapper."""
+            if is_authorized(auth_context, context, behavior.__name__):
+                responses = behavior(self, request, context)
+                try:
+                    async for response in responses:
+                        yield response
+                finally:
+                    # Have the wrapped generator clean up right away:
+                    await responses.aclose()
+                return
+
+            await context.abort(grpc.StatusCode.UNAUTHENTICATED,
+                                "No valid authorization or authentication provided")
+
+        return __authorize_async_wrapper
+
+    return __authorize_decorator
@@ -94,27 +94,10 @@ def authorize(auth_context):
     """
     def __authorize_decorator(behavior):
         """RPC authorization method decorator."""
-        _HandlerCallDetails = namedtuple(
-            '_HandlerCallDetails', ('invocation_metadata', 'method',))
-
         @functools.wraps(behavior)
         def __authorize_wrapper(self, request, context):
             """RPC authorization method wrapper."""
-            if auth_context.interceptor is None:
-                return behavior(self, request, context)
-
-            authorized = False
-
-            def __continuator(handler_call_details):
-                nonlocal authorized
-                authorized = True
-
-            details = _HandlerCallDetails(context.invocation_metadata(),
-                                          behavior.__name__)
-
-            auth_context.interceptor.intercept_service(__continuator, details)
-
-            if authorized:
+            if is_authorized(auth_context, context, behavior.__name__):
                 return behavior(self, request, context)
 
             context.abort(grpc.StatusCode.UNAUTHENTICATED,
@@ -127,6 +110,37 @@ def authorize(auth_context):
     return __authorize_decorator
 
 
+_HandlerCallDetails = namedtuple(
+    '_HandlerCallDetails', ('invocation_metadata', 'method',))
+
+
+def is_authorized(auth_context, context, method_name):
+    """Runs an authorization context's interceptor against an RPC's metadata.
+
+    Args:
+        auth_context(AuthContext): Authorization context holder.
+        context(grpc.ServicerContext): Context of the RPC to authorize.
+        method_name(str): Name of the RPC method being called.
+
+    Returns:
+        bool: Whether the RPC is authorized.
+    """
+    if auth_context.interceptor is None:
+        return True
+
+    authorized = False
+
+    def __continuator(handler_call_details):
+        nonlocal authorized
+        authorized = True
+
+    details = _HandlerCallDetails(context.invocation_metadata(), method_name)
+
+    auth_context.interceptor.intercept_service(__continuator, details)
+
+    return authorized
+
+
 class AuthMetadataServerInterceptor(grpc.ServerInterceptor):
 
     __auth_errors = {
@@ -14,48 +14,103 @@
 
 
 import functools
+import threading
 
 import grpc
 
+from buildgrid.settings import RESOURCE_EXHAUSTED_RETRY_DELAY
 
-class ExecContext:
 
-    __max_workers = None
-    __busy_workers = None
-
-    @classmethod
-    def init(cls, max_workers):
-        # Max 4/5 workers for blocking requests:
-        cls.__max_workers = 4 * max_workers // 5
-        cls.__busy_workers = 0
+class ConcurrencyLimit:
+    """Caps the number of requests concurrently handled by a class of RPC
+    methods, so that slow requests of one class cannot take up all the
+    server's threads.
+    """
 
-    @classmethod
-    def request_worker(cls):
-        if cls.__max_workers is None:
+    def __init__(self, name):
+        self.__name = name
+
+        self.__lock = threading.Lock()
+        self.__max_workers = None
+        self.__busy_workers = 0
+        self.__rejected_requests = 0
+
+    @property
+    def name(self):
+        return self.__name
+
+    @property
+    def max_workers(self):
+        return self.__max_workers
+
+    @property
+    def busy_workers(self):
+        return self.__busy_workers
+
+    def init(self, max_workers):
+        """Sets the maximum number of requests handled at once, ``None``
+        meaning no limit.
+        """
+        with self.__lock:
+            self.__max_workers = max_workers
+            self.__busy_workers = 0
+            self.__rejected_requests = 0
+
+    def request_worker(self):
+        with self.__lock:
+            if self.__max_workers is None:
+                return True
+            if self.__busy_workers >= self.__max_workers:
+                self.__rejected_requests += 1
+                return False
+            self.__busy_workers += 1
             return True
-        if cls.__busy_workers >= cls.__max_workers:
-            return False
-        cls.__busy_workers += 1
-        return True
 
-    @classmethod
-    def release_worker(cls):
-        if cls.__max_workers is None:
-            return
-        cls.__busy_workers -= 1
+    def release_worker(self):
+        with self.__lock:
+            if self.__max_workers is None:
+                return
+            self.__busy_workers -= 1
+
+    def query_n_rejected_requests(self):
+        """Returns the number of requests rejected since the last query."""
+        with self.__lock:
+            rejected_requests, self.__rejected_requests = self.__rejected_requests, 0
+            return rejected_requests
+
+
+# Blocking execution requests (Execute, WaitExecution):
+ExecContext = ConcurrencyLimit('execution')
+# Bot session long-polls (CreateBotSession, UpdateBotSession):
+BotsContext = ConcurrencyLimit('bots')
+# Streamed blob transfers (ByteStream Read and Write):
+ByteStreamContext = ConcurrencyLimit('bytestream')
+# CAS requests (FindMissingBlobs, Batch*Blobs, GetTree):
+CASContext = ConcurrencyLimit('cas')
+# Action cache requests (GetActionResult, UpdateActionResult):
+ActionCacheContext = ConcurrencyLimit('action-cache')
+
+# Every limit, by name:
+CONCURRENCY_LIMITS = {concurrency_limit.name: concurrency_limit
+                      for concurrency_limit in (ExecContext, BotsContext, ByteStreamContext,
+                                                CASContext, ActionCacheContext)}
 
 
 def limit(exec_context):
     """RPC method decorator for execution resource control.
 
-    This decorator is design to be used together with an :class:`ExecContext`
-    execution context holder::
+    This decorator is design to be used together with a
+    :class:`ConcurrencyLimit` execution context holder::
 
         @limit(ExecContext)
         def Execute(self, request, context):
 
+    Requests over the limit are rejected with a ``RESOURCE_EXHAUSTED``
+    status, carrying a ``grpc-retry-pushback-ms`` trailer hinting clients
+    at when to retry.
+
     Args:
-        exec_context(ExecContext): Execution context holder.
+        exec_context(ConcurrencyLimit): Execution context holder.
     """
     def __limit_decorator(behavior):
         """RPC resource control method decorator."""
@@ -63,11 +118,16 @@ def limit(exec_context):
         def __limit_wrapper(self, request, context):
             """RPC resource control method wrapper."""
             if not exec_context.request_worker():
+                retry_delay_ms = int(RESOURCE_EXHAUSTED_RETRY_DELAY * 1000)
+                context.set_trailing_metadata((('grpc-retry-pushback-ms', str(retry_delay_ms)),))
                 context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED,
-                              "Max. number of simultaneous request reached")
+                              "Max. number of simultaneous {} requests reached, retry in {}ms"
+                              .format(exec_context.name, retry_delay_ms))
                 return None
 
-            context.add_callback(__limit_callback)
+            if context.add_callback(__limit_callback) is False:
+                # The RPC has already terminated:
+                exec_context.release_worker()
 
             return behavior(self, request, context)
 
@@ -0,0 +1,228 @@
+# Copyright (C) 2019 Bloomberg LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  <http://www.apache.org/licenses/LICENSE-2.0>
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Caching Action Cache
+====================
+
+Keeps the results of recent lookups to another action cache in memory.
+
+Hits are remembered for `ttl` seconds and misses for `negative_ttl`
+seconds, so that repeated lookups of the same keys are answered locally
+rather than by a remote or expensive action cache. The number of
+remembered lookups is bounded, the least recently used ones being dropped
+first.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+from buildgrid._exceptions import NotFoundError
+from buildgrid._protos.build.bazel.remote.execution.v2 import remote_execution_pb2
+from ...utils import get_hash_type
+
+
+class CachingActionCache:
+
+    def __init__(self, action_cache, max_cached_refs, ttl=60, negative_ttl=5):
+        """Initialises a new CachingActionCache instance.
+
+        Args:
+            action_cache: action cache to cache the lookups of.
+            max_cached_refs (int): maximum number of lookups to remember.
+            ttl (float): time in seconds a found result is served for
+                without querying `action_cache` again.
+            negative_ttl (float): time in seconds a missing result is
+                reported as such without querying `action_cache` again.
+                ``0`` disables negative caching.
+        """
+        self.__logger = logging.getLogger(__name__)
+
+        self._instance_name = None
+
+        self._action_cache = action_cache
+
+        self._max_cached_refs = max_cached_refs
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+
+        # {(hash, size_bytes): (expiry_time, ActionResult or None)}
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    # --- Public API ---
+
+    @property
+    def instance_name(self):
+        return self._instance_name
+
+    @instance_name.setter
+    def instance_name(self, instance_name):
+        self._instance_name = instance_name
+
+    @property
+    def allow_updates(self):
+        return self._action_cache.allow_updates
+
+    def hash_type(self):
+        return get_hash_type()
+
+    def register_instance_with_server(self, instance_name, server):
+        """Names and registers the action-cache instance with a given server."""
+        if self._instance_name is None:
+            server.add_action_cache_instance(self, instance_name)
+
+            self._instance_name = instance_name
+
+        else:
+            raise AssertionError("Instance already registered")
+
+    def get_action_result(self, action_digest):
+        """Retrieves the cached ActionResult for the given Action digest.
+
+        Args:
+            action_digest: The digest to get the result for
+
+        Returns:
+            The cached ActionResult matching the given key or raises
+            NotFoundError.
+        """
+        key = self._get_key(action_digest)
+
+        found, action_result = self._get_entry(key)
+        if found:
+            if action_result is None:
+                raise NotFoundError("Key not found: {}/{}".format(*key))
+            return action_result
+
+        try:
+            action_result = self._action_cache.get_action_result(action_digest)
+
+        except NotFoundError:
+            self._put_entry(key, None)
+            raise
+
+        self._put_entry(key, action_result)
+        return action_result
+
+    def get_action_results(self, action_digests):
+        """Retrieves the cached ActionResults for several Action digests.
+
+        Lookups not remembered locally are forwarded in a single batch if
+        the underlying action cache supports it.
+
+        Args:
+            action_digests (list): The digests to get the results for.
+
+        Returns:
+            dict: The cached ActionResults, keyed by action digest hash.
+            Digests without a cached result are omitted.
+        """
+        action_results, remaining_digests = {}, []
+        for action_digest in action_digests:
+            found, action_result = self._get_entry(self._get_key(action_digest))
+            if not found:
+                remaining_digests.append(action_digest)
+            elif action_result is not None:
+                action_results[action_digest.hash] = action_result
+
+        if not remaining_digests:
+            return action_results
+
+        if hasattr(self._action_cache, 'get_action_results'):
+            fetched_results = self._action_cache.get_action_results(remaining_digests)
+        else:
+            fetched_results = {}
+            for action_digest in remaining_digests:
+                try:
+                    fetched_results[action_digest.hash] = self._action_cache.get_action_result(action_digest)
+                except NotFoundError:
+                    pass
+
+        for action_digest in remaining_digests:
+            action_result = fetched_results.get(action_digest.hash)
+            self._put_entry(self._get_key(action_digest), action_result)
+            if action_result is not None:
+                action_results[action_digest.hash] = action_result
+
+        return action_results
+
+    def update_action_result(self, action_digest, action_result):
+        """Stores the result in the underlying cache for the given key.
+
+        Args:
+            action_digest (Digest): digest of Action to update
+            action_result (ActionResult): ActionResult to store.
+        """
+        self._action_cache.update_action_result(action_digest, action_result)
+
+        # The underlying cache may not keep the result (failed actions...),
+        # simply forget any previous lookup:
+        with self._lock:
+            self._entries.pop(self._get_key(action_digest), None)
+
+    def stop(self):
+        """Stops the underlying action cache's background workers, if any."""
+        if hasattr(self._action_cache, 'stop'):
+            self._action_cache.stop()
+
+    # --- Private API ---
+
+    def _get_key(self, action_digest):
+        return (action_digest.hash, action_digest.size_bytes)
+
+    def _get_entry(self, key):
+        """Returns a `(found, ActionResult)` pair for a remembered lookup,
+        the result being ``None`` for remembered misses.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+
+            expiry_time, action_result = entry
+            if time.monotonic() >= expiry_time:
+                del self._entries[key]
+                return False, None
+
+            self._entries.move_to_end(key)
+
+        if action_result is None:
+            return True, None
+
+        # Callers may modify the message they get:
+        result_copy = remote_execution_pb2.ActionResult()
+        result_copy.CopyFrom(action_result)
+        return True, result_copy
+
+    def _put_entry(self, key, action_result):
+        """Remembers the outcome of a lookup, ``None`` meaning a miss."""
+        ttl = self._ttl if action_result is not None else self._negative_ttl
+        if ttl <= 0 or self._max_cached_refs <= 0:
+            return
+
+        if action_result is not None:
+            result_copy = remote_execution_pb2.ActionResult()
+            result_copy.CopyFrom(action_result)
+            action_result = result_copy
+
+        with self._lock:
+            self._entries.pop(key, None)
+            while len(self._entries) >= self._max_cached_refs:
+                self._entries.popitem(last=False)
+
+            self._entries[key] = (time.monotonic() + ttl, action_result)
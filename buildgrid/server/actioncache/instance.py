@@ -21,6 +21,7 @@ Implements an in-memory action Cache
 """
 
 import logging
+from urllib.parse import quote, unquote
 
 from ..referencestorage.storage import ReferenceCache
 from ...utils import get_hash_type
@@ -28,7 +29,9 @@ from ...utils import get_hash_type
 
 class ActionCache(ReferenceCache):
 
-    def __init__(self, storage, max_cached_refs, allow_updates=True, cache_failed_actions=True):
+    def __init__(self, storage, max_cached_refs, allow_updates=True, cache_failed_actions=True,
+                 tree_cache=None, freshness_window=0, snapshot_path=None, snapshot_period=300,
+                 snapshot_journal=True):
         """ Initialises a new ActionCache instance.
 
         Args:
@@ -36,8 +39,14 @@ class ActionCache(ReferenceCache):
             max_cached_refs (int): maximum number of entries to be stored. Passed to ReferenceCache
             allow_updates (bool): allow the client to write to storage. Passed to ReferenceCache
             cache_failed_actions (bool): cache actions with non-zero exit codes.
+            tree_cache (TreeCache): cache of the blobs referenced by output trees. Passed to ReferenceCache
+            freshness_window (float): seconds during which a validated result is trusted. Passed to ReferenceCache
+            snapshot_path (str): file entries are persisted to. Passed to ReferenceCache
+            snapshot_period (float): seconds between two snapshots. Passed to ReferenceCache
+            snapshot_journal (bool): record updates between snapshots. Passed to ReferenceCache
         """
-        super().__init__(storage, max_cached_refs, allow_updates)
+        super().__init__(storage, max_cached_refs, allow_updates, tree_cache, freshness_window,
+                         snapshot_path, snapshot_period, snapshot_journal)
 
         self.__logger = logging.getLogger(__name__)
 
@@ -88,3 +97,11 @@ class ActionCache(ReferenceCache):
 
     def _get_key(self, action_digest):
         return (action_digest.hash, action_digest.size_bytes)
+
+    def _encode_key(self, key):
+        # Hashes come from clients and may contain any separator:
+        return '{}/{}'.format(quote(key[0], safe=''), key[1])
+
+    def _decode_key(self, key):
+        digest_hash, _, digest_size = key.rpartition('/')
+        return (unquote(digest_hash), int(digest_size))
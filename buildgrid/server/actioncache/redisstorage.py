@@ -0,0 +1,221 @@
+# Copyright (C) 2019 Bloomberg LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  <http://www.apache.org/licenses/LICENSE-2.0>
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Redis Action Cache
+==================
+
+Implements an Action Cache using redis to store cache entries.
+https://redis.io/
+
+ActionResults up to `max_inline_size` bytes are stored inline, so that a
+lookup only takes one round-trip to redis. Larger ones are stored in CAS
+and only their digest is kept in redis. Values are prefixed with a one byte
+marker telling the two apart.
+"""
+
+import logging
+
+import redis
+
+from buildgrid._exceptions import NotFoundError
+from buildgrid._protos.build.bazel.remote.execution.v2 import remote_execution_pb2
+from buildgrid.server.cas.storage.redis import redis_client_exception_wrapper
+from buildgrid.server.cas.tree_cache import TreeCache
+from ...utils import get_hash_type
+from .validation import action_results_blobs_still_exist
+
+
+# Keeps action cache entries apart from CAS blobs sharing the same database,
+# as the action digest is usually also the digest of a blob:
+_KEY_PREFIX = 'action-cache:'
+
+_INLINE_RESULT_MARKER = b'R'
+_RESULT_DIGEST_MARKER = b'D'
+
+
+class RedisActionCache:
+
+    @redis_client_exception_wrapper
+    def __init__(self, storage, allow_updates=True, cache_failed_actions=True, ttl=None,
+                 max_inline_size=64 * 1024, tree_cache=None, **kwargs):
+        """ Initialises a new ActionCache instance using redis to persist the action cache.
+
+        Args:
+            storage (StorageABC): storage backend instance to be used to store
+                large ActionResults and check for output blobs.
+            allow_updates (bool): allow the client to write to storage
+            cache_failed_actions (bool): whether to store failed actions in the Action Cache
+            ttl (int): time in seconds entries expire after when not accessed.
+                Entries never expire if ``None``.
+            max_inline_size (int): size in bytes of the largest ActionResult
+                stored inline. Larger ones are stored in `storage`.
+            tree_cache (TreeCache): cache of the blobs referenced by output
+                trees, possibly shared with other services. Output trees are
+                fetched on every lookup if ``None``.
+            **kwargs: redis client options (``host``, ``port``, ``password``,
+                ``db``...).
+        """
+        self.__logger = logging.getLogger(__name__)
+
+        self._instance_name = None
+
+        self.__storage = storage
+
+        self._allow_updates = allow_updates
+        self._cache_failed_actions = cache_failed_actions
+        self._ttl = ttl
+        self._max_inline_size = max_inline_size
+        self._tree_cache = tree_cache if tree_cache is not None else TreeCache(0)
+
+        self._client = redis.Redis(**kwargs)
+
+    # --- Public API ---
+
+    @property
+    def instance_name(self):
+        return self._instance_name
+
+    @instance_name.setter
+    def instance_name(self, instance_name):
+        self._instance_name = instance_name
+
+    @property
+    def allow_updates(self):
+        return self._allow_updates
+
+    def hash_type(self):
+        return get_hash_type()
+
+    def register_instance_with_server(self, instance_name, server):
+        """Names and registers the action-cache instance with a given server."""
+        if self._instance_name is None:
+            server.add_action_cache_instance(self, instance_name)
+
+            self._instance_name = instance_name
+
+        else:
+            raise AssertionError("Instance already registered")
+
+    def get_action_result(self, action_digest):
+        """Retrieves the cached ActionResult for the given Action digest.
+
+        Args:
+            action_digest: The digest to get the result for
+
+        Returns:
+            The cached ActionResult matching the given key or raises
+            NotFoundError.
+        """
+        action_results = self.get_action_results([action_digest])
+        if action_digest.hash in action_results:
+            return action_results[action_digest.hash]
+
+        raise NotFoundError("Key not found: {}/{}".format(action_digest.hash,
+                                                          action_digest.size_bytes))
+
+    @redis_client_exception_wrapper
+    def get_action_results(self, action_digests):
+        """Retrieves the cached ActionResults for several Action digests.
+
+        All entries are fetched in a single pipelined round-trip. Entries
+        whose outputs are no longer all in CAS are not returned, and are
+        removed from the cache if updates are allowed.
+
+        Args:
+            action_digests (list): The digests to get the results for.
+
+        Returns:
+            dict: The cached ActionResults, keyed by action digest hash.
+            Digests without a valid cached result are omitted.
+        """
+        digests_by_key = {self._get_key(digest): digest for digest in action_digests}
+        keys = list(digests_by_key)
+
+        pipeline = self._client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.get(key)
+            if self._ttl is not None:
+                # Expiry is counted from the last access:
+                pipeline.expire(key, self._ttl)
+        replies = pipeline.execute()
+
+        values = replies[::2] if self._ttl is not None else replies
+
+        found_keys = []
+        action_results = {}
+        for key, value in zip(keys, values):
+            if value is None:
+                continue
+            found_keys.append(key)
+            action_result = self._parse_value(value)
+            if action_result is not None:
+                action_results[key] = action_result
+
+        valid_keys = action_results_blobs_still_exist(self.__storage, self._tree_cache,
+                                                      action_results)
+
+        invalid_keys = [key for key in found_keys if key not in valid_keys]
+        if invalid_keys and self._allow_updates:
+            self.__logger.debug("Removing [%s] entries from cache due to missing "
+                                "blobs in CAS", len(invalid_keys))
+            self._client.delete(*invalid_keys)
+
+        return {digests_by_key[key].hash: action_results[key] for key in valid_keys}
+
+    @redis_client_exception_wrapper
+    def update_action_result(self, action_digest, action_result):
+        """Stores the result in cache for the given key.
+
+        Args:
+            action_digest (Digest): digest of Action to update
+            action_result (ActionResult): ActionResult to store.
+        """
+        if not self._allow_updates:
+            raise NotImplementedError("Updating cache not allowed")
+
+        if self._cache_failed_actions or action_result.exit_code == 0:
+            result = action_result.SerializeToString()
+            if len(result) <= self._max_inline_size:
+                value = _INLINE_RESULT_MARKER + result
+            else:
+                result_digest = self.__storage.put_message(action_result)
+                value = _RESULT_DIGEST_MARKER + result_digest.SerializeToString()
+
+            self._client.set(self._get_key(action_digest), value, ex=self._ttl)
+
+            self.__logger.info("Result cached for action [%s/%s]",
+                               action_digest.hash, action_digest.size_bytes)
+
+    # --- Private API ---
+
+    def _get_key(self, action_digest):
+        return '{}{}_{}'.format(_KEY_PREFIX, action_digest.hash, action_digest.size_bytes)
+
+    def _parse_value(self, value):
+        """Returns the ActionResult stored in an entry, or ``None`` if it
+        references a result that is not in CAS anymore.
+        """
+        marker, data = value[:1], value[1:]
+
+        if marker == _INLINE_RESULT_MARKER:
+            return remote_execution_pb2.ActionResult.FromString(data)
+
+        elif marker == _RESULT_DIGEST_MARKER:
+            result_digest = remote_execution_pb2.Digest.FromString(data)
+            return self.__storage.get_message(result_digest, remote_execution_pb2.ActionResult)
+
+        self.__logger.warning("Ignoring action cache entry with unknown marker [%s]", marker)
+        return None
@@ -19,6 +19,11 @@ S3 Action Cache
 
 Implements an Action Cache using S3 to store cache entries.
 
+Entries normally hold the digest of an ActionResult stored in CAS. Small
+ActionResults can instead be stored in the entry itself, saving a CAS fetch
+per lookup: such entries start with a version header, which a serialized
+digest can never start with, so both formats can be read.
+
 """
 
 import collections
@@ -29,13 +34,20 @@ import io
 from botocore.exceptions import ClientError
 from buildgrid._exceptions import NotFoundError
 from buildgrid._protos.build.bazel.remote.execution.v2 import remote_execution_pb2
+from buildgrid.server.cas.tree_cache import TreeCache
 from ...utils import get_hash_type
+from .validation import get_action_result_blobs
+
+
+# Serialized protobuf messages never start with a null byte (field number 0
+# is reserved), so this can't be mistaken for a digest-only entry:
+_INLINE_RESULT_HEADER = b'\x00\x01'
 
 
 class S3ActionCache:
 
     def __init__(self, storage, allow_updates=True, cache_failed_actions=True, bucket=None,
-                 endpoint=None, access_key=None, secret_key=None):
+                 endpoint=None, access_key=None, secret_key=None, tree_cache=None, max_inline_size=0):
         """ Initialises a new ActionCache instance using S3 to persist the action cache.
 
         Args:
@@ -47,6 +59,13 @@ class S3ActionCache:
             endpoint (str): URL of endpoint.
             access-key (str): S3-ACCESS-KEY
             secret-key (str): S3-SECRET-KEY
+            tree_cache (TreeCache): cache of the blobs referenced by output
+                trees, possibly shared with other services. Output trees are
+                fetched on every lookup if ``None``.
+            max_inline_size (int): size in bytes of the largest ActionResult
+                stored in the cache entry itself rather than in CAS.
+                Defaults to ``0``, storing every result in CAS, which
+                older servers sharing the bucket can read.
         """
         self.__logger = logging.getLogger(__name__)
 
@@ -57,6 +76,8 @@ class S3ActionCache:
         self._allow_updates = allow_updates
         self._cache_failed_actions = cache_failed_actions
         self._bucket = bucket
+        self._tree_cache = tree_cache if tree_cache is not None else TreeCache(0)
+        self._max_inline_size = max_inline_size
 
         self._s3cache = boto3.resource('s3', endpoint_url=endpoint, aws_access_key_id=access_key,
                                        aws_secret_access_key=secret_key)
@@ -98,14 +119,10 @@ class S3ActionCache:
             The cached ActionResult matching the given key or raises
             NotFoundError.
         """
-        storage_digest = self._get_digest_from_cache(action_digest)
-        if storage_digest:
-            action_result = self.__storage.get_message(storage_digest,
-                                                       remote_execution_pb2.ActionResult)
-
-            if action_result is not None:
-                if self._action_result_blobs_still_exist(action_result):
-                    return action_result
+        action_result = self._get_result_from_cache(action_digest)
+        if action_result is not None:
+            if self._action_result_blobs_still_exist(action_result):
+                return action_result
 
         if self._allow_updates:
             self.__logger.debug("Removing {}/{} from cache due to missing "
@@ -123,32 +140,45 @@ class S3ActionCache:
             action_result (Digest): digest of ActionResult to store.
         """
         if self._cache_failed_actions or action_result.exit_code == 0:
-            result_digest = self.__storage.put_message(action_result)
-            self._update_cache_key(action_digest, result_digest.SerializeToString())
+            result = action_result.SerializeToString()
+            # Empty results must not get inlined when inlining is disabled:
+            if self._max_inline_size > 0 and len(result) <= self._max_inline_size:
+                value = _INLINE_RESULT_HEADER + result
+            else:
+                result_digest = self.__storage.put_message(action_result)
+                value = result_digest.SerializeToString()
+
+            self._update_cache_key(action_digest, value)
 
             self.__logger.info("Result cached for action [%s/%s]",
                                action_digest.hash, action_digest.size_bytes)
 
     # --- Private API ---
-    def _get_digest_from_cache(self, digest):
-        """Get a digest from the reference cache
+    def _get_result_from_cache(self, digest):
+        """Get an ActionResult from the action cache
 
         Args:
-            digest: Action digest to get the associated ActionResult digest for
+            digest: Action digest to get the associated ActionResult for
 
         Returns:
-            The ActionDigest associated with the cached result, or None if the
-            digest doesn't exist
+            The cached ActionResult, or None if the digest doesn't exist or
+            if its result isn't in CAS anymore
         """
         try:
             obj = self._s3cache.Object(self._bucket,
                                        digest.hash + '_' + str(digest.size_bytes))
-            return remote_execution_pb2.Digest.FromString(obj.get()['Body'].read())
+            value = obj.get()['Body'].read()
         except ClientError as e:
             if e.response['Error']['Code'] not in ['404', 'NoSuchKey']:
                 raise
             return None
 
+        if value.startswith(_INLINE_RESULT_HEADER):
+            return remote_execution_pb2.ActionResult.FromString(value[len(_INLINE_RESULT_HEADER):])
+
+        storage_digest = remote_execution_pb2.Digest.FromString(value)
+        return self.__storage.get_message(storage_digest, remote_execution_pb2.ActionResult)
+
     def _update_cache_key(self, digest, value):
         if not self._allow_updates:
             raise NotImplementedError("Updating cache not allowed")
@@ -183,30 +213,9 @@ class S3ActionCache:
         Returns:
             True if all referenced blobs are present in CAS, False otherwise.
         """
-        blobs_needed = []
-
-        for output_file in action_result.output_files:
-            blobs_needed.append(output_file.digest)
-
-        for output_directory in action_result.output_directories:
-            blobs_needed.append(output_directory.tree_digest)
-            tree = self.__storage.get_message(output_directory.tree_digest,
-                                              remote_execution_pb2.Tree)
-            if tree is None:
-                return False
-
-            for file_node in tree.root.files:
-                blobs_needed.append(file_node.digest)
-
-            for child in tree.children:
-                for file_node in child.files:
-                    blobs_needed.append(file_node.digest)
-
-        if action_result.stdout_digest.hash and not action_result.stdout_raw:
-            blobs_needed.append(action_result.stdout_digest)
-
-        if action_result.stderr_digest.hash and not action_result.stderr_raw:
-            blobs_needed.append(action_result.stderr_digest)
+        blobs_needed = get_action_result_blobs(self.__storage, self._tree_cache, action_result)
+        if blobs_needed is None:
+            return False
 
         missing = self.__storage.missing_blobs(blobs_needed)
         if len(missing) != 0:
@@ -28,6 +28,7 @@ from buildgrid._exceptions import InvalidArgumentError, NotFoundError
 from buildgrid._protos.build.bazel.remote.execution.v2 import remote_execution_pb2
 from buildgrid._protos.build.bazel.remote.execution.v2 import remote_execution_pb2_grpc
 from buildgrid.server._authentication import AuthContext, authorize
+from buildgrid.server._resources import ActionCacheContext, limit
 
 
 class ActionCacheService(remote_execution_pb2_grpc.ActionCacheServicer):
@@ -47,6 +48,7 @@ class ActionCacheService(remote_execution_pb2_grpc.ActionCacheServicer):
     # --- Public API: Servicer ---
 
     @authorize(AuthContext)
+    @limit(ActionCacheContext)
     def GetActionResult(self, request, context):
         self.__logger.debug("GetActionResult request from [%s]", context.peer())
 
@@ -66,6 +68,7 @@ class ActionCacheService(remote_execution_pb2_grpc.ActionCacheServicer):
         return remote_execution_pb2.ActionResult()
 
     @authorize(AuthContext)
+    @limit(ActionCacheContext)
     def UpdateActionResult(self, request, context):
         self.__logger.debug("UpdateActionResult request from [%s]", context.peer())
 
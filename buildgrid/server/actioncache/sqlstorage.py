@@ -0,0 +1,296 @@
+# Copyright (C) 2019 Bloomberg LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  <http://www.apache.org/licenses/LICENSE-2.0>
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+SQL Action Cache
+==================
+
+Implements an Action Cache using a SQL database to store cache entries.
+
+ActionResults are stored inline, keyed by action digest, so that a lookup
+takes a single indexed query and the cache can be shared by several
+servers. Each entry records when it was last accessed: access times are
+refreshed in batches, and the cache size is checked every
+`eviction_interval` updates, the least recently used entries being evicted
+if it holds more than `max_cached_refs` entries.
+"""
+
+from contextlib import contextmanager
+from datetime import datetime
+import logging
+import threading
+import time
+
+from sqlalchemy import func
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.orm.session import sessionmaker
+
+from buildgrid._exceptions import NotFoundError
+from buildgrid._protos.build.bazel.remote.execution.v2 import remote_execution_pb2
+from buildgrid.server.cas.tree_cache import TreeCache
+from buildgrid.server.persistence.sql.models import ActionCacheEntry, digest_to_string
+from buildgrid.server.persistence.sql.utils import create_sqlalchemy_engine, get_default_inlimit
+from ...utils import get_hash_type
+from .validation import action_results_blobs_still_exist
+
+
+class SQLActionCache:
+
+    def __init__(self, storage, max_cached_refs, connection_string, allow_updates=True,
+                 cache_failed_actions=True, automigrate=False, tree_cache=None,
+                 access_batch_size=100, access_flush_period=10, eviction_interval=100,
+                 inclause_limit=-1, **kwargs):
+        """ Initialises a new ActionCache instance using a SQL database to persist the action cache.
+
+        Args:
+            storage (StorageABC): storage backend instance used to check for output blobs.
+            max_cached_refs (int): maximum number of entries to be stored.
+            connection_string (str): SQLAlchemy connection string.
+            allow_updates (bool): allow the client to write to storage
+            cache_failed_actions (bool): whether to store failed actions in the Action Cache
+            automigrate (bool): attempt to upgrade the database schema to the newest version.
+            tree_cache (TreeCache): cache of the blobs referenced by output
+                trees, possibly shared with other services. Output trees are
+                fetched on every lookup if ``None``.
+            access_batch_size (int): number of accessed entries to buffer
+                before refreshing their access time in the database.
+            access_flush_period (float): maximum time in seconds an access
+                time refresh is buffered for.
+            eviction_interval (int): number of updates between two checks for
+                entries to evict, the cache holding up to that many extra
+                entries in between.
+            inclause_limit (int): if positive, overrides the default number of
+                keys per IN clause for the current SQL dialect.
+            **kwargs: additional SQLAlchemy engine options (``pool_size``,
+                ``max_overflow``, ``pool_timeout``, ``connect_args``).
+        """
+        self.__logger = logging.getLogger(__name__)
+
+        self._instance_name = None
+
+        self.__storage = storage
+
+        self._max_cached_refs = max_cached_refs
+        self._allow_updates = allow_updates
+        self._cache_failed_actions = cache_failed_actions
+        self._tree_cache = tree_cache if tree_cache is not None else TreeCache(0)
+
+        self._engine = create_sqlalchemy_engine(connection_string, automigrate, **kwargs)
+
+        if inclause_limit > 0:
+            self._inclause_limit = inclause_limit
+        else:
+            self._inclause_limit = get_default_inlimit(self._engine)
+
+        session_factory = sessionmaker()
+        self.Session = scoped_session(session_factory)
+        self.Session.configure(bind=self._engine)
+
+        self._access_batch_size = access_batch_size
+        self._access_flush_period = access_flush_period
+        self._pending_accesses = set()
+        self._last_access_flush = time.monotonic()
+        self._access_lock = threading.Lock()
+
+        self._eviction_interval = max(1, eviction_interval)
+        self._updates_since_eviction = 0
+        self._eviction_lock = threading.Lock()
+
+    # --- Public API ---
+
+    @property
+    def instance_name(self):
+        return self._instance_name
+
+    @instance_name.setter
+    def instance_name(self, instance_name):
+        self._instance_name = instance_name
+
+    @property
+    def allow_updates(self):
+        return self._allow_updates
+
+    def hash_type(self):
+        return get_hash_type()
+
+    def register_instance_with_server(self, instance_name, server):
+        """Names and registers the action-cache instance with a given server."""
+        if self._instance_name is None:
+            server.add_action_cache_instance(self, instance_name)
+
+            self._instance_name = instance_name
+
+        else:
+            raise AssertionError("Instance already registered")
+
+    @contextmanager
+    def session(self, reraise=False):
+        """Context manager for database sessions. Commits when the context
+        ends and rolls back failed transactions, reraising errors if asked.
+        """
+        session = self.Session()
+        try:
+            yield session
+            session.commit()
+        except:
+            self.__logger.exception(
+                "Error in action cache database session. Rolling back.")
+            session.rollback()
+            if reraise:
+                raise
+        finally:
+            session.close()
+
+    def get_action_result(self, action_digest):
+        """Retrieves the cached ActionResult for the given Action digest.
+
+        Args:
+            action_digest: The digest to get the result for
+
+        Returns:
+            The cached ActionResult matching the given key or raises
+            NotFoundError.
+        """
+        action_results = self.get_action_results([action_digest])
+        if action_digest.hash in action_results:
+            return action_results[action_digest.hash]
+
+        raise NotFoundError("Key not found: {}/{}".format(action_digest.hash,
+                                                          action_digest.size_bytes))
+
+    def get_action_results(self, action_digests):
+        """Retrieves the cached ActionResults for several Action digests.
+
+        Entries whose outputs are no longer all in CAS are not returned, and
+        are removed from the cache if updates are allowed.
+
+        Args:
+            action_digests (list): The digests to get the results for.
+
+        Returns:
+            dict: The cached ActionResults, keyed by action digest hash.
+            Digests without a valid cached result are omitted.
+        """
+        digests_by_key = {digest_to_string(digest): digest for digest in action_digests}
+
+        action_results = {}
+        with self.session(reraise=True) as session:
+            for keys in self._partitioned(list(digests_by_key)):
+                query = session.query(ActionCacheEntry.action_digest,
+                                      ActionCacheEntry.action_result)
+                for key, result in query.filter(ActionCacheEntry.action_digest.in_(keys)):
+                    action_results[key] = remote_execution_pb2.ActionResult.FromString(result)
+
+        valid_keys = action_results_blobs_still_exist(self.__storage, self._tree_cache,
+                                                      action_results)
+
+        invalid_keys = [key for key in action_results if key not in valid_keys]
+        if invalid_keys and self._allow_updates:
+            self.__logger.debug("Removing [%s] entries from cache due to missing "
+                                "blobs in CAS", len(invalid_keys))
+            self._delete_entries(invalid_keys)
+
+        self._record_accesses(valid_keys)
+
+        return {digests_by_key[key].hash: action_results[key] for key in valid_keys}
+
+    def update_action_result(self, action_digest, action_result):
+        """Stores the result in cache for the given key.
+
+        Args:
+            action_digest (Digest): digest of Action to update
+            action_result (ActionResult): ActionResult to store.
+        """
+        if not self._allow_updates:
+            raise NotImplementedError("Updating cache not allowed")
+
+        if self._cache_failed_actions or action_result.exit_code == 0:
+            with self.session(reraise=True) as session:
+                session.merge(ActionCacheEntry(
+                    action_digest=digest_to_string(action_digest),
+                    action_result=action_result.SerializeToString(),
+                    accessed_timestamp=datetime.utcnow()))
+
+            # Counting entries takes a full scan, only do it once in a while:
+            with self._eviction_lock:
+                self._updates_since_eviction += 1
+                eviction_due = self._updates_since_eviction >= self._eviction_interval
+                if eviction_due:
+                    self._updates_since_eviction = 0
+
+            if eviction_due:
+                self._evict_entries()
+
+            self.__logger.info("Result cached for action [%s/%s]",
+                               action_digest.hash, action_digest.size_bytes)
+
+    # --- Private API ---
+
+    def _partitioned(self, keys):
+        """Splits a list of keys in parts no larger than the IN clause limit."""
+        for start in range(0, len(keys), self._inclause_limit):
+            yield keys[start:start + self._inclause_limit]
+
+    def _record_accesses(self, keys):
+        """Buffers access time refreshes, flushing them when due."""
+        with self._access_lock:
+            self._pending_accesses.update(keys)
+
+            flush_due = (len(self._pending_accesses) >= self._access_batch_size or
+                         time.monotonic() - self._last_access_flush >= self._access_flush_period)
+
+        if flush_due:
+            self._flush_accesses()
+
+    def _flush_accesses(self):
+        """Writes every buffered access time refresh to the database."""
+        with self._access_lock:
+            keys, self._pending_accesses = list(self._pending_accesses), set()
+            self._last_access_flush = time.monotonic()
+
+        if not keys:
+            return
+
+        accessed_timestamp = datetime.utcnow()
+        with self.session() as session:
+            for part in self._partitioned(keys):
+                session.query(ActionCacheEntry).filter(
+                    ActionCacheEntry.action_digest.in_(part)
+                ).update({'accessed_timestamp': accessed_timestamp},
+                         synchronize_session=False)
+
+    def _evict_entries(self):
+        """Removes the least recently used entries beyond the size limit."""
+        # Recent accesses must be accounted for before picking entries:
+        self._flush_accesses()
+
+        with self.session() as session:
+            entry_count = session.query(func.count(ActionCacheEntry.action_digest)).scalar()
+            if entry_count <= self._max_cached_refs:
+                return
+
+            query = session.query(ActionCacheEntry.action_digest)
+            query = query.order_by(ActionCacheEntry.accessed_timestamp)
+            evicted_keys = [key for key, in query.limit(entry_count - self._max_cached_refs)]
+
+        self.__logger.debug("Evicting [%s] entries from cache", len(evicted_keys))
+        self._delete_entries(evicted_keys)
+
+    def _delete_entries(self, keys):
+        with self.session() as session:
+            for part in self._partitioned(keys):
+                session.query(ActionCacheEntry).filter(
+                    ActionCacheEntry.action_digest.in_(part)
+                ).delete(synchronize_session=False)
@@ -0,0 +1,87 @@
+# Copyright (C) 2019 Bloomberg LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  <http://www.apache.org/licenses/LICENSE-2.0>
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Action Result Validation
+========================
+
+Helpers checking that the outputs of cached ActionResults are still in CAS.
+"""
+
+
+def action_results_blobs_still_exist(storage, tree_cache, action_results):
+    """Checks CAS for the output blobs of several ActionResults at once.
+
+    Every referenced blob is looked up in a single `missing_blobs` call.
+
+    Args:
+        storage (StorageABC): CAS storage the outputs are expected in.
+        tree_cache (TreeCache): cache of the blobs referenced by output trees.
+        action_results (dict): ActionResults to search referenced output
+            blobs for, keyed by any hashable key.
+
+    Returns:
+        set: The keys of the ActionResults whose referenced blobs are all
+        present in CAS.
+    """
+    blobs_needed = {}
+    for key, action_result in action_results.items():
+        result_blobs = get_action_result_blobs(storage, tree_cache, action_result)
+        if result_blobs is not None:
+            blobs_needed[key] = result_blobs
+
+    if not blobs_needed:
+        return set()
+
+    missing = storage.missing_blobs(
+        [digest for result_blobs in blobs_needed.values() for digest in result_blobs])
+    missing_hashes = set(digest.hash for digest in missing)
+
+    return set(key for key, result_blobs in blobs_needed.items()
+               if not any(digest.hash in missing_hashes for digest in result_blobs))
+
+
+def get_action_result_blobs(storage, tree_cache, action_result):
+    """Lists the blobs an ActionResult references.
+
+    Args:
+        storage (StorageABC): CAS storage output trees are fetched from.
+        tree_cache (TreeCache): cache of the blobs referenced by output trees.
+        action_result (ActionResult): ActionResult to list output blobs for.
+
+    Returns:
+        list: The referenced blob digests, or ``None`` if one of the output
+        trees is not in CAS anymore.
+    """
+    blobs_needed = []
+
+    for output_file in action_result.output_files:
+        blobs_needed.append(output_file.digest)
+
+    for output_directory in action_result.output_directories:
+        blobs_needed.append(output_directory.tree_digest)
+        tree_blobs = tree_cache.get_tree_file_digests(storage, output_directory.tree_digest)
+        if tree_blobs is None:
+            return None
+
+        blobs_needed.extend(tree_blobs)
+
+    if action_result.stdout_digest.hash and not action_result.stdout_raw:
+        blobs_needed.append(action_result.stdout_digest)
+
+    if action_result.stderr_digest.hash and not action_result.stderr_raw:
+        blobs_needed.append(action_result.stderr_digest)
+
+    return blobs_needed
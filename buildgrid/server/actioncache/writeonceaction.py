@@ -94,3 +94,8 @@ class WriteOnceActionCache:
                                         "WriteOnceActionCache doesn't allow updates.")
         except NotFoundError:
             self._action_cache.update_action_result(action_digest, action_result)
+
+    def stop(self):
+        """Stops the underlying action cache's background workers, if any."""
+        if hasattr(self._action_cache, 'stop'):
+            self._action_cache.stop()
@@ -30,6 +30,7 @@ from buildgrid._exceptions import InvalidArgumentError, OutOfSyncError
 from buildgrid._protos.google.devtools.remoteworkers.v1test2 import bots_pb2
 from buildgrid._protos.google.devtools.remoteworkers.v1test2 import bots_pb2_grpc
 from buildgrid.server._authentication import AuthContext, authorize
+from buildgrid.server._resources import BotsContext, limit
 
 
 class BotsService(bots_pb2_grpc.BotsServicer):
@@ -88,6 +89,7 @@ class BotsService(bots_pb2_grpc.BotsServicer):
     # --- Public API: Servicer ---
 
     @authorize(AuthContext)
+    @limit(BotsContext)
     def CreateBotSession(self, request, context):
         """Handles CreateBotSessionRequest messages.
 
@@ -124,6 +126,7 @@ class BotsService(bots_pb2_grpc.BotsServicer):
         return bots_pb2.BotSession()
 
     @authorize(AuthContext)
+    @limit(BotsContext)
     def UpdateBotSession(self, request, context):
         """Handles UpdateBotSessionRequest messages.
 
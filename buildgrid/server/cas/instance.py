@@ -19,7 +19,10 @@ Storage Instances
 Instances of CAS and ByteStream
 """
 
+import collections
 import logging
+import threading
+import time
 
 from buildgrid._exceptions import InvalidArgumentError, NotFoundError, OutOfRangeError
 from buildgrid._protos.google.bytestream import bytestream_pb2
@@ -31,12 +34,13 @@ from buildgrid.utils import get_hash_type
 
 class ContentAddressableStorageInstance:
 
-    def __init__(self, storage):
+    def __init__(self, storage, tree_cache=None):
         self.__logger = logging.getLogger(__name__)
 
         self._instance_name = None
 
         self.__storage = storage
+        self.__tree_cache = tree_cache
 
     # --- Public API ---
 
@@ -117,54 +121,151 @@ class ContentAddressableStorageInstance:
         return response
 
     def get_tree(self, request):
+        """Streams the directories of a tree, in level order.
+
+        Each level of the tree is fetched from storage in batches rather
+        than one directory at a time, and subtrees appearing more than once
+        are only walked and returned once. Every response but the last one
+        carries a `next_page_token`, made of the root digest and the number of
+        directories returned so far, from which the walk can be resumed: the
+        tree is walked again from its root, skipping that many directories.
+
+        If a tree cache is configured, the list of directories of a tree is
+        recorded after a complete walk, so that later requests for the same
+        root fetch every directory in batches without walking level by level.
+
+        Raises:
+            InvalidArgumentError: If `request.page_token` is malformed.
+            NotFoundError: If a directory of the tree is not in storage.
+        """
         storage = self.__storage
 
+        page_size = request.page_size or MAX_REQUEST_COUNT
+
+        tree_cache = self.__tree_cache
+        walked = None
+
+        # Number of directories, in walk order, already returned:
+        skipped = 0
+        if request.page_token:
+            skipped = _decode_page_token(request.page_token, request.root_digest)
+
+        cached_digests = None
+        if tree_cache is not None:
+            cached_digests = tree_cache.get(re_pb2.Directory, request.root_digest)
+
+        if cached_digests is not None:
+            # The cached list is in walk order, no need to walk skipped directories:
+            seen = set((digest.hash, digest.size_bytes) for digest in cached_digests)
+            pending = collections.deque(cached_digests[skipped:])
+            position = skipped
+        else:
+            seen = set([(request.root_digest.hash, request.root_digest.size_bytes)])
+            pending = collections.deque([request.root_digest])
+            position = 0
+            if tree_cache is not None:
+                walked = []
+
+        # Room left for the page token, whatever the position:
+        token_size = _field_size(len(_encode_page_token(request.root_digest, 2 ** 63)))
+        fetched = {}
+
+        def __fetch_next_directories():
+            batch = []
+            for digest in pending:
+                if (digest.hash, digest.size_bytes) not in fetched:
+                    batch.append(digest)
+                if len(batch) >= MAX_REQUEST_COUNT:
+                    break
+
+            blobs = storage.bulk_read_blobs(batch)
+            for digest in batch:
+                blob = blobs.get(digest.hash)
+                if blob is None:
+                    if tree_cache is not None:
+                        tree_cache.discard(re_pb2.Directory, request.root_digest)
+                    raise NotFoundError("Directory not found: [{}/{}]"
+                                        .format(digest.hash, digest.size_bytes))
+                fetched[(digest.hash, digest.size_bytes)] = re_pb2.Directory.FromString(blob.read())
+                blob.close()
+
         response = re_pb2.GetTreeResponse()
-        page_size = request.page_size
+        response_size = 0
+
+        while pending:
+            key = (pending[0].hash, pending[0].size_bytes)
+            if key not in fetched:
+                __fetch_next_directories()
 
-        if not request.page_size:
-            request.page_size = MAX_REQUEST_COUNT
+            directory = fetched[key]
 
-        root_digest = request.root_digest
-        page_size = request.page_size
+            if position >= skipped:
+                directory_size = _field_size(directory.ByteSize())
 
-        def __get_tree(node_digest):
-            nonlocal response, page_size, request
+                if response.directories and (
+                        len(response.directories) >= page_size or
+                        response_size + directory_size + token_size > MAX_REQUEST_SIZE):
+                    response.next_page_token = _encode_page_token(request.root_digest, position)
+                    yield response
 
-            if not page_size:
-                page_size = request.page_size
-                yield response
-                response = re_pb2.GetTreeResponse()
+                    response = re_pb2.GetTreeResponse()
+                    response_size = 0
 
-            if response.ByteSize() >= (MAX_REQUEST_SIZE):
-                yield response
-                response = re_pb2.GetTreeResponse()
+                response.directories.add().CopyFrom(directory)
+                response_size += directory_size
 
-            directory_from_digest = storage.get_message(
-                node_digest, re_pb2.Directory)
-            page_size -= 1
-            response.directories.extend([directory_from_digest])
+            digest = pending.popleft()
+            del fetched[key]
+            position += 1
+            if walked is not None:
+                walked.append(digest)
 
-            for directory in directory_from_digest.directories:
-                yield from __get_tree(directory.digest)
+            for directory_node in directory.directories:
+                child_key = (directory_node.digest.hash, directory_node.digest.size_bytes)
+                if child_key not in seen:
+                    seen.add(child_key)
+                    pending.append(directory_node.digest)
 
-            yield response
-            response = re_pb2.GetTreeResponse()
+        if walked is not None:
+            tree_cache.put(re_pb2.Directory, request.root_digest, walked)
 
-        return __get_tree(root_digest)
+        yield response
 
 
 class ByteStreamInstance:
 
     BLOCK_SIZE = 1 * 1024 * 1024  # 1 MB block size
 
-    def __init__(self, storage):
+    # Time in seconds a resumed write waits for the interrupted one to stop:
+    RESUME_TIMEOUT = 5.0
+
+    def __init__(self, storage, max_write_sessions=16, max_write_sessions_size=2 ** 30,
+                 write_session_timeout=600):
+        """Initializes a new :class:`ByteStreamInstance`.
+
+        Args:
+            storage (StorageABC): storage blobs are read from and written to.
+            max_write_sessions (int): maximum number of writes kept for clients
+                to resume them, the least recently used being dropped first.
+            max_write_sessions_size (int): maximum number of bytes received
+                for the kept writes altogether, the least recently used being
+                dropped first.
+            write_session_timeout (float): time in seconds an interrupted
+                write is kept for, if not resumed.
+        """
         self.__logger = logging.getLogger(__name__)
 
         self._instance_name = None
 
         self.__storage = storage
 
+        self.__max_write_sessions = max_write_sessions
+        self.__max_write_sessions_size = max_write_sessions_size
+        self.__write_session_timeout = write_session_timeout
+        # {(upload UUID, hash, size): _WriteSession}, oldest first:
+        self.__write_sessions = collections.OrderedDict()
+        self.__write_sessions_lock = threading.Lock()
+
     # --- Public API ---
 
     @property
@@ -217,36 +318,202 @@ class ByteStreamInstance:
                 data=result.read(min(self.BLOCK_SIZE, bytes_remaining)))
             bytes_remaining -= self.BLOCK_SIZE
 
-    def write(self, digest_hash, digest_size, first_block, other_blocks):
+    def write(self, digest_hash, digest_size, first_block, other_blocks,
+              write_offset=0, upload_uuid=None):
         if len(digest_hash) != HASH_LENGTH or not digest_size.isdigit():
             raise InvalidArgumentError("Invalid digest [{}/{}]"
                                        .format(digest_hash, digest_size))
 
         digest = re_pb2.Digest(hash=digest_hash, size_bytes=int(digest_size))
+        session_key = (upload_uuid, digest.hash, digest.size_bytes)
 
-        write_session = self.__storage.begin_write(digest)
+        if write_offset == 0:
+            write_session = _WriteSession(self.__storage.begin_write(digest))
+            write_session.lock.acquire()
+            self._add_write_session(session_key, write_session)
 
-        # Start the write session and write the first request's data.
-        write_session.write(first_block)
+        else:
+            write_session = self._resume_write_session(session_key, write_offset)
 
-        computed_hash = HASH(first_block)
-        bytes_written = len(first_block)
+        try:
+            # Start the write session and write the first request's data.
+            write_session.write(first_block)
 
-        # Handle subsequent write requests.
-        for next_block in other_blocks:
-            write_session.write(next_block)
+            # Handle subsequent write requests.
+            for next_block in other_blocks:
+                write_session.write(next_block)
 
-            computed_hash.update(next_block)
-            bytes_written += len(next_block)
+        except Exception:
+            # The client went away, keep what was received for it to resume:
+            self.__logger.info("Write of blob [%s/%s] interrupted at offset [%s]",
+                               digest.hash, digest.size_bytes, write_session.committed_size)
+            self._release_write_session(session_key, write_session)
+            raise
 
         # Check that the data matches the provided digest.
-        if bytes_written != digest.size_bytes:
+        if write_session.committed_size < digest.size_bytes:
+            self._release_write_session(session_key, write_session)
+            raise NotImplementedError(
+                "Cannot close stream before finishing write")
+
+        self._remove_write_session(session_key, write_session)
+
+        if write_session.committed_size != digest.size_bytes:
             raise NotImplementedError(
                 "Cannot close stream before finishing write")
 
-        elif computed_hash.hexdigest() != digest.hash:
+        elif write_session.hash.hexdigest() != digest.hash:
             raise InvalidArgumentError("Data does not match hash")
 
-        self.__storage.commit_write(digest, write_session)
+        self.__storage.commit_write(digest, write_session.stream)
+
+        return bytestream_pb2.WriteResponse(committed_size=write_session.committed_size)
+
+    def query_write_status(self, digest_hash, digest_size, upload_uuid=None):
+        if len(digest_hash) != HASH_LENGTH or not digest_size.isdigit():
+            raise InvalidArgumentError("Invalid digest [{}/{}]"
+                                       .format(digest_hash, digest_size))
+
+        digest = re_pb2.Digest(hash=digest_hash, size_bytes=int(digest_size))
 
-        return bytestream_pb2.WriteResponse(committed_size=bytes_written)
+        if self.__storage.has_blob(digest):
+            return bytestream_pb2.QueryWriteStatusResponse(committed_size=digest.size_bytes,
+                                                           complete=True)
+
+        with self.__write_sessions_lock:
+            write_session = self.__write_sessions.get((upload_uuid, digest.hash, digest.size_bytes))
+
+        if write_session is None:
+            raise NotFoundError("Write session not found")
+
+        return bytestream_pb2.QueryWriteStatusResponse(committed_size=write_session.committed_size,
+                                                       complete=False)
+
+    # --- Private API ---
+
+    def _add_write_session(self, session_key, write_session):
+        """Registers a new, locked, write session, dropping the oldest ones if
+        over the limits.
+        """
+        with self.__write_sessions_lock:
+            dropped_sessions = []
+            if session_key in self.__write_sessions:
+                dropped_sessions.append(self.__write_sessions.pop(session_key))
+
+            self.__write_sessions[session_key] = write_session
+
+            self._drop_write_sessions(dropped_sessions)
+
+    def _drop_write_sessions(self, dropped_sessions=None):
+        """Drops the write sessions left idle for too long, then the oldest
+        ones while over the limits. Must be called with the lock held.
+        """
+        if dropped_sessions is None:
+            dropped_sessions = []
+
+        expiry_time = time.monotonic() - self.__write_session_timeout
+        for session_key, write_session in list(self.__write_sessions.items()):
+            if write_session.released_at is not None and write_session.released_at < expiry_time:
+                dropped_sessions.append(self.__write_sessions.pop(session_key))
+
+        sessions_size = sum(write_session.committed_size
+                            for write_session in self.__write_sessions.values())
+        while (len(self.__write_sessions) > self.__max_write_sessions or
+               sessions_size > self.__max_write_sessions_size):
+            dropped_session = self.__write_sessions.popitem(last=False)[1]
+            sessions_size -= dropped_session.committed_size
+            dropped_sessions.append(dropped_session)
+
+        for dropped_session in dropped_sessions:
+            # Sessions still in use get closed once released:
+            if dropped_session.lock.acquire(blocking=False):
+                dropped_session.stream.close()
+                dropped_session.lock.release()
+
+    def _resume_write_session(self, session_key, write_offset):
+        """Locks and returns an interrupted write session, for a write to carry
+        on from `write_offset`.
+        """
+        with self.__write_sessions_lock:
+            write_session = self.__write_sessions.get(session_key)
+
+        # The interrupted write may not have noticed yet:
+        if write_session is not None and write_session.lock.acquire(timeout=self.RESUME_TIMEOUT):
+            with self.__write_sessions_lock:
+                if (self.__write_sessions.get(session_key) is write_session and
+                        write_session.committed_size == write_offset):
+                    self.__write_sessions.move_to_end(session_key)
+                    write_session.released_at = None
+                    return write_session
+
+                write_session.lock.release()
+
+        raise InvalidArgumentError("Cannot resume write at offset [{}]".format(write_offset))
+
+    def _release_write_session(self, session_key, write_session):
+        """Unlocks a write session, for a later write to resume it."""
+        with self.__write_sessions_lock:
+            write_session.released_at = time.monotonic()
+            self._drop_write_sessions()
+
+            # Sessions dropped while in use are not resumable:
+            if self.__write_sessions.get(session_key) is not write_session:
+                write_session.stream.close()
+
+            write_session.lock.release()
+
+    def _remove_write_session(self, session_key, write_session):
+        """Unregisters a finished write session."""
+        with self.__write_sessions_lock:
+            if self.__write_sessions.get(session_key) is write_session:
+                del self.__write_sessions[session_key]
+
+            write_session.lock.release()
+
+
+class _WriteSession:
+    """Data received for a blob being written, kept until the write is
+    finished so that interrupted writes can be resumed.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.hash = HASH()
+        self.committed_size = 0
+        # Held while a write request is feeding the session:
+        self.lock = threading.Lock()
+        # Time the last write request feeding the session stopped at:
+        self.released_at = None
+
+    def write(self, block):
+        self.stream.write(block)
+        self.hash.update(block)
+        self.committed_size += len(block)
+
+
+def _field_size(message_size):
+    """Returns the encoded size of a length-delimited field of `message_size` bytes."""
+    # One byte for the field's tag, plus the varint-encoded length:
+    field_size = 1 + message_size + 1
+    while message_size >= 0x80:
+        message_size >>= 7
+        field_size += 1
+    return field_size
+
+
+def _encode_page_token(root_digest, position):
+    """Serialises a tree's root digest and a position in its walk into a
+    GetTree page token.
+    """
+    return '{}/{}/{}'.format(root_digest.hash, root_digest.size_bytes, position)
+
+
+def _decode_page_token(page_token, root_digest):
+    """Parses a GetTree page token back into a position in the walk of the
+    tree rooted at `root_digest`.
+    """
+    names = page_token.split('/')
+    if (len(names) != 3 or names[0] != root_digest.hash or
+            names[1] != str(root_digest.size_bytes) or not names[2].isdigit()):
+        raise InvalidArgumentError("Invalid page token: [{}]".format(page_token))
+    return int(names[2])
@@ -30,6 +30,7 @@ from buildgrid._protos.google.bytestream import bytestream_pb2, bytestream_pb2_g
 from buildgrid._protos.build.bazel.remote.execution.v2 import remote_execution_pb2
 from buildgrid._protos.build.bazel.remote.execution.v2 import remote_execution_pb2_grpc
 from buildgrid.server._authentication import AuthContext, authorize
+from buildgrid.server._resources import ByteStreamContext, CASContext, limit
 
 
 class ContentAddressableStorageService(remote_execution_pb2_grpc.ContentAddressableStorageServicer):
@@ -49,6 +50,7 @@ class ContentAddressableStorageService(remote_execution_pb2_grpc.ContentAddressa
     # --- Public API: Servicer ---
 
     @authorize(AuthContext)
+    @limit(CASContext)
     def FindMissingBlobs(self, request, context):
         self.__logger.debug("FindMissingBlobs request from [%s]", context.peer())
 
@@ -66,6 +68,7 @@ class ContentAddressableStorageService(remote_execution_pb2_grpc.ContentAddressa
         return remote_execution_pb2.FindMissingBlobsResponse()
 
     @authorize(AuthContext)
+    @limit(CASContext)
     def BatchUpdateBlobs(self, request, context):
         self.__logger.debug("BatchUpdateBlobs request from [%s]", context.peer())
 
@@ -83,6 +86,7 @@ class ContentAddressableStorageService(remote_execution_pb2_grpc.ContentAddressa
         return remote_execution_pb2.BatchReadBlobsResponse()
 
     @authorize(AuthContext)
+    @limit(CASContext)
     def BatchReadBlobs(self, request, context):
         self.__logger.debug("BatchReadBlobs request from [%s]", context.peer())
 
@@ -99,6 +103,7 @@ class ContentAddressableStorageService(remote_execution_pb2_grpc.ContentAddressa
         return remote_execution_pb2.BatchReadBlobsResponse()
 
     @authorize(AuthContext)
+    @limit(CASContext)
     def GetTree(self, request, context):
         self.__logger.debug("GetTree request from [%s]", context.peer())
 
@@ -113,6 +118,13 @@ class ContentAddressableStorageService(remote_execution_pb2_grpc.ContentAddressa
 
             yield remote_execution_pb2.GetTreeResponse()
 
+        except NotFoundError as e:
+            self.__logger.error(e)
+            context.set_details(str(e))
+            context.set_code(grpc.StatusCode.NOT_FOUND)
+
+            yield remote_execution_pb2.GetTreeResponse()
+
     # --- Private API ---
 
     def _get_instance(self, instance_name):
@@ -140,6 +152,7 @@ class ByteStreamService(bytestream_pb2_grpc.ByteStreamServicer):
     # --- Public API: Servicer ---
 
     @authorize(AuthContext)
+    @limit(ByteStreamContext)
     def Read(self, request, context):
         self.__logger.debug("Read request from [%s]", context.peer())
 
@@ -187,34 +200,21 @@ class ByteStreamService(bytestream_pb2_grpc.ByteStreamServicer):
             yield bytestream_pb2.ReadResponse()
 
     @authorize(AuthContext)
+    @limit(ByteStreamContext)
     def Write(self, requests, context):
         self.__logger.debug("Write request from [%s]", context.peer())
 
         request = next(requests)
-        names = request.resource_name.split('/')
 
         try:
-            instance_name = ''
-            # Format: "{instance_name}/uploads/{uuid}/blobs/{hash}/{size}/{anything}":
-            if len(names) < 5 or 'uploads' not in names or 'blobs' not in names:
-                raise InvalidArgumentError("Invalid resource name: [{}]"
-                                           .format(request.resource_name))
-
-            elif names[0] != 'uploads':
-                index = names.index('uploads')
-                instance_name = '/'.join(names[:index])
-                names = names[index:]
-
-            if len(names) < 5:
-                raise InvalidArgumentError("Invalid resource name: [{}]"
-                                           .format(request.resource_name))
-
-            _, hash_, size_bytes = names[1], names[3], names[4]
+            instance_name, upload_uuid, hash_, size_bytes = self._parse_write_resource_name(
+                request.resource_name)
 
             instance = self._get_instance(instance_name)
 
             return instance.write(hash_, size_bytes, request.data,
-                                  [request.data for request in requests])
+                                  (request.data for request in requests),
+                                  write_offset=request.write_offset, upload_uuid=upload_uuid)
 
         except NotImplementedError as e:
             self.__logger.error(e)
@@ -235,13 +235,53 @@ class ByteStreamService(bytestream_pb2_grpc.ByteStreamServicer):
 
     @authorize(AuthContext)
     def QueryWriteStatus(self, request, context):
-        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
-        context.set_details('Method not implemented!')
+        self.__logger.debug("QueryWriteStatus request from [%s]", context.peer())
+
+        try:
+            instance_name, upload_uuid, hash_, size_bytes = self._parse_write_resource_name(
+                request.resource_name)
+
+            instance = self._get_instance(instance_name)
+
+            return instance.query_write_status(hash_, size_bytes, upload_uuid=upload_uuid)
+
+        except InvalidArgumentError as e:
+            self.__logger.error(e)
+            context.set_details(str(e))
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+
+        except NotFoundError as e:
+            self.__logger.debug(e)
+            context.set_details(str(e))
+            context.set_code(grpc.StatusCode.NOT_FOUND)
 
         return bytestream_pb2.QueryWriteStatusResponse()
 
     # --- Private API ---
 
+    def _parse_write_resource_name(self, resource_name):
+        """Returns the instance name, upload UUID, hash and size of a write
+        resource name.
+        """
+        names = resource_name.split('/')
+
+        instance_name = ''
+        # Format: "{instance_name}/uploads/{uuid}/blobs/{hash}/{size}/{anything}":
+        if len(names) < 5 or 'uploads' not in names or 'blobs' not in names:
+            raise InvalidArgumentError("Invalid resource name: [{}]"
+                                       .format(resource_name))
+
+        elif names[0] != 'uploads':
+            index = names.index('uploads')
+            instance_name = '/'.join(names[:index])
+            names = names[index:]
+
+        if len(names) < 5:
+            raise InvalidArgumentError("Invalid resource name: [{}]"
+                                       .format(resource_name))
+
+        return instance_name, names[1], names[3], names[4]
+
     def _get_instance(self, instance_name):
         try:
             return self._instances[instance_name]
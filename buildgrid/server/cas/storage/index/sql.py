@@ -25,16 +25,13 @@ or a local SQLite database.
 from contextlib import contextmanager
 from datetime import datetime
 import logging
-import os
 import time
 import io
 import itertools
 
 from typing import Any, BinaryIO, ContextManager, Dict, Iterable, List, Optional, Sequence, Union
 
-from alembic import command
-from alembic.config import Config
-from sqlalchemy import and_, create_engine, event, func, text, Column
+from sqlalchemy import and_, func, text, Column
 from sqlalchemy.sql import select
 from sqlalchemy.sql.elements import BinaryExpression as SQLExpression
 from sqlalchemy.exc import IntegrityError, OperationalError
@@ -49,42 +46,12 @@ from .index_abc import IndexABC
 from buildgrid._protos.build.bazel.remote.execution.v2.remote_execution_pb2 import Digest
 from buildgrid._protos.google.rpc import code_pb2
 from buildgrid._protos.google.rpc.status_pb2 import Status
-import buildgrid.server.persistence.sql as sql_module
-from buildgrid.server.persistence.sql.impl import sqlite_on_connect
 from buildgrid.server.persistence.sql.models import IndexEntry
-
-
-# Each dialect has a limit on the number of bind parameters allowed. This
-# matters because it determines how large we can allow our IN clauses to get.
-#
-# SQLite: 1000 https://www.sqlite.org/limits.html#max_variable_number
-# PostgreSQL: 32767 (Int16.MAX_VALUE) https://www.postgresql.org/docs/9.4/protocol-message-formats.html
-#
-# We'll refer to this as the "inlimit" in the code. The inlimits are
-# set to 75% of the bind parameter limit of the implementation.
-DIALECT_INLIMIT_MAP = {
-    "sqlite": 750,
-    "postgresql": 24000
-}
-DEFAULT_INLIMIT = 100
+from buildgrid.server.persistence.sql.utils import create_sqlalchemy_engine, get_default_inlimit
 
 
 class SQLIndex(IndexABC):
 
-    def _get_default_inlimit_for_current_dialect(self) -> int:
-        """ Map a connection string to its inlimit. """
-        dialect = self._engine.dialect.name
-        if dialect not in DIALECT_INLIMIT_MAP:
-            self.__logger.warning("The SQL dialect [%s] is unsupported, and "
-                                  "errors may occur. Supported dialects are %s. "
-                                  "Using default inclause limit of %s.",
-                                  dialect,
-                                  list(DIALECT_INLIMIT_MAP.keys()),
-                                  DEFAULT_INLIMIT)
-            return DEFAULT_INLIMIT
-
-        return DIALECT_INLIMIT_MAP[dialect]
-
     def __init__(self, storage: StorageABC, connection_string: str,
                  automigrate: bool=False, window_size: int=1000,
                  inclause_limit: int=-1, **kwargs):
@@ -125,7 +92,7 @@ class SQLIndex(IndexABC):
             # inlimit.
             self._inclause_limit = min(
                 window_size,
-                self._get_default_inlimit_for_current_dialect())
+                get_default_inlimit(self._engine))
             self.__logger.debug("SQL index: using default inclause limit "
                                 "of %s", self._inclause_limit)
 
@@ -133,85 +100,9 @@ class SQLIndex(IndexABC):
         self.Session = scoped_session(session_factory)
         self.Session.configure(bind=self._engine)
 
-    def _create_or_migrate_db(self, connection_string: str) -> None:
-        self.__logger.warn(
-            "Will attempt migration to latest version if needed.")
-
-        config = Config()
-
-        config.set_main_option("script_location",
-                               os.path.join(
-                                   os.path.dirname(__file__),
-                                   "../../../persistence/sql/alembic"))
-
-        with self._engine.begin() as connection:
-            config.attributes['connection'] = connection
-            command.upgrade(config, "head")
-
     def _create_sqlalchemy_engine(self, connection_string, automigrate, **kwargs):
         self.automigrate = automigrate
-
-        # Disallow sqlite in-memory because multi-threaded access to it is
-        # complex and potentially problematic at best
-        # ref: https://docs.sqlalchemy.org/en/13/dialects/sqlite.html#threading-pooling-behavior
-        if self._is_sqlite_inmemory_connection_string(connection_string):
-            raise ValueError("Cannot use SQLite in-memory with BuildGrid (connection_string=[%s]). "
-                             "Use a file or leave the connection_string empty for a tempfile." %
-                             connection_string)
-
-        # Only pass the (known) kwargs that have been explicitly set by the user
-        available_options = set(['pool_size', 'max_overflow', 'pool_timeout', 'connect_args'])
-        kwargs_keys = set(kwargs.keys())
-        if not kwargs_keys.issubset(available_options):
-            unknown_options = kwargs_keys - available_options
-            raise TypeError("Unknown keyword arguments: [%s]" % unknown_options)
-
-        self.__logger.debug("SQLAlchemy additional kwargs: [%s]", kwargs)
-
-        self._engine = create_engine(connection_string, echo=False, **kwargs)
-
-        self.__logger.info("Using SQL backend for index at connection [%s] "
-                           "using additional SQL options %s",
-                           repr(self._engine.url), kwargs)
-
-        if self._engine.dialect.name == "sqlite":
-            event.listen(self._engine, "connect", sqlite_on_connect)
-
-        if self.automigrate:
-            self._create_or_migrate_db(connection_string)
-
-    def _is_sqlite_connection_string(self, connection_string: str) -> bool:
-        if connection_string:
-            return connection_string.startswith("sqlite")
-        return False
-
-    def _is_sqlite_inmemory_connection_string(self, full_connection_string: str) -> bool:
-        if self._is_sqlite_connection_string(full_connection_string):
-            # Valid connection_strings for in-memory SQLite which we don't support could look like:
-            # "sqlite:///file:memdb1?option=value&cache=shared&mode=memory",
-            # "sqlite:///file:memdb1?mode=memory&cache=shared",
-            # "sqlite:///file:memdb1?cache=shared&mode=memory",
-            # "sqlite:///file::memory:?cache=shared",
-            # "sqlite:///file::memory:",
-            # "sqlite:///:memory:",
-            # "sqlite:///",
-            # "sqlite://"
-            # ref: https://www.sqlite.org/inmemorydb.html
-            # Note that a user can also specify drivers, so prefix could become 'sqlite+driver:///'
-            connection_string = full_connection_string
-
-            uri_split_index = connection_string.find("?")
-            if uri_split_index != -1:
-                connection_string = connection_string[0:uri_split_index]
-
-            if connection_string.endswith((":memory:", ":///", "://")):
-                return True
-            elif uri_split_index != -1:
-                opts = full_connection_string[uri_split_index + 1:].split("&")
-                if "mode=memory" in opts:
-                    return True
-
-        return False
+        self._engine = create_sqlalchemy_engine(connection_string, automigrate, **kwargs)
 
     @contextmanager
     def session(self, reraise: bool=False) -> ContextManager[SessionType]:
@@ -0,0 +1,267 @@
+# Copyright (C) 2019 Bloomberg LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  <http://www.apache.org/licenses/LICENSE-2.0>
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+ShardedStorage
+==================
+
+A storage provider that spreads blobs over several child storages.
+
+Each digest is assigned to `replication_factor` shards picked by
+rendezvous (highest random weight) hashing over the shard names, so that
+adding or removing a shard only moves the blobs it owns. Shards holding a
+copy of a blob are tried in order on reads, and replicas found to be
+missing a blob are repaired in the background from one that has it.
+"""
+
+from concurrent import futures
+import io
+import logging
+import shutil
+import threading
+
+from buildgrid._protos.google.rpc import code_pb2
+from buildgrid._protos.google.rpc.status_pb2 import Status
+from buildgrid.settings import HASH
+
+from .storage_abc import StorageABC
+
+
+class _ReplicatedWriteSession(io.BufferedIOBase):
+    """A file-like object that writes data to several write sessions."""
+
+    def __init__(self, sessions):
+        super().__init__()
+
+        self.sessions = sessions
+
+    def flush(self):
+        for _, session in self.sessions:
+            session.flush()
+
+    def readable(self):
+        return False
+
+    def seekable(self):
+        return False
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        for _, session in self.sessions:
+            session.write(b)
+        return len(b)
+
+
+class ShardedStorage(StorageABC):
+
+    def __init__(self, shards, replication_factor=1, max_workers=None):
+        """Initializes a new :class:`ShardedStorage` instance.
+
+        Args:
+            shards (dict): Mapping of shard names to :class:`StorageABC`
+                instances. Names, not ordering, determine blob placement.
+            replication_factor (int): Number of shards each blob is
+                stored on. Defaults to ``1``.
+            max_workers (int, optional): Size of the thread pool used to
+                query shards in parallel. Defaults to the number of shards.
+        """
+        self.__logger = logging.getLogger(__name__)
+
+        if not shards:
+            raise ValueError("At least one shard is required")
+        if not 1 <= replication_factor <= len(shards):
+            raise ValueError("Replication factor must be between 1 and the "
+                             "number of shards, got [{}]".format(replication_factor))
+
+        self._shards = dict(shards)
+        self._replication_factor = replication_factor
+
+        try:
+            self._executor = futures.ThreadPoolExecutor(
+                max_workers or len(self._shards), thread_name_prefix="ShardedStorage")
+            # Keep repairs from competing with requests for the main pool:
+            self._repair_executor = futures.ThreadPoolExecutor(
+                1, thread_name_prefix="ShardedStorage_Repair")
+        except TypeError:
+            # We need python >= 3.6 to support `thread_name_prefix`, so fallback
+            # to ugly thread names if that didn't work
+            self._executor = futures.ThreadPoolExecutor(max_workers or len(self._shards))
+            self._repair_executor = futures.ThreadPoolExecutor(1)
+
+        self._repairs = set()
+        self._repairs_lock = threading.Lock()
+
+    def has_blob(self, digest):
+        for name in self._replicas_for(digest):
+            if self._shards[name].has_blob(digest):
+                return True
+        return False
+
+    def get_blob(self, digest):
+        missing_replicas = []
+        for name in self._replicas_for(digest):
+            blob = self._shards[name].get_blob(digest)
+            if blob is not None:
+                if missing_replicas:
+                    self._queue_repair(digest, name, missing_replicas)
+                return blob
+            missing_replicas.append(name)
+        return None
+
+    def delete_blob(self, digest):
+        for name in self._replicas_for(digest):
+            self._shards[name].delete_blob(digest)
+
+    def begin_write(self, digest):
+        return _ReplicatedWriteSession([(name, self._shards[name].begin_write(digest))
+                                        for name in self._replicas_for(digest)])
+
+    def commit_write(self, digest, write_session):
+        write_session.flush()
+        commits = [self._executor.submit(self._shards[name].commit_write, digest, session)
+                   for name, session in write_session.sessions]
+        for commit in commits:
+            # Re-raises the first error encountered, if any:
+            commit.result()
+
+    def missing_blobs(self, digests):
+        digests = list(digests)
+
+        shard_digests = {}
+        for digest in digests:
+            for name in self._replicas_for(digest):
+                shard_digests.setdefault(name, []).append(digest)
+
+        missing_by_shard = self._map_shards(
+            lambda name, shard_batch: self._shards[name].missing_blobs(shard_batch), shard_digests)
+
+        missing_keys = {}
+        for name, missing in missing_by_shard.items():
+            for digest in missing:
+                missing_keys.setdefault((digest.hash, digest.size_bytes), []).append(name)
+
+        result = []
+        for digest in digests:
+            missing_replicas = missing_keys.get((digest.hash, digest.size_bytes), [])
+            if len(missing_replicas) >= self._replication_factor:
+                result.append(digest)
+            elif missing_replicas:
+                source = next(name for name in self._replicas_for(digest)
+                              if name not in missing_replicas)
+                self._queue_repair(digest, source, missing_replicas)
+        return result
+
+    def bulk_update_blobs(self, blobs):
+        blobs = list(blobs)
+
+        shard_blobs = {}
+        for index, (digest, data) in enumerate(blobs):
+            for name in self._replicas_for(digest):
+                shard_blobs.setdefault(name, []).append((index, digest, data))
+
+        def __update_shard(name, shard_batch):
+            return self._shards[name].bulk_update_blobs(
+                [(digest, data) for _, digest, data in shard_batch])
+
+        statuses_by_shard = self._map_shards(__update_shard, shard_blobs)
+
+        # A blob is only reported as stored if every replica accepted it:
+        result = [Status(code=code_pb2.OK) for _ in blobs]
+        for name, statuses in statuses_by_shard.items():
+            for (index, _, _), status in zip(shard_blobs[name], statuses):
+                if status.code != code_pb2.OK and result[index].code == code_pb2.OK:
+                    result[index] = status
+        return result
+
+    def bulk_read_blobs(self, digests):
+        digests = list(digests)
+
+        blobmap = {}
+        for replica_index in range(self._replication_factor):
+            shard_digests = {}
+            for digest in digests:
+                if digest.hash not in blobmap:
+                    name = self._replicas_for(digest)[replica_index]
+                    shard_digests.setdefault(name, []).append(digest)
+
+            if not shard_digests:
+                break
+
+            blobs_by_shard = self._map_shards(
+                lambda name, shard_batch: self._shards[name].bulk_read_blobs(shard_batch), shard_digests)
+
+            for name, blobs in blobs_by_shard.items():
+                blobmap.update(blobs)
+
+                if replica_index > 0:
+                    for digest in shard_digests[name]:
+                        if digest.hash in blobs:
+                            self._queue_repair(digest, name,
+                                               self._replicas_for(digest)[:replica_index])
+
+        return blobmap
+
+    # --- Private API ---
+
+    def _replicas_for(self, digest):
+        """Returns the names of the shards a digest is stored on, best first."""
+        def __weight(name):
+            key = '{}/{}'.format(name, digest.hash).encode()
+            return HASH(key).digest()
+
+        return sorted(self._shards, key=__weight, reverse=True)[:self._replication_factor]
+
+    def _map_shards(self, function, batches):
+        """Calls `function(name, batch)` in parallel for every shard batch."""
+        calls = {name: self._executor.submit(function, name, batch)
+                 for name, batch in batches.items()}
+        return {name: call.result() for name, call in calls.items()}
+
+    def _queue_repair(self, digest, source, targets):
+        key = (digest.hash, digest.size_bytes)
+        with self._repairs_lock:
+            if key in self._repairs:
+                return
+            self._repairs.add(key)
+
+        self._repair_executor.submit(self._repair_blob, digest, source, list(targets))
+
+    def _repair_blob(self, digest, source, targets):
+        key = (digest.hash, digest.size_bytes)
+        try:
+            for target in targets:
+                blob = self._shards[source].get_blob(digest)
+                if blob is None:
+                    return
+
+                try:
+                    write_session = self._shards[target].begin_write(digest)
+                    shutil.copyfileobj(blob, write_session)
+                    self._shards[target].commit_write(digest, write_session)
+                finally:
+                    blob.close()
+
+                self.__logger.debug("Repaired blob [%s/%s] on shard [%s]",
+                                    digest.hash, digest.size_bytes, target)
+
+        except Exception:  # pylint: disable=broad-except
+            self.__logger.warning("Failed to repair blob [%s/%s]",
+                                  digest.hash, digest.size_bytes, exc_info=True)
+
+        finally:
+            with self._repairs_lock:
+                self._repairs.discard(key)
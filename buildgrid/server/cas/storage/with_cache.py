@@ -23,10 +23,41 @@ fallback provider.
 To ensure clients can reliably store blobs in CAS, only `get_blob`
 calls are cached -- `has_blob` and `missing_blobs` will always query
 the fallback.
+
+Optionally, writes to the fallback can be deferred ("write-back" mode):
+a write is then acknowledged as soon as it has been committed to the
+cache, and a pool of background threads uploads it to the fallback.
+Blobs waiting to be uploaded are reported as present by `has_blob` and
+`missing_blobs`. As the cache is the only copy of those blobs until they
+reach the fallback, write-back mode should only be used with a durable
+cache, such as a `DiskStorage`, that is large enough not to evict
+pending blobs. Uploads that keep failing stay pending and are retried
+periodically. Pending blobs can be recorded in a journal file, for their
+uploads to resume after a restart::
+
+    + <hash>/<size_bytes>
+    - <hash>/<size_bytes>
+
+with fields separated by tabs.
+
+Presence checks can also be answered by the cache for the blobs it holds
+("trust-cache" mode), the fallback then only being queried for the
+remainder. This is only safe if every blob in the cache is known to also
+be in the fallback, which is not guaranteed if writes to the fallback can
+fail after the cache has been written to.
 """
 
+from concurrent import futures
 import io
 import logging
+import os
+import queue
+import shutil
+import threading
+import time
+
+from buildgrid._protos.build.bazel.remote.execution.v2 import remote_execution_pb2
+from buildgrid._protos.google.rpc import code_pb2
 
 from .storage_abc import StorageABC
 
@@ -79,19 +110,32 @@ class _CachingTee(io.RawIOBase):
     """A file-like object that wraps a 'fallback' file, and when it's
     read, writes the resulting data to a 'cache' storage provider.
 
+    If `on_partial_read` is given, closing the file before it has been
+    entirely read discards the cached data and calls `on_partial_read`
+    with the digest, instead of reading the remainder synchronously.
+
     Does not support non-blocking mode.
     """
 
-    def __init__(self, fallback_file, digest, cache):
+    def __init__(self, fallback_file, digest, cache, on_partial_read=None):
         super().__init__()
 
         self._file = fallback_file
         self._digest = digest
         self._cache = cache
         self._cache_session = cache.begin_write(digest)
+        self._on_partial_read = on_partial_read
+        self._bytes_read = 0
 
     def close(self):
+        if self.closed:
+            return
         super().close()
+        if self._on_partial_read is not None and self._bytes_read < self._digest.size_bytes:
+            self._cache_session.close()
+            self._file.close()
+            self._on_partial_read(self._digest)
+            return
         self._cache_session.write(self._file.read())
         self._cache.commit_write(self._digest, self._cache_session)
         self._file.close()
@@ -108,23 +152,101 @@ class _CachingTee(io.RawIOBase):
     def readall(self):
         data = self._file.read()
         self._cache_session.write(data)
+        self._bytes_read += len(data)
         return data
 
     def readinto(self, b):
         bytes_read = self._file.readinto(b)
         self._cache_session.write(b[:bytes_read])
+        self._bytes_read += bytes_read
         return bytes_read
 
 
 class WithCacheStorage(StorageABC):
 
-    def __init__(self, cache, fallback):
+    def __init__(self, cache, fallback, write_back=False, write_back_threads=1,
+                 write_back_queue_size=1000, write_back_retries=3, write_back_backoff=1.0,
+                 write_back_retry_period=60.0, write_back_journal=None,
+                 trust_cache=False, background_promotion=False, promotion_threads=2):
+        """Initializes a new :class:`WithCacheStorage` instance.
+
+        Args:
+            cache (StorageABC): Fast storage tier, checked first on reads.
+            fallback (StorageABC): Slow storage tier, authoritative for
+                presence checks.
+            write_back (bool): Acknowledge writes once committed to the
+                cache and upload them to the fallback in the background.
+                Defaults to ``False``.
+            write_back_threads (int): Number of background uploader threads.
+            write_back_queue_size (int): Maximum number of pending uploads.
+                Writers block once that many uploads are queued.
+            write_back_retries (int): Number of times a failed upload to the
+                fallback is retried in a row.
+            write_back_backoff (float): Base delay, in seconds, between two
+                upload attempts. Doubles after each failed attempt.
+            write_back_retry_period (float): Time, in seconds, after which
+                uploads that failed every retry are queued again.
+            write_back_journal (str): Path of the file recording pending
+                uploads, resumed when the storage is created again. Pending
+                uploads are only kept in memory if not set.
+            trust_cache (bool): Answer `has_blob` and `missing_blobs` from
+                the cache for blobs it holds, only querying the fallback for
+                the remainder. Defaults to ``False``.
+            background_promotion (bool): Copy blobs into the cache from a
+                background thread when they are only partially read, or
+                read through `bulk_read_blobs`. Defaults to ``False``.
+            promotion_threads (int): Number of background promotion threads.
+        """
         self.__logger = logging.getLogger(__name__)
 
         self._cache = cache
         self._fallback = fallback
 
+        self._write_back = write_back
+        self._write_back_retries = write_back_retries
+        self._write_back_backoff = write_back_backoff
+        self._write_back_retry_period = write_back_retry_period
+
+        self._trust_cache = trust_cache
+
+        self._pending_writes = {}
+        # {(hash, size): (Digest, time of the last failure)}, pending
+        # uploads waiting to be queued again:
+        self._failed_writes = {}
+        self._pending_writes_lock = threading.Lock()
+        self._write_queue = None
+        self._journal = None
+
+        if self._write_back:
+            self._write_queue = queue.Queue(maxsize=write_back_queue_size)
+
+            if write_back_journal is not None:
+                self._load_journal(write_back_journal)
+
+            for index in range(max(1, write_back_threads)):
+                thread = threading.Thread(target=self._fallback_writer,
+                                          name="WithCache_Writer_{}".format(index),
+                                          daemon=True)
+                thread.start()
+
+        self._promotions = set()
+        self._promotions_lock = threading.Lock()
+        self._promotion_executor = None
+
+        if background_promotion:
+            try:
+                self._promotion_executor = futures.ThreadPoolExecutor(
+                    max(1, promotion_threads), thread_name_prefix="WithCache_Promoter")
+            except TypeError:
+                # We need python >= 3.6 to support `thread_name_prefix`, so fallback
+                # to ugly thread names if that didn't work
+                self._promotion_executor = futures.ThreadPoolExecutor(max(1, promotion_threads))
+
     def has_blob(self, digest):
+        if self._is_pending(digest):
+            return True
+        if self._trust_cache and self._cache.has_blob(digest):
+            return True
         return self._fallback.has_blob(digest)
 
     def get_blob(self, digest):
@@ -134,24 +256,54 @@ class WithCacheStorage(StorageABC):
         fallback_result = self._fallback.get_blob(digest)
         if fallback_result is None:
             return None
+        if self._promotion_executor is not None:
+            return _CachingTee(fallback_result, digest, self._cache,
+                               on_partial_read=self._queue_promotion)
         return _CachingTee(fallback_result, digest, self._cache)
 
     def delete_blob(self, digest):
+        key = (digest.hash, digest.size_bytes)
+        with self._pending_writes_lock:
+            if self._pending_writes.pop(key, None) is not None:
+                self._failed_writes.pop(key, None)
+                self._log_pending_write('-', digest)
         self._fallback.delete_blob(digest)
         self._cache.delete_blob(digest)
 
     def begin_write(self, digest):
+        if self._write_back:
+            return self._cache.begin_write(digest)
         return _OutputTee(self._cache.begin_write(digest), self._fallback.begin_write(digest))
 
     def commit_write(self, digest, write_session):
+        if self._write_back:
+            self._cache.commit_write(digest, write_session)
+            self._queue_fallback_write(digest)
+            return
+
         write_session.flush()
         self._cache.commit_write(digest, write_session._original_a)
         self._fallback.commit_write(digest, write_session._original_b)
 
     def missing_blobs(self, blobs):
+        if self._write_back:
+            blobs = [digest for digest in blobs if not self._is_pending(digest)]
+            if not blobs:
+                return []
+        if self._trust_cache:
+            blobs = self._cache.missing_blobs(blobs)
+            if not blobs:
+                return []
         return self._fallback.missing_blobs(blobs)
 
     def bulk_update_blobs(self, blobs):
+        if self._write_back:
+            results = self._cache.bulk_update_blobs(blobs)
+            for (digest, _), status in zip(blobs, results):
+                if status.code == code_pb2.OK:
+                    self._queue_fallback_write(digest)
+            return results
+
         self._cache.bulk_update_blobs(blobs)
         return self._fallback.bulk_update_blobs(blobs)
 
@@ -162,5 +314,266 @@ class WithCacheStorage(StorageABC):
             digests
         )
         fallback_blobs = self._fallback.bulk_read_blobs(uncached_digests)
+        if self._promotion_executor is not None and fallback_blobs:
+            # Bulk reads are bounded in size and callers read blobs whole:
+            # read them now and promote that data, rather than downloading
+            # them again from the fallback.
+            blobs_data = {}
+            for blob_hash, fallback_blob in list(fallback_blobs.items()):
+                try:
+                    blobs_data[blob_hash] = fallback_blob.read()
+                finally:
+                    fallback_blob.close()
+                fallback_blobs[blob_hash] = io.BytesIO(blobs_data[blob_hash])
+
+            self._queue_bulk_promotion([(digest, blobs_data[digest.hash]) for digest in digests
+                                        if digest.hash in blobs_data])
         cache_blobs.update(fallback_blobs)
         return cache_blobs
+
+    def wait_for_pending_writes(self):
+        """Blocks until every queued deferred write has been attempted.
+
+        Writes that failed stay pending, to be retried later. Does nothing if
+        write-back mode is disabled.
+        """
+        if self._write_queue is not None:
+            self._write_queue.join()
+
+    @property
+    def pending_writes_count(self):
+        """int: Number of blobs not yet uploaded to the fallback."""
+        with self._pending_writes_lock:
+            return len(self._pending_writes)
+
+    # --- Private API ---
+
+    def _is_pending(self, digest):
+        with self._pending_writes_lock:
+            return (digest.hash, digest.size_bytes) in self._pending_writes
+
+    def _queue_promotion(self, digest):
+        key = (digest.hash, digest.size_bytes)
+        with self._promotions_lock:
+            if key in self._promotions:
+                return
+            self._promotions.add(key)
+
+        self._promotion_executor.submit(self._promote_blob, digest)
+
+    def _queue_bulk_promotion(self, blobs):
+        promoted_blobs = []
+        with self._promotions_lock:
+            for digest, data in blobs:
+                key = (digest.hash, digest.size_bytes)
+                if key not in self._promotions:
+                    self._promotions.add(key)
+                    promoted_blobs.append((digest, data))
+
+        if promoted_blobs:
+            self._promotion_executor.submit(self._promote_blobs, promoted_blobs)
+
+    def _promote_blobs(self, blobs):
+        try:
+            results = self._cache.bulk_update_blobs(blobs)
+            for (digest, _), status in zip(blobs, results):
+                if status.code != code_pb2.OK:
+                    self.__logger.warning("Failed to promote blob [%s/%s] to the cache: %s",
+                                          digest.hash, digest.size_bytes, status.message)
+
+        except Exception:  # pylint: disable=broad-except
+            self.__logger.warning("Failed to promote [%s] blobs to the cache",
+                                  len(blobs), exc_info=True)
+
+        finally:
+            with self._promotions_lock:
+                for digest, _ in blobs:
+                    self._promotions.discard((digest.hash, digest.size_bytes))
+
+    def _promote_blob(self, digest):
+        key = (digest.hash, digest.size_bytes)
+        try:
+            if self._cache.has_blob(digest):
+                return
+
+            fallback_blob = self._fallback.get_blob(digest)
+            if fallback_blob is None:
+                return
+
+            try:
+                cache_session = self._cache.begin_write(digest)
+                shutil.copyfileobj(fallback_blob, cache_session)
+                self._cache.commit_write(digest, cache_session)
+            finally:
+                fallback_blob.close()
+
+        except Exception:  # pylint: disable=broad-except
+            self.__logger.warning("Failed to promote blob [%s/%s] to the cache",
+                                  digest.hash, digest.size_bytes, exc_info=True)
+
+        finally:
+            with self._promotions_lock:
+                self._promotions.discard(key)
+
+    def _queue_fallback_write(self, digest):
+        key = (digest.hash, digest.size_bytes)
+        with self._pending_writes_lock:
+            if key in self._pending_writes:
+                return
+            self._pending_writes[key] = digest
+            self._log_pending_write('+', digest)
+
+        # Blocks if the queue is full, throttling writers down to the
+        # rate at which the fallback accepts uploads:
+        self._write_queue.put(digest)
+
+    def _queue_failed_writes(self):
+        """Queues again the failed uploads whose retry period has elapsed,
+        without blocking, as only writer threads empty the queue.
+        """
+        retry_time = time.monotonic() - self._write_back_retry_period
+        with self._pending_writes_lock:
+            retried_writes = [(key, digest) for key, (digest, failure_time)
+                              in self._failed_writes.items() if failure_time <= retry_time]
+
+        for key, digest in retried_writes:
+            with self._pending_writes_lock:
+                if self._failed_writes.pop(key, None) is None:
+                    continue
+
+            try:
+                self._write_queue.put_nowait(digest)
+
+            except queue.Full:
+                with self._pending_writes_lock:
+                    if key in self._pending_writes:
+                        self._failed_writes[key] = (digest, retry_time)
+                break
+
+    def _fallback_writer(self):
+        while True:
+            self._queue_failed_writes()
+
+            try:
+                digest = self._write_queue.get(timeout=self._write_back_retry_period)
+            except queue.Empty:
+                continue
+
+            key = (digest.hash, digest.size_bytes)
+            is_done = False
+            try:
+                with self._pending_writes_lock:
+                    # The blob may have been deleted in the meantime:
+                    is_pending = key in self._pending_writes
+                if is_pending:
+                    is_done = self._write_to_fallback(digest)
+
+            except Exception:  # pylint: disable=broad-except
+                self.__logger.error("Failed to write blob [%s/%s] to the fallback storage",
+                                    digest.hash, digest.size_bytes, exc_info=True)
+
+            finally:
+                with self._pending_writes_lock:
+                    if key not in self._pending_writes:
+                        pass
+                    elif is_done:
+                        del self._pending_writes[key]
+                        self._log_pending_write('-', digest)
+                    else:
+                        self._failed_writes[key] = (digest, time.monotonic())
+                self._write_queue.task_done()
+
+    def _write_to_fallback(self, digest):
+        """Uploads a blob from the cache to the fallback, retrying on errors.
+
+        Returns:
+            bool: Whether the blob no longer needs uploading, either because
+            it reached the fallback or because it is gone from the cache.
+        """
+        for attempt in range(self._write_back_retries + 1):
+            if attempt > 0:
+                time.sleep(self._write_back_backoff * 2 ** (attempt - 1))
+
+            try:
+                cache_blob = self._cache.get_blob(digest)
+                if cache_blob is None:
+                    self.__logger.error("Blob [%s/%s] evicted from cache before reaching "
+                                        "the fallback storage", digest.hash, digest.size_bytes)
+                    return True
+
+                try:
+                    write_session = self._fallback.begin_write(digest)
+                    shutil.copyfileobj(cache_blob, write_session)
+                    self._fallback.commit_write(digest, write_session)
+                finally:
+                    cache_blob.close()
+
+            except Exception:  # pylint: disable=broad-except
+                self.__logger.warning("Failed to write blob [%s/%s] to the fallback storage "
+                                      "(attempt %s/%s)", digest.hash, digest.size_bytes,
+                                      attempt + 1, self._write_back_retries + 1, exc_info=True)
+
+            else:
+                return True
+
+        self.__logger.error("Failed to write blob [%s/%s] to the fallback storage, retrying "
+                            "in [%s]s", digest.hash, digest.size_bytes, self._write_back_retry_period)
+        return False
+
+    def _load_journal(self, journal_path):
+        """Reads the uploads left pending by a previous run, for writer threads
+        to resume them, then starts a fresh journal listing only these.
+        """
+        pending_writes = {}
+        try:
+            with open(journal_path, 'r') as journal:
+                for line in journal:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) != 2:
+                        continue  # Truncated or corrupted line
+                    digest_hash, _, digest_size = fields[1].partition('/')
+                    if not digest_size.isdigit():
+                        continue
+                    key = (digest_hash, int(digest_size))
+                    if fields[0] == '+':
+                        pending_writes[key] = remote_execution_pb2.Digest(
+                            hash=digest_hash, size_bytes=int(digest_size))
+                    elif fields[0] == '-':
+                        pending_writes.pop(key, None)
+
+        except FileNotFoundError:
+            pass
+
+        # Writer threads queue these on their first iteration:
+        for key, digest in pending_writes.items():
+            self._pending_writes[key] = digest
+            self._failed_writes[key] = (digest, float('-inf'))
+
+        temp_path = journal_path + '.tmp'
+        with open(temp_path, 'w') as journal:
+            for digest in pending_writes.values():
+                journal.write('+\t{}/{}\n'.format(digest.hash, digest.size_bytes))
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(temp_path, journal_path)
+
+        self._journal = open(journal_path, 'a')
+
+        if pending_writes:
+            self.__logger.info("Resuming [%s] pending writes to the fallback storage from [%s]",
+                               len(pending_writes), journal_path)
+
+    def _log_pending_write(self, operation, digest):
+        """Records a pending upload, ``+``, or its completion, ``-``, in the
+        journal, if any. Must be called with the lock held.
+        """
+        if self._journal is None:
+            return
+
+        if operation == '-' and not self._pending_writes:
+            # Nothing pending anymore, start over:
+            self._journal.seek(0)
+            self._journal.truncate()
+        else:
+            self._journal.write('{}\t{}/{}\n'.format(operation, digest.hash, digest.size_bytes))
+        self._journal.flush()
@@ -0,0 +1,132 @@
+# Copyright (C) 2019 Bloomberg LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  <http://www.apache.org/licenses/LICENSE-2.0>
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+TreeCache
+==================
+
+A size-bounded, in-memory cache mapping the digest of a tree to the
+flattened list of blob digests it references.
+
+CAS content is immutable, so walking a tree always yields the same
+digests: the cache can be shared by every service walking the same trees
+(GetTree, action cache result validation...). Entries are keyed by the
+message type of their root, as a `Tree` and a `Directory` may share the
+same digest. When the total number of cached digests, or the number of
+entries, exceeds the limit, the least recently used entries are dropped
+first.
+"""
+
+import collections
+import logging
+import threading
+
+from buildgrid._protos.build.bazel.remote.execution.v2 import remote_execution_pb2
+
+
+class TreeCache:
+
+    def __init__(self, max_digests):
+        """Initializes a new :class:`TreeCache` instance.
+
+        Args:
+            max_digests (int): Maximum total number of digests to keep in
+                cache, over all entries, and maximum number of entries.
+                ``0`` disables caching.
+        """
+        self.__logger = logging.getLogger(__name__)
+
+        self._max_digests = max_digests
+        self._entries = collections.OrderedDict()
+        self._digests_stored = 0
+        self._lock = threading.Lock()
+
+    # --- Public API ---
+
+    def get(self, message_type, digest):
+        """Returns the cached digests for a tree, or ``None`` if not cached.
+
+        Args:
+            message_type: Protobuf message type of the tree's root.
+            digest (Digest): Digest of the tree's root.
+        """
+        key = (message_type.DESCRIPTOR.full_name, digest.hash, digest.size_bytes)
+        with self._lock:
+            digests = self._entries.get(key)
+            if digests is not None:
+                self._entries.move_to_end(key)
+            return digests
+
+    def put(self, message_type, digest, digests):
+        """Caches the digests referenced by a tree.
+
+        Args:
+            message_type: Protobuf message type of the tree's root.
+            digest (Digest): Digest of the tree's root.
+            digests (list): Digests referenced by the tree.
+        """
+        if self._max_digests <= 0 or len(digests) > self._max_digests:
+            return
+
+        key = (message_type.DESCRIPTOR.full_name, digest.hash, digest.size_bytes)
+        digests = tuple(digests)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._digests_stored -= len(previous)
+
+            self._digests_stored += len(digests)
+            # Entries referencing no digest still take memory, bound them too:
+            while self._entries and (self._digests_stored > self._max_digests or
+                                     len(self._entries) >= self._max_digests):
+                _, evicted = self._entries.popitem(last=False)
+                self._digests_stored -= len(evicted)
+
+            self._entries[key] = digests
+
+    def discard(self, message_type, digest):
+        """Drops a tree's entry from the cache, if present."""
+        key = (message_type.DESCRIPTOR.full_name, digest.hash, digest.size_bytes)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._digests_stored -= len(previous)
+
+    def get_tree_file_digests(self, storage, tree_digest):
+        """Returns the digests of every file in an output `Tree`.
+
+        The tree is only fetched from `storage` and parsed on cache misses.
+
+        Args:
+            storage (StorageABC): Storage to fetch the tree from.
+            tree_digest (Digest): Digest of the `Tree` message.
+
+        Returns:
+            list: The file digests, or ``None`` if the tree is not in storage.
+        """
+        digests = self.get(remote_execution_pb2.Tree, tree_digest)
+        if digests is not None:
+            return digests
+
+        tree = storage.get_message(tree_digest, remote_execution_pb2.Tree)
+        if tree is None:
+            return None
+
+        digests = [file_node.digest for file_node in tree.root.files]
+        for child in tree.children:
+            digests.extend(file_node.digest for file_node in child.files)
+
+        self.put(remote_execution_pb2.Tree, tree_digest, digests)
+        return digests
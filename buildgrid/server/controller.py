@@ -37,10 +37,13 @@ from .operations.instance import OperationsInstance
 class ExecutionController:
 
     def __init__(self, data_store, *, storage=None, action_cache=None, action_browser_url=None,
-                 property_keys=None, bot_session_keepalive_timeout=None):
+                 property_keys=None, bot_session_keepalive_timeout=None, cache_check_workers=0,
+                 cache_check_batch_size=100):
         self.__logger = logging.getLogger(__name__)
 
-        scheduler = Scheduler(data_store, action_cache=action_cache, action_browser_url=action_browser_url)
+        scheduler = Scheduler(data_store, action_cache=action_cache, action_browser_url=action_browser_url,
+                              cache_check_workers=cache_check_workers,
+                              cache_check_batch_size=cache_check_batch_size)
 
         self._execution_instance = ExecutionInstance(scheduler, storage, property_keys)
         self._bots_interface = BotsInterface(scheduler, bot_session_keepalive_timeout=bot_session_keepalive_timeout)
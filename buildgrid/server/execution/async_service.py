@@ -0,0 +1,197 @@
+# Copyright (C) 2019 Bloomberg LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  <http://www.apache.org/licenses/LICENSE-2.0>
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+AsyncExecutionService
+=====================
+
+Serves remote execution requests from a :mod:`grpc.aio` server.
+
+Only imported by servers set up with `grpc_aio`, as its streaming methods
+are async generators, which require Python 3.6.
+"""
+
+import asyncio
+import logging
+
+import grpc
+import janus
+
+from buildgrid._exceptions import FailedPreconditionError, InvalidArgumentError, CancelledError
+from buildgrid._protos.google.longrunning import operations_pb2
+from buildgrid.server._async_authentication import authorize_async
+from buildgrid.server._authentication import AuthContext
+from buildgrid.server.execution.service import ExecutionService
+from buildgrid.server.peer import Peer
+
+
+class AsyncExecutionService(ExecutionService):
+    """Execution service for :mod:`grpc.aio` servers.
+
+    Execute and WaitExecution streams are coroutines waiting for operation
+    updates on asyncio queues, so that watching an operation does not hold
+    a thread for the whole life of its job. Blocking calls to the execution
+    instances run in the event loop's default executor.
+    """
+
+    def __init__(self, server, monitor=False):
+        super().__init__(server, monitor=monitor)
+
+        self.__logger = logging.getLogger(__name__)
+
+    # --- Public API: Servicer ---
+
+    @authorize_async(AuthContext)
+    async def Execute(self, request, context):
+        """Handles ExecuteRequest messages.
+
+        Args:
+            request (ExecuteRequest): The incoming RPC request.
+            context (grpc.aio.ServicerContext): Context for the RPC call.
+        """
+        self.__logger.debug("Execute request from [%s]", context.peer())
+
+        loop = asyncio.get_event_loop()
+        instance_name = request.instance_name
+        message_queue = janus.Queue()
+        peer_uid = context.peer()
+        operation_name = None
+
+        Peer.register_peer(uid=peer_uid, context=context)
+
+        try:
+            instance = self._get_instance(instance_name)
+
+            job_name = await loop.run_in_executor(
+                None, instance.execute, request.action_digest, request.skip_cache_lookup)
+
+            operation_name = await loop.run_in_executor(
+                None, instance.register_job_peer, job_name, peer_uid, message_queue.sync_q)
+
+            self._count_peer(peer_uid, instance_name)
+
+            operation_full_name = "{}/{}".format(instance_name, operation_name)
+
+            self.__logger.info("Operation [%s] created for job [%s]",
+                               operation_full_name, job_name)
+
+            async for operation in self._stream_operation_updates(message_queue.async_q):
+                operation.name = operation_full_name
+                yield operation
+
+        except InvalidArgumentError as e:
+            self.__logger.error(e)
+            context.set_details(str(e))
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            yield operations_pb2.Operation()
+
+        except FailedPreconditionError as e:
+            self.__logger.error(e)
+            context.set_details(str(e))
+            context.set_code(grpc.StatusCode.FAILED_PRECONDITION)
+            yield operations_pb2.Operation()
+
+        except CancelledError as e:
+            self.__logger.info("Operation cancelled [%s]", operation_full_name)
+            context.set_details(str(e))
+            context.set_code(grpc.StatusCode.CANCELLED)
+            yield e.last_response
+
+        finally:
+            if operation_name is not None:
+                await self._rpc_termination(peer_uid, instance_name, operation_name)
+            else:
+                Peer.deregister_peer(peer_uid)
+
+            message_queue.close()
+
+    @authorize_async(AuthContext)
+    async def WaitExecution(self, request, context):
+        """Handles WaitExecutionRequest messages.
+
+        Args:
+            request (WaitExecutionRequest): The incoming RPC request.
+            context (grpc.aio.ServicerContext): Context for the RPC call.
+        """
+        self.__logger.debug("WaitExecution request from [%s]", context.peer())
+
+        loop = asyncio.get_event_loop()
+        names = request.name.split('/')
+        instance_name = '/'.join(names[:-1])
+        operation_name = names[-1]
+        message_queue = janus.Queue()
+        peer = context.peer()
+        registered = False
+
+        Peer.register_peer(uid=peer, context=context)
+
+        try:
+            instance = self._get_instance(instance_name)
+
+            await loop.run_in_executor(
+                None, instance.register_operation_peer, operation_name, peer, message_queue.sync_q)
+            registered = True
+
+            self._count_peer(peer, instance_name)
+
+            operation_full_name = "{}/{}".format(instance_name, operation_name)
+
+            async for operation in self._stream_operation_updates(message_queue.async_q):
+                operation.name = operation_full_name
+                yield operation
+
+        except InvalidArgumentError as e:
+            self.__logger.error(e)
+            context.set_details(str(e))
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            yield operations_pb2.Operation()
+
+        except CancelledError as e:
+            self.__logger.info("Operation cancelled [%s]", operation_full_name)
+            context.set_details(str(e))
+            context.set_code(grpc.StatusCode.CANCELLED)
+            yield e.last_response
+
+        finally:
+            if registered:
+                await self._rpc_termination(peer, instance_name, operation_name)
+            else:
+                Peer.deregister_peer(peer)
+
+            message_queue.close()
+
+    # --- Private API ---
+
+    async def _stream_operation_updates(self, message_queue):
+        """Yields operation updates until the operation is done.
+
+        There is no need to poll for the RPC's termination here: the task
+        serving the RPC gets cancelled if the client goes away.
+        """
+        while True:
+            error, operation = await message_queue.get()
+            if error is not None:
+                raise error
+
+            yield operation
+
+            if operation.done:
+                return
+
+    async def _rpc_termination(self, peer_uid, instance_name, operation_name):
+        loop = asyncio.get_event_loop()
+        # Unregistering must complete even if the RPC is being cancelled:
+        await asyncio.shield(loop.run_in_executor(
+            None, self._rpc_termination_callback, peer_uid, instance_name, operation_name))
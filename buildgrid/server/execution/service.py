@@ -113,12 +113,7 @@ class ExecutionService(remote_execution_pb2_grpc.ExecutionServicer):
             context.add_callback(partial(self._rpc_termination_callback,
                                          peer_uid, instance_name, operation_name))
 
-            if self._is_instrumented:
-                if peer_uid not in self.__peers:
-                    self.__peers_by_instance[instance_name].add(peer_uid)
-                    self.__peers[peer_uid] = 1
-                else:
-                    self.__peers[peer_uid] += 1
+            self._count_peer(peer_uid, instance_name)
 
             operation_full_name = "{}/{}".format(instance_name, operation_name)
 
@@ -180,12 +175,7 @@ class ExecutionService(remote_execution_pb2_grpc.ExecutionServicer):
             context.add_callback(partial(self._rpc_termination_callback,
                                          peer, instance_name, operation_name))
 
-            if self._is_instrumented:
-                if peer not in self.__peers:
-                    self.__peers_by_instance[instance_name].add(peer)
-                    self.__peers[peer] = 1
-                else:
-                    self.__peers[peer] += 1
+            self._count_peer(peer, instance_name)
 
             operation_full_name = "{}/{}".format(instance_name, operation_name)
 
@@ -233,6 +223,14 @@ class ExecutionService(remote_execution_pb2_grpc.ExecutionServicer):
 
     # --- Private API ---
 
+    def _count_peer(self, peer_uid, instance_name):
+        if self._is_instrumented:
+            if peer_uid not in self.__peers:
+                self.__peers_by_instance[instance_name].add(peer_uid)
+                self.__peers[peer_uid] = 1
+            else:
+                self.__peers[peer_uid] += 1
+
     def _rpc_termination_callback(self, peer_uid, instance_name, operation_name):
         self.__logger.debug("RPC terminated for peer_uid=[%s], instance_name=[%s], operation_name=[%s]",
                             peer_uid, instance_name, operation_name)
@@ -40,7 +40,7 @@ from buildgrid.server.execution.service import ExecutionService
 from buildgrid.server._monitoring import MonitoringBus, MonitoringOutputType, MonitoringOutputFormat
 from buildgrid.server.operations.service import OperationsService
 from buildgrid.server.referencestorage.service import ReferenceStorageService
-from buildgrid.server._resources import ExecContext
+from buildgrid.server._resources import CONCURRENCY_LIMITS, ExecContext
 from buildgrid.settings import LOG_RECORD_FORMAT, MIN_THREAD_POOL_SIZE, MONITORING_PERIOD
 
 
@@ -58,7 +58,8 @@ class Server:
                  mon_metric_prefix="",
                  auth_method=AuthMetadataMethod.NONE,
                  auth_secret=None,
-                 auth_algorithm=AuthMetadataAlgorithm.UNSPECIFIED):
+                 auth_algorithm=AuthMetadataAlgorithm.UNSPECIFIED,
+                 grpc_aio=False, reuse_port=False, concurrency_limits=None):
         """Initializes a new :class:`Server` instance.
 
         Args:
@@ -73,9 +74,26 @@ class Server:
                 algorithm to be uses in combination with `auth_secret` for
                 authorizing request using `auth_method`. Defaults to
                 ``UNSPECIFIED``.
+            grpc_aio (bool, optional): Whether or not to serve requests using
+                a :mod:`grpc.aio` server. Execute and WaitExecution streams
+                then run as coroutines on the main event loop instead of
+                holding a worker thread each, other RPCs still being handled
+                by the worker threads. Requires Python 3.6. Defaults to
+                ``False``.
+            reuse_port (bool, optional): Whether or not to let other processes
+                bind the same ports, sharing incoming connections with them.
+                Defaults to ``False``.
+            concurrency_limits (dict, optional): Maximum number of requests,
+                at least 1, handled at once by class of RPC methods
+                (``execution``, ``bots``, ``bytestream``, ``cas`` and
+                ``action-cache``). Execution requests default to 4/5 of
+                `max_workers`, other classes to no limit.
         """
         self.__logger = logging.getLogger(__name__)
 
+        if grpc_aio and sys.version_info < (3, 6):
+            raise ValueError("Serving requests with grpc.aio requires Python >= 3.6")
+
         if max_workers is None:
             # Use max_workers default from Python 3.5+
             max_workers = max(MIN_THREAD_POOL_SIZE, (os.cpu_count() or 1) * 5)
@@ -86,7 +104,23 @@ class Server:
             # Enforce a minumun for max_workers
             max_workers = MIN_THREAD_POOL_SIZE
 
-        ExecContext.init(max_workers)
+        if concurrency_limits is None:
+            concurrency_limits = {}
+
+        unknown_limits = set(concurrency_limits) - set(CONCURRENCY_LIMITS)
+        if unknown_limits:
+            raise ValueError("Unknown concurrency limits: {}".format(sorted(unknown_limits)))
+
+        invalid_limits = [name for name, max_requests in concurrency_limits.items() if max_requests < 1]
+        if invalid_limits:
+            raise ValueError("Concurrency limits must be at least 1: {}".format(sorted(invalid_limits)))
+
+        for name, concurrency_limit in CONCURRENCY_LIMITS.items():
+            concurrency_limit.init(concurrency_limits.get(name))
+
+        if 'execution' not in concurrency_limits:
+            # Max 4/5 workers for blocking requests:
+            ExecContext.init(4 * max_workers // 5)
 
         self.__grpc_auth_interceptor = None
 
@@ -103,14 +137,28 @@ class Server:
             # We need python >= 3.6 to support `thread_name_prefix`, so fallback
             # to ugly thread names if that didn't work
             self.__grpc_executor = futures.ThreadPoolExecutor(max_workers)
-        self.__grpc_server = grpc.server(self.__grpc_executor,
-                                         options=(('grpc.so_reuseport', 0),),
-                                         maximum_concurrent_rpcs=max_workers)
-
-        self.__logger.debug("Setting up gRPC server with thread-limit=[%s]", max_workers)
 
         self.__main_loop = asyncio.get_event_loop()
 
+        self._grpc_aio = grpc_aio
+
+        grpc_options = (('grpc.so_reuseport', 1 if reuse_port else 0),)
+
+        if self._grpc_aio:
+            from grpc import aio
+
+            # Streaming RPCs no longer hold a thread, the number of concurrent
+            # RPCs is thus not capped by the size of the pool:
+            self.__grpc_server = aio.server(migration_thread_pool=self.__grpc_executor,
+                                            options=grpc_options)
+        else:
+            self.__grpc_server = grpc.server(self.__grpc_executor,
+                                             options=grpc_options,
+                                             maximum_concurrent_rpcs=max_workers)
+
+        self.__logger.debug("Setting up %sgRPC server with thread-limit=[%s]",
+                            "asyncio " if self._grpc_aio else "", max_workers)
+
         self.__monitoring_bus = None
 
         self.__logging_queue = janus.Queue(loop=self.__main_loop)
@@ -124,6 +172,8 @@ class Server:
         self.__build_monitoring_tasks = None
         self.__logging_task = None
 
+        self.__is_stopping = False
+
         # We always want a capabilities service
         self._capabilities_service = CapabilitiesService(self.__grpc_server)
 
@@ -137,6 +187,8 @@ class Server:
 
         self._schedulers = {}
         self._instances = set()
+        # Caches to stop, for them to save their state, once serving is over:
+        self._reference_caches = []
 
         self._is_instrumented = monitor
 
@@ -167,7 +219,10 @@ class Server:
 
     def start(self):
         """Starts the BuildGrid server."""
-        self.__grpc_server.start()
+        if self._grpc_aio:
+            self.__main_loop.run_until_complete(self.__grpc_server.start())
+        else:
+            self.__grpc_server.start()
 
         if self._is_instrumented:
             self.__monitoring_bus.start()
@@ -196,7 +251,16 @@ class Server:
         self.__main_loop.run_forever()
 
     def stop(self):
-        """Stops the BuildGrid server."""
+        """Stops the BuildGrid server.
+
+        May be called from a signal handler running on the main loop, the
+        server then finishes stopping asynchronously, `start()` returning
+        once it is done. Later calls are no-ops.
+        """
+        if self.__is_stopping:
+            return
+        self.__is_stopping = True
+
         if self._is_instrumented:
             if self.__state_monitoring_task is not None:
                 self.__state_monitoring_task.cancel()
@@ -210,9 +274,20 @@ class Server:
         if self.__logging_task is not None:
             self.__logging_task.cancel()
 
-        self.__main_loop.stop()
+        if not self._grpc_aio:
+            self.__main_loop.stop()
+
+            self.__grpc_server.stop(None)
+            self._stop_reference_caches()
 
-        self.__grpc_server.stop(None)
+        elif self.__main_loop.is_running():
+            # We can't block the loop waiting for the asyncio server, let it
+            # stop in a task that then stops the loop:
+            asyncio.ensure_future(self._grpc_server_stopper(), loop=self.__main_loop)
+
+        else:
+            self.__main_loop.run_until_complete(self.__grpc_server.stop(None))
+            self._stop_reference_caches()
 
     def add_port(self, address, credentials):
         """Adds a port to the server.
@@ -253,8 +328,15 @@ class Server:
             instance_name (str): Instance name.
         """
         if self._execution_service is None:
-            self._execution_service = ExecutionService(
-                self.__grpc_server, monitor=self._is_instrumented)
+            if self._grpc_aio:
+                # Only importable from Python 3.6:
+                from buildgrid.server.execution.async_service import AsyncExecutionService
+
+                self._execution_service = AsyncExecutionService(
+                    self.__grpc_server, monitor=self._is_instrumented)
+            else:
+                self._execution_service = ExecutionService(
+                    self.__grpc_server, monitor=self._is_instrumented)
 
         self._execution_service.add_instance(instance_name, instance)
         self._add_capabilities_instance(instance_name, execution_instance=instance)
@@ -309,6 +391,7 @@ class Server:
             self._reference_storage_service = ReferenceStorageService(self.__grpc_server)
 
         self._reference_storage_service.add_instance(instance_name, instance)
+        self._reference_caches.append(instance)
 
     def add_action_cache_instance(self, instance, instance_name):
         """Adds a :obj:`ReferenceCache` to the service.
@@ -324,6 +407,7 @@ class Server:
 
         self._action_cache_service.add_instance(instance_name, instance)
         self._add_capabilities_instance(instance_name, action_cache_instance=instance)
+        self._reference_caches.append(instance)
 
     def add_cas_instance(self, instance, instance_name):
         """Adds a :obj:`ContentAddressableStorageInstance` to the service.
@@ -387,6 +471,21 @@ class Server:
                                                          execution_instance)
             self._capabilities_service.add_instance(instance_name, capabilities_instance)
 
+    async def _grpc_server_stopper(self):
+        """Stops the asyncio gRPC server, then the main loop."""
+        try:
+            await self.__grpc_server.stop(None)
+            self._stop_reference_caches()
+
+        finally:
+            self.__main_loop.stop()
+
+    def _stop_reference_caches(self):
+        """Stops the caches that have background workers or state to save."""
+        for reference_cache in self._reference_caches:
+            if hasattr(reference_cache, 'stop'):
+                reference_cache.stop()
+
     async def _logging_worker(self):
         """Publishes log records to the monitoring bus."""
         async def __logging_worker():
@@ -516,6 +615,14 @@ class Server:
                 if queue_time:
                     queue_times.append(queue_time)
 
+            # Emits records by class of limited RPC methods:
+            for concurrency_limit in CONCURRENCY_LIMITS.values():
+                if concurrency_limit.max_workers is None:
+                    continue
+
+                for record in self._query_concurrency_limit(concurrency_limit):
+                    await self.__monitoring_bus.send_record(record)
+
             # Emits records by bot status:
             for bot_status in [BotStatus.OK, BotStatus.UNHEALTHY]:
                 # Emit status bots count record:
@@ -586,6 +693,28 @@ class Server:
 
     # --- Private API: Monitoring ---
 
+    def _query_concurrency_limit(self, concurrency_limit):
+        """Queries the saturation of a class of limited RPC methods."""
+        metadata = {'method-class': concurrency_limit.name}
+
+        busy_workers = concurrency_limit.busy_workers
+        busy_record = self._forge_gauge_metric_record(
+            MetricRecordDomain.STATE, 'busy-workers-count', busy_workers,
+            metadata=metadata)
+
+        # As a percentage of the limit:
+        saturation = 100 * busy_workers // max(concurrency_limit.max_workers, 1)
+        saturation_record = self._forge_gauge_metric_record(
+            MetricRecordDomain.STATE, 'workers-saturation', saturation,
+            metadata=metadata)
+
+        rejected_requests = concurrency_limit.query_n_rejected_requests()
+        rejected_record = self._forge_counter_metric_record(
+            MetricRecordDomain.STATE, 'rejected-requests-count', rejected_requests,
+            metadata=metadata)
+
+        return busy_record, saturation_record, rejected_record
+
     def _query_n_clients(self):
         """Queries the number of clients connected."""
         n_clients = self._execution_service.query_n_clients()
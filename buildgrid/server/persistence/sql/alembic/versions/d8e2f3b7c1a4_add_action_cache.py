@@ -0,0 +1,47 @@
+# Copyright (C) 2019 Bloomberg LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  <http://www.apache.org/licenses/LICENSE-2.0>
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Add action cache
+
+Revision ID: d8e2f3b7c1a4
+Revises: 8a0dbc05b5b0
+Create Date: 2019-11-04 11:02:45.310274
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8e2f3b7c1a4'
+down_revision = '8a0dbc05b5b0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'action_cache',
+        sa.Column('action_digest', sa.String(), nullable=False),
+        sa.Column('action_result', sa.LargeBinary(), nullable=False),
+        sa.Column('accessed_timestamp', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('action_digest')
+    )
+    op.create_index(op.f('ix_action_cache_accessed_timestamp'),
+                    'action_cache', ['accessed_timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_action_cache_accessed_timestamp'), table_name='action_cache')
+    op.drop_table('action_cache')
@@ -30,16 +30,12 @@ from ...._enums import OperationStage
 from ....settings import MAX_JOB_BLOCK_TIME
 from ..interface import DataStoreInterface
 from .models import digest_to_string, Job, Lease, Operation, PlatformRequirement
+from .utils import is_sqlite_inmemory_connection_string, sqlite_on_connect
 
 
 Session = sessionmaker()
 
 
-def sqlite_on_connect(conn, record):
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA synchronous=NORMAL")
-
-
 class SQLDataStore(DataStoreInterface):
 
     def __init__(self, storage, *, connection_string=None, automigrate=False,
@@ -69,7 +65,7 @@ class SQLDataStore(DataStoreInterface):
         # Disallow sqlite in-memory because multi-threaded access to it is
         # complex and potentially problematic at best
         # ref: https://docs.sqlalchemy.org/en/13/dialects/sqlite.html#threading-pooling-behavior
-        if self._is_sqlite_inmemory_connection_string(connection_string):
+        if is_sqlite_inmemory_connection_string(connection_string):
             raise ValueError("Cannot use SQLite in-memory with BuildGrid (connection_string=[%s]). "
                              "Use a file or leave the connection_string empty for a tempfile." %
                              connection_string)
@@ -92,39 +88,6 @@ class SQLDataStore(DataStoreInterface):
         if self.automigrate:
             self._create_or_migrate_db(connection_string)
 
-    def _is_sqlite_connection_string(self, connection_string):
-        if connection_string:
-            return connection_string.startswith("sqlite")
-        return False
-
-    def _is_sqlite_inmemory_connection_string(self, full_connection_string):
-        if self._is_sqlite_connection_string(full_connection_string):
-            # Valid connection_strings for in-memory SQLite which we don't support could look like:
-            # "sqlite:///file:memdb1?option=value&cache=shared&mode=memory",
-            # "sqlite:///file:memdb1?mode=memory&cache=shared",
-            # "sqlite:///file:memdb1?cache=shared&mode=memory",
-            # "sqlite:///file::memory:?cache=shared",
-            # "sqlite:///file::memory:",
-            # "sqlite:///:memory:",
-            # "sqlite:///",
-            # "sqlite://"
-            # ref: https://www.sqlite.org/inmemorydb.html
-            # Note that a user can also specify drivers, so prefix could become 'sqlite+driver:///'
-            connection_string = full_connection_string
-
-            uri_split_index = connection_string.find("?")
-            if uri_split_index != -1:
-                connection_string = connection_string[0:uri_split_index]
-
-            if connection_string.endswith((":memory:", ":///", "://")):
-                return True
-            elif uri_split_index != -1:
-                opts = full_connection_string[uri_split_index + 1:].split("&")
-                if "mode=memory" in opts:
-                    return True
-
-        return False
-
     def __repr__(self):
         return "SQL data store interface for `%s`" % repr(self.engine.url)
 
@@ -16,7 +16,7 @@ from datetime import datetime
 
 from google.protobuf.duration_pb2 import Duration
 from google.protobuf.timestamp_pb2 import Timestamp
-from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Index, Integer, String
+from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Index, Integer, LargeBinary, String
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
@@ -186,6 +186,14 @@ class IndexEntry(Base):
     accessed_timestamp = Column(DateTime, nullable=False)
 
 
+class ActionCacheEntry(Base):
+    __tablename__ = 'action_cache'
+
+    action_digest = Column(String, primary_key=True)
+    action_result = Column(LargeBinary, nullable=False)
+    accessed_timestamp = Column(DateTime, index=True, nullable=False)
+
+
 def digest_to_string(digest):
     return '{}/{}'.format(digest.hash, digest.size_bytes)
 
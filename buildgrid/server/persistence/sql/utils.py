@@ -0,0 +1,163 @@
+# Copyright (C) 2019 Bloomberg LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  <http://www.apache.org/licenses/LICENSE-2.0>
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+SQL helpers
+===========
+
+SQLAlchemy engine set-up shared by the SQL-backed server components (CAS
+index, action cache...).
+"""
+
+import logging
+import os
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import create_engine, event
+
+
+# Each dialect has a limit on the number of bind parameters allowed. This
+# matters because it determines how large we can allow our IN clauses to get.
+#
+# SQLite: 1000 https://www.sqlite.org/limits.html#max_variable_number
+# PostgreSQL: 32767 (Int16.MAX_VALUE) https://www.postgresql.org/docs/9.4/protocol-message-formats.html
+#
+# We'll refer to this as the "inlimit" in the code. The inlimits are
+# set to 75% of the bind parameter limit of the implementation.
+DIALECT_INLIMIT_MAP = {
+    "sqlite": 750,
+    "postgresql": 24000
+}
+DEFAULT_INLIMIT = 100
+
+
+def sqlite_on_connect(conn, record):
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+
+
+def create_sqlalchemy_engine(connection_string, automigrate=False, **kwargs):
+    """Creates an engine for a given database, migrating its schema if asked.
+
+    Args:
+        connection_string (str): SQLAlchemy connection string. SQLite
+            in-memory databases are rejected.
+        automigrate (bool): Upgrade the database schema to the newest
+            version.
+        **kwargs: Additional engine options among ``pool_size``,
+            ``max_overflow``, ``pool_timeout`` and ``connect_args``.
+
+    Returns:
+        sqlalchemy.engine.Engine: The new engine.
+
+    Raises:
+        ValueError: If `connection_string` is an SQLite in-memory database.
+        TypeError: If unknown engine options are given.
+    """
+    logger = logging.getLogger(__name__)
+
+    # Disallow sqlite in-memory because multi-threaded access to it is
+    # complex and potentially problematic at best
+    # ref: https://docs.sqlalchemy.org/en/13/dialects/sqlite.html#threading-pooling-behavior
+    if is_sqlite_inmemory_connection_string(connection_string):
+        raise ValueError("Cannot use SQLite in-memory with BuildGrid (connection_string=[%s]). "
+                         "Use a file or leave the connection_string empty for a tempfile." %
+                         connection_string)
+
+    # Only pass the (known) kwargs that have been explicitly set by the user
+    available_options = set(['pool_size', 'max_overflow', 'pool_timeout', 'connect_args'])
+    kwargs_keys = set(kwargs.keys())
+    if not kwargs_keys.issubset(available_options):
+        unknown_options = kwargs_keys - available_options
+        raise TypeError("Unknown keyword arguments: [%s]" % unknown_options)
+
+    logger.debug("SQLAlchemy additional kwargs: [%s]", kwargs)
+
+    engine = create_engine(connection_string, echo=False, **kwargs)
+
+    logger.info("Using SQL backend at connection [%s] "
+                "using additional SQL options %s",
+                repr(engine.url), kwargs)
+
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", sqlite_on_connect)
+
+    if automigrate:
+        migrate_db(engine)
+
+    return engine
+
+
+def migrate_db(engine):
+    """Upgrades a database schema to the newest version."""
+    logger = logging.getLogger(__name__)
+    logger.warning("Will attempt migration to latest version if needed.")
+
+    config = Config()
+    config.set_main_option("script_location",
+                           os.path.join(os.path.dirname(__file__), "alembic"))
+
+    with engine.begin() as connection:
+        config.attributes['connection'] = connection
+        command.upgrade(config, "head")
+
+
+def get_default_inlimit(engine):
+    """Returns the default number of variables allowed per IN clause."""
+    dialect = engine.dialect.name
+    if dialect not in DIALECT_INLIMIT_MAP:
+        logging.getLogger(__name__).warning(
+            "The SQL dialect [%s] is unsupported, and errors may occur. "
+            "Supported dialects are %s. Using default inclause limit of %s.",
+            dialect, list(DIALECT_INLIMIT_MAP.keys()), DEFAULT_INLIMIT)
+        return DEFAULT_INLIMIT
+
+    return DIALECT_INLIMIT_MAP[dialect]
+
+
+def is_sqlite_connection_string(connection_string):
+    if connection_string:
+        return connection_string.startswith("sqlite")
+    return False
+
+
+def is_sqlite_inmemory_connection_string(full_connection_string):
+    if is_sqlite_connection_string(full_connection_string):
+        # Valid connection_strings for in-memory SQLite which we don't support could look like:
+        # "sqlite:///file:memdb1?option=value&cache=shared&mode=memory",
+        # "sqlite:///file:memdb1?mode=memory&cache=shared",
+        # "sqlite:///file:memdb1?cache=shared&mode=memory",
+        # "sqlite:///file::memory:?cache=shared",
+        # "sqlite:///file::memory:",
+        # "sqlite:///:memory:",
+        # "sqlite:///",
+        # "sqlite://"
+        # ref: https://www.sqlite.org/inmemorydb.html
+        # Note that a user can also specify drivers, so prefix could become 'sqlite+driver:///'
+        connection_string = full_connection_string
+
+        uri_split_index = connection_string.find("?")
+        if uri_split_index != -1:
+            connection_string = connection_string[0:uri_split_index]
+
+        if connection_string.endswith((":memory:", ":///", "://")):
+            return True
+        elif uri_split_index != -1:
+            opts = full_connection_string[uri_split_index + 1:].split("&")
+            if "mode=memory" in opts:
+                return True
+
+    return False
@@ -0,0 +1,177 @@
+# Copyright (C) 2019 Bloomberg LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  <http://www.apache.org/licenses/LICENSE-2.0>
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Reference Cache Snapshots
+=========================
+
+Persists a reference cache's key to digest map on local disk.
+
+The map is periodically written in full to a snapshot file, and every
+change made in between two snapshots can be appended to a journal file,
+so that no entry is lost on restart. The journal is rotated when a snapshot
+starts being written, the previous one being kept until the new snapshot is
+in place. All files share the same line-based format, entries being listed
+from least to most recently used::
+
+    + <key> <hash>/<size_bytes>
+    - <key>
+
+with fields separated by tabs.
+"""
+
+import collections
+import logging
+import os
+import shutil
+
+from buildgrid._protos.build.bazel.remote.execution.v2 import remote_execution_pb2
+
+
+class ReferenceCacheSnapshot:
+
+    def __init__(self, path, journal=True):
+        """Initializes a new :class:`ReferenceCacheSnapshot` instance.
+
+        Args:
+            path (str): Path of the snapshot file. The journal, if any, is
+                stored next to it with a ``.journal`` suffix.
+            journal (bool): Whether to record changes made between two
+                snapshots. Defaults to ``True``.
+        """
+        self.__logger = logging.getLogger(__name__)
+
+        self._path = os.path.abspath(path)
+        self._journal_path = self._path + '.journal'
+        self._previous_journal_path = self._journal_path + '.previous'
+        self._journal = None
+
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+
+        if journal:
+            self._journal = open(self._journal_path, 'a')
+
+    # --- Public API ---
+
+    def load(self):
+        """Reads the last snapshot, then replays the journal on top of it.
+
+        Returns:
+            collections.OrderedDict: The `{key: Digest}` map, from least to
+            most recently used. Keys are returned as stored strings.
+        """
+        digest_map = collections.OrderedDict()
+
+        for path in (self._path, self._previous_journal_path, self._journal_path):
+            try:
+                with open(path, 'r') as entries:
+                    for line in entries:
+                        self._replay(digest_map, line)
+
+            except FileNotFoundError:
+                pass
+
+        self.__logger.info("Loaded [%s] reference cache entries from [%s]",
+                           len(digest_map), self._path)
+
+        return digest_map
+
+    def rotate_journal(self):
+        """Starts a fresh journal, for changes made after the entries about
+        to be saved were listed.
+
+        The previous journal is kept until :meth:`save` succeeds, so that a
+        failed or interrupted save loses nothing.
+        """
+        if self._journal is None:
+            return
+
+        self._journal.close()
+
+        if os.path.exists(self._previous_journal_path):
+            # The last save failed, both journals are needed:
+            with open(self._journal_path, 'r') as journal, \
+                    open(self._previous_journal_path, 'a') as previous_journal:
+                shutil.copyfileobj(journal, previous_journal)
+            os.remove(self._journal_path)
+        else:
+            os.replace(self._journal_path, self._previous_journal_path)
+
+        self._journal = open(self._journal_path, 'a')
+
+    def save(self, entries):
+        """Atomically writes a new snapshot, then drops the journal that got
+        rotated when the entries were listed.
+
+        Args:
+            entries (list): `(key, Digest)` pairs, from least to most
+                recently used. Keys must be strings, free of tabs and
+                newlines.
+        """
+        temp_path = self._path + '.tmp'
+        with open(temp_path, 'w') as snapshot:
+            for key, digest in entries:
+                snapshot.write(self._format_update(key, digest))
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+
+        os.replace(temp_path, self._path)
+
+        # The journal only holds changes made since the previous snapshot:
+        stale_paths = [self._previous_journal_path]
+        if self._journal is None:
+            stale_paths.append(self._journal_path)
+
+        for stale_path in stale_paths:
+            try:
+                os.remove(stale_path)
+            except FileNotFoundError:
+                pass
+
+        self.__logger.debug("Saved [%s] reference cache entries to [%s]",
+                            len(entries), self._path)
+
+    def log_update(self, key, digest):
+        """Records a new or updated entry in the journal, if enabled."""
+        if self._journal is not None:
+            self._journal.write(self._format_update(key, digest))
+            self._journal.flush()
+
+    def log_delete(self, key):
+        """Records an entry removal in the journal, if enabled."""
+        if self._journal is not None:
+            self._journal.write('-\t{}\n'.format(key))
+            self._journal.flush()
+
+    # --- Private API ---
+
+    def _format_update(self, key, digest):
+        return '+\t{}\t{}/{}\n'.format(key, digest.hash, digest.size_bytes)
+
+    def _replay(self, digest_map, line):
+        fields = line.rstrip('\n').split('\t')
+
+        if len(fields) == 3 and fields[0] == '+':
+            digest_hash, _, digest_size = fields[2].partition('/')
+            if not digest_size.isdigit():
+                return
+            digest_map.pop(fields[1], None)
+            digest_map[fields[1]] = remote_execution_pb2.Digest(hash=digest_hash,
+                                                                size_bytes=int(digest_size))
+
+        elif len(fields) == 2 and fields[0] == '-':
+            digest_map.pop(fields[1], None)
+
+        # Anything else is a truncated or corrupted line, skip it.
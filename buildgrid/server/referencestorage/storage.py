@@ -23,21 +23,49 @@ For a given key, it
 """
 
 import collections
+from concurrent import futures
 import logging
+import threading
+import time
+from urllib.parse import quote, unquote
 
 from buildgrid._exceptions import NotFoundError
 from buildgrid._protos.build.bazel.remote.execution.v2 import remote_execution_pb2
+from buildgrid.server.actioncache.validation import get_action_result_blobs
+from buildgrid.server.cas.tree_cache import TreeCache
+
+from .snapshot import ReferenceCacheSnapshot
+
+
+# Fraction of the freshness window after which a hit triggers a background
+# revalidation of the entry, so that popular entries never expire:
+_REVALIDATION_THRESHOLD = 0.75
 
 
 class ReferenceCache:
 
-    def __init__(self, storage, max_cached_refs, allow_updates=True):
+    def __init__(self, storage, max_cached_refs, allow_updates=True, tree_cache=None,
+                 freshness_window=0, snapshot_path=None, snapshot_period=300, snapshot_journal=True):
         """ Initialises a new ReferenceCache instance.
 
         Args:
             storage (StorageABC): storage backend instance to be used.
             max_cached_refs (int): maximum number of entries to be stored.
             allow_updates (bool): allow the client to write to storage
+            tree_cache (TreeCache): cache of the blobs referenced by output
+                trees, possibly shared with other services. Output trees are
+                fetched on every lookup if ``None``.
+            freshness_window (float): time, in seconds, during which an
+                ActionResult whose output blobs were found in storage is
+                served without being checked again. ``0`` checks on every
+                lookup.
+            snapshot_path (str): file the cache's entries are saved to and
+                restored from on startup. Entries only live in memory if
+                ``None``.
+            snapshot_period (float): time, in seconds, between two
+                snapshots.
+            snapshot_journal (bool): record every update made between two
+                snapshots, so that no entry is lost on restart.
         """
         self.__logger = logging.getLogger(__name__)
 
@@ -48,6 +76,35 @@ class ReferenceCache:
         self._allow_updates = allow_updates
         self._max_cached_refs = max_cached_refs
         self._digest_map = collections.OrderedDict()
+        self._tree_cache = tree_cache if tree_cache is not None else TreeCache(0)
+
+        self._freshness_window = freshness_window
+        self._validated_results = {}
+        self._revalidations = set()
+        self._lock = threading.Lock()
+        self._revalidation_executor = None
+
+        if self._freshness_window > 0:
+            try:
+                self._revalidation_executor = futures.ThreadPoolExecutor(
+                    1, thread_name_prefix="ReferenceCache_Revalidation")
+            except TypeError:
+                # We need python >= 3.6 to support `thread_name_prefix`, so fallback
+                # to ugly thread names if that didn't work
+                self._revalidation_executor = futures.ThreadPoolExecutor(1)
+
+        self._snapshot = None
+        self._snapshot_lock = threading.Lock()
+        self._snapshot_thread = None
+        self._snapshot_stop = threading.Event()
+
+        if snapshot_path is not None:
+            self._snapshot = ReferenceCacheSnapshot(snapshot_path, journal=snapshot_journal)
+            self._restore_snapshot()
+
+            self._snapshot_thread = threading.Thread(target=self._snapshot_worker, args=(snapshot_period,),
+                                                     name="ReferenceCache_Snapshot", daemon=True)
+            self._snapshot_thread.start()
 
     # --- Public API ---
 
@@ -69,6 +126,34 @@ class ReferenceCache:
     def allow_updates(self):
         return self._allow_updates
 
+    def save_snapshot(self):
+        """Writes all the cache's entries to the snapshot file, if configured."""
+        if self._snapshot is None:
+            return
+
+        with self._snapshot_lock:
+            # Only listing entries blocks lookups and updates:
+            with self._lock:
+                entries = [(self._encode_key(key), digest) for key, digest in self._digest_map.items()]
+                self._snapshot.rotate_journal()
+
+            self._snapshot.save(entries)
+
+    def stop(self):
+        """Stops the cache's background workers, then saves a last snapshot."""
+        self._snapshot_stop.set()
+        if self._snapshot_thread is not None:
+            self._snapshot_thread.join()
+
+        if self._revalidation_executor is not None:
+            self._revalidation_executor.shutdown(wait=False)
+
+        try:
+            self.save_snapshot()
+
+        except OSError:
+            self.__logger.exception("Failed to save reference cache snapshot")
+
     def get_digest_reference(self, key):
         """Retrieves the cached Digest for the given key.
 
@@ -86,7 +171,7 @@ class ReferenceCache:
             if reference_result is not None:
                 return reference_result
 
-            del self._digest_map[key]
+            self._drop_entry(key)
 
         raise NotFoundError("Key not found: {}".format(key))
 
@@ -100,16 +185,24 @@ class ReferenceCache:
             The cached ActionResult matching the given key or raises
             NotFoundError.
         """
-        if key in self._digest_map:
-            reference_result = self.__storage.get_message(self._digest_map[key],
+        fresh_result = self._get_fresh_result(key)
+        if fresh_result is not None:
+            return fresh_result
+
+        result_digest = self._digest_map.get(key)
+        if result_digest is not None:
+            reference_result = self.__storage.get_message(result_digest,
                                                           remote_execution_pb2.ActionResult)
 
             if reference_result is not None:
                 if self._action_result_blobs_still_exist(reference_result):
-                    self._digest_map.move_to_end(key)
+                    self._mark_validated(key, result_digest, reference_result)
+                    with self._lock:
+                        if key in self._digest_map:
+                            self._digest_map.move_to_end(key)
                     return reference_result
 
-            del self._digest_map[key]
+            self._drop_entry(key)
 
         raise NotFoundError("Key not found: {}".format(key))
 
@@ -130,14 +223,117 @@ class ReferenceCache:
         if self._max_cached_refs == 0:
             return
 
-        while len(self._digest_map) >= self._max_cached_refs:
-            self._digest_map.popitem(last=False)
-
         result_digest = self.__storage.put_message(result)
-        self._digest_map[key] = result_digest
+
+        with self._lock:
+            self._validated_results.pop(key, None)
+            self._digest_map.pop(key, None)
+
+            while len(self._digest_map) >= self._max_cached_refs:
+                evicted_key, _ = self._digest_map.popitem(last=False)
+                self._validated_results.pop(evicted_key, None)
+                if self._snapshot is not None:
+                    self._snapshot.log_delete(self._encode_key(evicted_key))
+
+            self._digest_map[key] = result_digest
+            if self._snapshot is not None:
+                self._snapshot.log_update(self._encode_key(key), result_digest)
 
     # --- Private API ---
 
+    def _encode_key(self, key):
+        """Returns the string stored in snapshots for a key."""
+        # Keys may contain the snapshot format's separators:
+        return quote(key, safe='/')
+
+    def _decode_key(self, key):
+        """Returns the key matching a string stored in snapshots."""
+        return unquote(key)
+
+    def _restore_snapshot(self):
+        for key, digest in self._snapshot.load().items():
+            try:
+                self._digest_map[self._decode_key(key)] = digest
+
+            except ValueError:
+                self.__logger.warning("Skipping invalid snapshot entry [%s]", key)
+
+        # Drop the least recently used entries if the limit was lowered:
+        while len(self._digest_map) > self._max_cached_refs:
+            self._digest_map.popitem(last=False)
+
+    def _snapshot_worker(self, period):
+        while not self._snapshot_stop.wait(period):
+            try:
+                self.save_snapshot()
+
+            except OSError:
+                self.__logger.exception("Failed to save reference cache snapshot")
+
+    def _drop_entry(self, key, result_digest=None):
+        """Removes an entry, only if it still maps to `result_digest` if given."""
+        with self._lock:
+            if result_digest is not None and self._digest_map.get(key) != result_digest:
+                return
+            if self._digest_map.pop(key, None) is not None and self._snapshot is not None:
+                self._snapshot.log_delete(self._encode_key(key))
+            self._validated_results.pop(key, None)
+
+    def _mark_validated(self, key, result_digest, action_result):
+        if self._freshness_window <= 0:
+            return
+        with self._lock:
+            # The entry may have been updated or evicted in the meantime:
+            if self._digest_map.get(key) == result_digest:
+                self._validated_results[key] = (time.monotonic(), action_result)
+
+    def _get_fresh_result(self, key):
+        """Returns a copy of the entry's ActionResult if recently validated."""
+        if self._freshness_window <= 0:
+            return None
+
+        with self._lock:
+            validated = self._validated_results.get(key)
+            if validated is None:
+                return None
+
+            validated_at, action_result = validated
+            age = time.monotonic() - validated_at
+            if age >= self._freshness_window:
+                del self._validated_results[key]
+                return None
+
+            self._digest_map.move_to_end(key)
+
+            if age >= self._freshness_window * _REVALIDATION_THRESHOLD and key not in self._revalidations:
+                self._revalidations.add(key)
+                self._revalidation_executor.submit(self._revalidate, key)
+
+        fresh_result = remote_execution_pb2.ActionResult()
+        fresh_result.CopyFrom(action_result)
+        return fresh_result
+
+    def _revalidate(self, key):
+        """Checks an entry's output blobs again, dropping it if incomplete."""
+        try:
+            result_digest = self._digest_map.get(key)
+            if result_digest is None:
+                return
+
+            action_result = self.__storage.get_message(result_digest,
+                                                       remote_execution_pb2.ActionResult)
+            if action_result is not None and self._action_result_blobs_still_exist(action_result):
+                self._mark_validated(key, result_digest, action_result)
+            else:
+                self._drop_entry(key, result_digest)
+
+        except Exception:  # pylint: disable=broad-except
+            self.__logger.warning("Failed to revalidate entry [%s]", key, exc_info=True)
+
+        finally:
+            with self._lock:
+                self._revalidations.discard(key)
+
     def _action_result_blobs_still_exist(self, action_result):
         """Checks CAS for ActionResult output blobs existance.
 
@@ -148,30 +344,9 @@ class ReferenceCache:
         Returns:
             True if all referenced blobs are present in CAS, False otherwise.
         """
-        blobs_needed = []
-
-        for output_file in action_result.output_files:
-            blobs_needed.append(output_file.digest)
-
-        for output_directory in action_result.output_directories:
-            blobs_needed.append(output_directory.tree_digest)
-            tree = self.__storage.get_message(output_directory.tree_digest,
-                                              remote_execution_pb2.Tree)
-            if tree is None:
-                return False
-
-            for file_node in tree.root.files:
-                blobs_needed.append(file_node.digest)
-
-            for child in tree.children:
-                for file_node in child.files:
-                    blobs_needed.append(file_node.digest)
-
-        if action_result.stdout_digest.hash and not action_result.stdout_raw:
-            blobs_needed.append(action_result.stdout_digest)
-
-        if action_result.stderr_digest.hash and not action_result.stderr_raw:
-            blobs_needed.append(action_result.stderr_digest)
+        blobs_needed = get_action_result_blobs(self.__storage, self._tree_cache, action_result)
+        if blobs_needed is None:
+            return False
 
         missing = self.__storage.missing_blobs(blobs_needed)
         return len(missing) == 0
@@ -22,7 +22,8 @@ Schedules jobs.
 import bisect
 from datetime import timedelta
 import logging
-from threading import Lock
+import queue
+from threading import Lock, Thread
 
 from buildgrid._enums import LeaseState, OperationStage
 from buildgrid._exceptions import NotFoundError, UpdateNotAllowedError
@@ -34,7 +35,8 @@ class Scheduler:
 
     MAX_N_TRIES = 5
 
-    def __init__(self, data_store, action_cache=None, action_browser_url=False, monitor=False):
+    def __init__(self, data_store, action_cache=None, action_browser_url=False, monitor=False,
+                 cache_check_workers=0, cache_check_batch_size=100):
         self.__logger = logging.getLogger(__name__)
 
         self._instance_name = None
@@ -54,6 +56,16 @@ class Scheduler:
 
         self.data_store = data_store
 
+        # Jobs waiting for an action cache lookup, when done asynchronously:
+        self.__cache_check_queue = None
+        self._cache_check_batch_size = cache_check_batch_size
+        if self._action_cache is not None and cache_check_workers > 0:
+            self.__cache_check_queue = queue.Queue()
+            for _ in range(cache_check_workers):
+                Thread(target=self._cache_check_worker, daemon=True).start()
+
+        self._requeue_cache_checks()
+
         self._is_instrumented = False
         if monitor:
             self.activate_monitoring()
@@ -181,6 +193,11 @@ class Scheduler:
             skip_cache_lookup (bool): whether or not to look for pre-computed
                 result for the given action.
 
+        Note:
+            If the scheduler has cache check workers, the job is returned in
+            ``CACHE_CHECK`` stage and the action cache lookup happens in the
+            background.
+
         Returns:
             str: the newly created job's name.
         """
@@ -215,7 +232,14 @@ class Scheduler:
 
         operation_stage = None
 
-        if self._action_cache is not None and not skip_cache_lookup:
+        if self.__cache_check_queue is not None and not skip_cache_lookup:
+            operation_stage = OperationStage.CACHE_CHECK
+            self._update_job_operation_stage(job.name, operation_stage)
+            self.__cache_check_queue.put((job.name, action_digest))
+
+            return job.name
+
+        elif self._action_cache is not None and not skip_cache_lookup:
             try:
                 action_result = self._action_cache.get_action_result(job.action_digest)
 
@@ -522,6 +546,83 @@ class Scheduler:
 
     # --- Private API ---
 
+    def _requeue_cache_checks(self):
+        """Resumes jobs persisted in ``CACHE_CHECK`` stage by a previous run.
+
+        They get looked up again if there are cache check workers, and are
+        queued for execution otherwise.
+        """
+        for job in self.data_store.load_unfinished_jobs():
+            if job.operation_stage != OperationStage.CACHE_CHECK or job.cancelled:
+                continue
+
+            if self.__cache_check_queue is not None:
+                self.__cache_check_queue.put((job.name, job.action_digest))
+            else:
+                self.data_store.queue_job(job.name)
+                self._update_job_operation_stage(job.name, OperationStage.QUEUED)
+
+            self.__logger.info("Job left waiting for a cache check resumed: [%s]", job.name)
+
+    def _cache_check_worker(self):
+        """Resolves jobs in ``CACHE_CHECK`` stage, by batches when possible."""
+        while True:
+            batch = [self.__cache_check_queue.get()]
+            while len(batch) < self._cache_check_batch_size:
+                try:
+                    batch.append(self.__cache_check_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self._check_action_cache(batch)
+
+            except Exception:  # pylint: disable=broad-except
+                self.__logger.exception("Failed to resolve [%s] cache checks", len(batch))
+
+    def _check_action_cache(self, batch):
+        """Looks up results for `(job_name, action_digest)` pairs, completing
+        jobs on cache hits and queuing them for execution otherwise.
+        """
+        action_digests = [action_digest for _, action_digest in batch]
+
+        try:
+            if hasattr(self._action_cache, 'get_action_results'):
+                action_results = self._action_cache.get_action_results(action_digests)
+            else:
+                action_results = {}
+                for action_digest in action_digests:
+                    try:
+                        action_results[action_digest.hash] = (
+                            self._action_cache.get_action_result(action_digest))
+                    except NotFoundError:
+                        pass
+
+        except Exception:  # pylint: disable=broad-except
+            # Don't hold jobs back because of a failing cache, run them:
+            self.__logger.exception("Action cache lookup failed for [%s] jobs", len(batch))
+            action_results = {}
+
+        for job_name, action_digest in batch:
+            job = self.data_store.get_job_by_name(job_name)
+            if job is None or job.cancelled:
+                continue
+
+            action_result = action_results.get(action_digest.hash)
+            if action_result is not None:
+                self.__logger.debug("Job cache hit for action [%s]: [%s]",
+                                    action_digest.hash[:8], job_name)
+
+                job.set_cached_result(action_result)
+                self.data_store.store_response(job)
+                operation_stage = OperationStage.COMPLETED
+
+            else:
+                self.data_store.queue_job(job_name)
+                operation_stage = OperationStage.QUEUED
+
+            self._update_job_operation_stage(job_name, operation_stage)
+
     def _update_job_operation_stage(self, job_name, operation_stage):
         """Requests a stage transition for the job's :class:Operations.
 
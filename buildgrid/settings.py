@@ -33,6 +33,10 @@ HASH_LENGTH = HASH().digest_size * 2
 # min. value for the 'thread-pool-size' configuration key.
 MIN_THREAD_POOL_SIZE = 5
 
+# Time in seconds clients are told to wait before retrying requests
+# rejected for exceeding a concurrency limit:
+RESOURCE_EXHAUSTED_RETRY_DELAY = 1.0
+
 # Maximum number of client auth. credentials to cache:
 AUTH_CACHE_SIZE = 200
 
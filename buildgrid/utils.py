@@ -19,7 +19,7 @@ import os
 import socket
 import threading
 
-from buildgrid.settings import HASH, HASH_LENGTH, BROWSER_URL_FORMAT
+from buildgrid.settings import HASH, HASH_LENGTH, BROWSER_URL_FORMAT, MAX_REQUEST_SIZE
 from buildgrid._protos.build.bazel.remote.execution.v2 import remote_execution_pb2
 
 
@@ -144,6 +144,30 @@ def create_digest(bytes_to_digest):
                                        size_bytes=len(bytes_to_digest))
 
 
+def create_digest_from_file(file_path):
+    """Computes the :obj:`Digest` of a file's content.
+
+    The file is read and hashed chunk by chunk, never loaded in memory as a
+    whole.
+
+    Args:
+        file_path (str): path to the file to digest.
+
+    Returns:
+        :obj:`Digest`: The :obj:`Digest` for the file's content.
+
+    Raises:
+        OSError: If `file_path` does not exist or is not readable.
+    """
+    hasher, size_bytes = HASH(), 0
+    with open(file_path, 'rb') as byte_file:
+        for chunk in iter(lambda: byte_file.read(MAX_REQUEST_SIZE), b''):
+            hasher.update(chunk)
+            size_bytes += len(chunk)
+
+    return remote_execution_pb2.Digest(hash=hasher.hexdigest(), size_bytes=size_bytes)
+
+
 def parse_digest(digest_string):
     """Creates a :obj:`Digest` from a digest string.
 
@@ -196,12 +220,15 @@ def write_file(file_path, content):
         byte_file.flush()
 
 
-def merkle_tree_maker(directory_path):
+def merkle_tree_maker(directory_path, file_blobs=True):
     """Walks a local folder tree, generating :obj:`FileNode` and
     :obj:`DirectoryNode`.
 
     Args:
         directory_path (str): absolute or relative path to a local directory.
+        file_blobs (bool, optional): whether or not to load files' content in
+            memory. If ``False``, files are hashed chunk by chunk and ``None``
+            is yielded in place of their blob. Defaults to ``True``.
 
     Yields:
         :obj:`Message`, bytes, str: a tutple of either a :obj:`FileNode` or
@@ -222,8 +249,12 @@ def merkle_tree_maker(directory_path):
             node_name, node_path = directory_entry.name, directory_entry.path
 
             if directory_entry.is_file(follow_symlinks=False):
-                node_blob = read_file(directory_entry.path)
-                node_digest = create_digest(node_blob)
+                if file_blobs:
+                    node_blob = read_file(directory_entry.path)
+                    node_digest = create_digest(node_blob)
+                else:
+                    node_blob = None
+                    node_digest = create_digest_from_file(directory_entry.path)
 
                 node = remote_execution_pb2.FileNode()
                 node.name = node_name
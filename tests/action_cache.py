@@ -15,17 +15,29 @@
 # pylint: disable=redefined-outer-name
 
 
+from unittest import mock
+from unittest.mock import patch
+
+import os
+import tempfile
+import time
+
 import boto3
+import fakeredis
 import grpc
 import pytest
 
 from buildgrid._exceptions import NotFoundError
 from buildgrid._protos.build.bazel.remote.execution.v2 import remote_execution_pb2
+from buildgrid.server.actioncache.cachingaction import CachingActionCache
 from buildgrid.server.actioncache.instance import ActionCache
 from buildgrid.server.actioncache.remote import RemoteActionCache
 from buildgrid.server.actioncache.s3storage import S3ActionCache
+from buildgrid.server.actioncache.sqlstorage import SQLActionCache
 from buildgrid.server.actioncache.writeonceaction import WriteOnceActionCache
 from buildgrid.server.cas.storage import lru_memory_cache
+from buildgrid.server.cas.tree_cache import TreeCache
+from buildgrid.utils import create_digest
 from moto import mock_s3
 
 from .utils.action_cache import serve_cache
@@ -71,11 +83,17 @@ def test_expiry(cas):
     assert cache.get_action_result(action_digest3) is not None
 
 
-@pytest.mark.parametrize('acType', ['memory', 's3', 'write_once'])
+@pytest.mark.parametrize('acType', ['memory', 's3', 'sql', 'redis', 'write_once', 'caching'])
 @mock_s3
-def test_checks_cas(acType, cas):
+def test_checks_cas(acType, cas, tmpdir):
     if acType == 'memory':
         cache = ActionCache(cas, 50)
+    elif acType == 'redis':
+        with patch('buildgrid.server.actioncache.redisstorage.redis.Redis', fakeredis.FakeRedis):
+            from buildgrid.server.actioncache.redisstorage import RedisActionCache
+            cache = RedisActionCache(cas, host="localhost", port=8000, db=0)
+    elif acType == 'sql':
+        cache = SQLActionCache(cas, 50, "sqlite:///%s" % tmpdir.join('ac.db'), automigrate=True)
     elif acType == 's3':
         auth_args = {"aws_access_key_id": "access_key",
                      "aws_secret_access_key": "secret_key"}
@@ -85,6 +103,9 @@ def test_checks_cas(acType, cas):
     elif acType == 'write_once':
         underlying_cache = ActionCache(cas, 50)
         cache = WriteOnceActionCache(underlying_cache)
+    elif acType == 'caching':
+        underlying_cache = ActionCache(cas, 50)
+        cache = CachingActionCache(underlying_cache, 50)
 
     action_digest1 = remote_execution_pb2.Digest(hash='alpha', size_bytes=4)
     action_digest2 = remote_execution_pb2.Digest(hash='bravo', size_bytes=4)
@@ -124,6 +145,342 @@ def test_checks_cas(acType, cas):
         cache.get_action_result(action_digest3)
 
 
+def test_sql_expiry(cas, tmpdir):
+    cache = SQLActionCache(cas, 2, "sqlite:///%s" % tmpdir.join('ac.db'), automigrate=True,
+                           access_batch_size=1, eviction_interval=1)
+
+    action_digest1 = remote_execution_pb2.Digest(hash='alpha', size_bytes=4)
+    action_digest2 = remote_execution_pb2.Digest(hash='bravo', size_bytes=4)
+    action_digest3 = remote_execution_pb2.Digest(hash='charlie', size_bytes=4)
+    dummy_result = remote_execution_pb2.ActionResult()
+
+    cache.update_action_result(action_digest1, dummy_result)
+    cache.update_action_result(action_digest2, dummy_result)
+
+    # Get digest 1 (making 2 the least recently used)
+    assert cache.get_action_result(action_digest1) is not None
+    # Add digest 3 (so 2 gets removed from the cache)
+    cache.update_action_result(action_digest3, dummy_result)
+
+    assert cache.get_action_result(action_digest1) is not None
+    with pytest.raises(NotFoundError):
+        cache.get_action_result(action_digest2)
+
+    assert cache.get_action_result(action_digest3) is not None
+
+
+def test_sql_eviction_interval(cas, tmpdir):
+    cache = SQLActionCache(cas, 1, "sqlite:///%s" % tmpdir.join('ac.db'), automigrate=True,
+                           eviction_interval=2)
+
+    action_digests = [remote_execution_pb2.Digest(hash=name, size_bytes=4)
+                      for name in ('alpha', 'bravo', 'charlie')]
+    dummy_result = remote_execution_pb2.ActionResult()
+
+    # The cache size is only checked every other update:
+    cache.update_action_result(action_digests[0], dummy_result)
+    cache.update_action_result(action_digests[1], dummy_result)
+    with pytest.raises(NotFoundError):
+        cache.get_action_result(action_digests[0])
+
+    cache.update_action_result(action_digests[2], dummy_result)
+    assert cache.get_action_result(action_digests[1]) is not None
+    assert cache.get_action_result(action_digests[2]) is not None
+
+
+def test_sql_get_action_results(cas, tmpdir):
+    cache = SQLActionCache(cas, 50, "sqlite:///%s" % tmpdir.join('ac.db'), automigrate=True,
+                           inclause_limit=2)
+
+    sample_digest = cas.put_message(remote_execution_pb2.Command(arguments=["sample"]))
+    action_digests = [remote_execution_pb2.Digest(hash=name, size_bytes=4)
+                      for name in ('alpha', 'bravo', 'charlie', 'delta', 'echo')]
+
+    for action_digest in action_digests[:3]:
+        action_result = remote_execution_pb2.ActionResult()
+        action_result.output_files.add().digest.CopyFrom(sample_digest)
+        cache.update_action_result(action_digest, action_result)
+
+    # An entry whose outputs are gone is dropped:
+    action_result = remote_execution_pb2.ActionResult()
+    action_result.stdout_digest.hash = "nonexistent"
+    action_result.stdout_digest.size_bytes = 8
+    cache.update_action_result(action_digests[3], action_result)
+
+    action_results = cache.get_action_results(action_digests)
+
+    assert set(action_results) == {'alpha', 'bravo', 'charlie'}
+    assert action_results['alpha'].output_files[0].digest == sample_digest
+
+    with pytest.raises(NotFoundError):
+        cache.get_action_result(action_digests[3])
+
+
+@pytest.mark.parametrize('max_inline_size', [0, 64 * 1024])
+def test_redis_get_action_results(cas, max_inline_size):
+    with patch('buildgrid.server.actioncache.redisstorage.redis.Redis', fakeredis.FakeRedis):
+        from buildgrid.server.actioncache.redisstorage import RedisActionCache
+        cache = RedisActionCache(cas, ttl=60, max_inline_size=max_inline_size,
+                                 host="localhost", port=8000, db=0)
+    cache._client.flushall()
+
+    sample_digest = cas.put_message(remote_execution_pb2.Command(arguments=["sample"]))
+    action_digests = [remote_execution_pb2.Digest(hash=name, size_bytes=4)
+                      for name in ('alpha', 'bravo', 'charlie')]
+
+    action_result = remote_execution_pb2.ActionResult()
+    action_result.output_files.add().digest.CopyFrom(sample_digest)
+    cache.update_action_result(action_digests[0], action_result)
+    cache.update_action_result(action_digests[1], action_result)
+
+    # Entries are stored in CAS only when too large to be inlined:
+    result_digest = cas.put_message(action_result)
+    cas.delete_blob(result_digest)
+    cache.update_action_result(action_digests[0], action_result)
+    assert cas.has_blob(result_digest) == (max_inline_size == 0)
+
+    action_results = cache.get_action_results(action_digests)
+    assert set(action_results) == {'alpha', 'bravo'}
+    assert action_results['alpha'].output_files[0].digest == sample_digest
+
+    assert 0 < cache._client.ttl(cache._get_key(action_digests[0])) <= 60
+
+
+def test_caching_action_cache(cas):
+    underlying_cache = mock.Mock(wraps=ActionCache(cas, 50))
+    cache = CachingActionCache(underlying_cache, 2, ttl=60, negative_ttl=0.5)
+
+    action_digest1 = remote_execution_pb2.Digest(hash='alpha', size_bytes=4)
+    action_digest2 = remote_execution_pb2.Digest(hash='bravo', size_bytes=4)
+    action_digest3 = remote_execution_pb2.Digest(hash='charlie', size_bytes=4)
+    dummy_result = remote_execution_pb2.ActionResult(exit_code=1)
+
+    cache.update_action_result(action_digest1, dummy_result)
+
+    # Hits are answered locally:
+    assert cache.get_action_result(action_digest1) == dummy_result
+    assert cache.get_action_result(action_digest1) == dummy_result
+    assert underlying_cache.get_action_result.call_count == 1
+
+    # So are misses, until they expire:
+    with pytest.raises(NotFoundError):
+        cache.get_action_result(action_digest2)
+    underlying_cache.update_action_result(action_digest2, dummy_result)
+    with pytest.raises(NotFoundError):
+        cache.get_action_result(action_digest2)
+    assert underlying_cache.get_action_result.call_count == 2
+
+    time.sleep(0.5)
+    assert cache.get_action_result(action_digest2) == dummy_result
+    assert underlying_cache.get_action_result.call_count == 3
+
+    # Updates made through the cache are seen straight away:
+    cache.update_action_result(action_digest1, remote_execution_pb2.ActionResult())
+    assert cache.get_action_result(action_digest1).exit_code == 0
+
+    # Only the most recently used lookups are kept:
+    results = cache.get_action_results([action_digest1, action_digest2, action_digest3])
+    assert set(results) == {'alpha', 'bravo'}
+    assert underlying_cache.get_action_result.call_count == 5
+    assert cache.get_action_result(action_digest2) == dummy_result
+    assert cache.get_action_result(action_digest1).exit_code == 0
+    assert underlying_cache.get_action_result.call_count == 6
+
+
+@mock_s3
+def test_s3_inline_results(cas):
+    auth_args = {"aws_access_key_id": "access_key",
+                 "aws_secret_access_key": "secret_key"}
+    boto3.resource('s3', **auth_args).create_bucket(Bucket='cachebucket')
+    cache = S3ActionCache(cas, bucket='cachebucket', access_key="access_key", secret_key="secret_key",
+                          max_inline_size=1024)
+
+    action_digest1 = remote_execution_pb2.Digest(hash='alpha', size_bytes=4)
+    action_digest2 = remote_execution_pb2.Digest(hash='bravo', size_bytes=4)
+    small_result = remote_execution_pb2.ActionResult(exit_code=1)
+    large_result = remote_execution_pb2.ActionResult(stdout_raw=b'x' * 2048)
+
+    cache.update_action_result(action_digest1, small_result)
+    cache.update_action_result(action_digest2, large_result)
+
+    # Only large results go to CAS:
+    assert not cas.has_blob(create_digest(small_result.SerializeToString()))
+    assert cas.has_blob(create_digest(large_result.SerializeToString()))
+    assert cache.get_action_result(action_digest1) == small_result
+    assert cache.get_action_result(action_digest2) == large_result
+
+    # Entries written without inlining are still read:
+    cache._update_cache_key(action_digest1, cas.put_message(small_result).SerializeToString())
+    assert cache.get_action_result(action_digest1) == small_result
+
+    # Nothing gets inlined by default, not even empty results:
+    cache = S3ActionCache(cas, bucket='cachebucket', access_key="access_key", secret_key="secret_key")
+    empty_result = remote_execution_pb2.ActionResult()
+    cache.update_action_result(action_digest1, empty_result)
+    stored_value = boto3.resource('s3', **auth_args).Object('cachebucket', 'alpha_4').get()['Body'].read()
+    assert stored_value == create_digest(b'').SerializeToString()
+    assert cache.get_action_result(action_digest1) == empty_result
+
+
+def test_freshness_window(cas):
+    cache = ActionCache(cas, 50, freshness_window=60)
+
+    action_digest = remote_execution_pb2.Digest(hash='alpha', size_bytes=4)
+
+    sample_digest = cas.put_message(remote_execution_pb2.Command(arguments=["sample"]))
+    action_result = remote_execution_pb2.ActionResult()
+    action_result.output_files.add().digest.CopyFrom(sample_digest)
+    cache.update_action_result(action_digest, action_result)
+
+    assert cache.get_action_result(action_digest) == action_result
+
+    # Recently validated results are served without checking CAS:
+    with mock.patch.object(cas, 'get_message') as get_message:
+        with mock.patch.object(cas, 'missing_blobs') as missing_blobs:
+            assert cache.get_action_result(action_digest) == action_result
+            assert not get_message.called
+            assert not missing_blobs.called
+
+    # Hits close to expiry revalidate the entry in the background:
+    cas.delete_blob(sample_digest)
+    with mock.patch('time.monotonic', return_value=time.monotonic() + 50):
+        assert cache.get_action_result(action_digest) == action_result
+
+    for _ in range(100):
+        if action_digest.hash not in [key[0] for key in cache._digest_map]:
+            break
+        time.sleep(0.01)
+    with pytest.raises(NotFoundError):
+        cache.get_action_result(action_digest)
+
+
+def test_snapshot(cas):
+    action_digests = [remote_execution_pb2.Digest(hash=name, size_bytes=4)
+                      for name in ['alpha', 'bravo', 'charlie']]
+    action_results = [remote_execution_pb2.ActionResult(exit_code=code) for code in range(3)]
+
+    with tempfile.TemporaryDirectory() as path:
+        snapshot_path = os.path.join(path, 'action-cache')
+
+        cache = ActionCache(cas, 2, snapshot_path=snapshot_path)
+        cache.update_action_result(action_digests[0], action_results[0])
+        cache.update_action_result(action_digests[1], action_results[1])
+        cache.save_snapshot()
+
+        # Updates made after the snapshot are recovered from the journal:
+        cache.update_action_result(action_digests[2], action_results[2])
+
+        restarted_cache = ActionCache(cas, 2, snapshot_path=snapshot_path)
+        with pytest.raises(NotFoundError):
+            restarted_cache.get_action_result(action_digests[0])
+        assert restarted_cache.get_action_result(action_digests[1]) == action_results[1]
+        assert restarted_cache.get_action_result(action_digests[2]) == action_results[2]
+
+        # Without journal, only the snapshot is restored:
+        cache = ActionCache(cas, 2, snapshot_path=snapshot_path, snapshot_journal=False)
+        cache.save_snapshot()
+        cache.update_action_result(action_digests[0], action_results[0])
+
+        restarted_cache = ActionCache(cas, 2, snapshot_path=snapshot_path, snapshot_journal=False)
+        with pytest.raises(NotFoundError):
+            restarted_cache.get_action_result(action_digests[0])
+        assert restarted_cache.get_action_result(action_digests[2]) == action_results[2]
+
+        # Stopping the cache saves a last snapshot:
+        cache.stop()
+        restarted_cache = ActionCache(cas, 2, snapshot_path=snapshot_path, snapshot_journal=False)
+        assert restarted_cache.get_action_result(action_digests[0]) == action_results[0]
+        restarted_cache.stop()
+
+
+def test_snapshot_escapes_keys(cas):
+    action_digests = [remote_execution_pb2.Digest(hash=name, size_bytes=4)
+                      for name in ['with/slash', 'with\ttab', 'with\nnewline\t+\tinjected/1\tdeadbeef/1']]
+    action_result = remote_execution_pb2.ActionResult(exit_code=0)
+
+    with tempfile.TemporaryDirectory() as path:
+        snapshot_path = os.path.join(path, 'action-cache')
+
+        cache = ActionCache(cas, 50, snapshot_path=snapshot_path)
+        cache.update_action_result(action_digests[0], action_result)
+        cache.save_snapshot()
+        for action_digest in action_digests[1:]:
+            cache.update_action_result(action_digest, action_result)
+
+        restarted_cache = ActionCache(cas, 50, snapshot_path=snapshot_path)
+        assert list(restarted_cache._digest_map) == [(digest.hash, digest.size_bytes)
+                                                     for digest in action_digests]
+        for action_digest in action_digests:
+            assert restarted_cache.get_action_result(action_digest) == action_result
+
+        for stopped_cache in (cache, restarted_cache):
+            stopped_cache.stop()
+
+
+def test_tree_cache(cas):
+    tree_cache = TreeCache(16)
+    cache = ActionCache(cas, 50, tree_cache=tree_cache)
+
+    action_digest = remote_execution_pb2.Digest(hash='alpha', size_bytes=4)
+
+    sample_digest = cas.put_message(remote_execution_pb2.Command(arguments=["sample"]))
+    tree = remote_execution_pb2.Tree()
+    tree.root.files.add().digest.CopyFrom(sample_digest)
+    tree_digest = cas.put_message(tree)
+
+    action_result = remote_execution_pb2.ActionResult()
+    action_result.output_directories.add().tree_digest.CopyFrom(tree_digest)
+    cache.update_action_result(action_digest, action_result)
+
+    assert cache.get_action_result(action_digest) == action_result
+    assert tree_cache.get(remote_execution_pb2.Tree, tree_digest) == (sample_digest,)
+
+    # Later lookups don't fetch the output tree again:
+    with mock.patch.object(cas, 'get_message', wraps=cas.get_message) as get_message:
+        assert cache.get_action_result(action_digest) == action_result
+        fetched_types = [call[0][1] for call in get_message.call_args_list]
+        assert remote_execution_pb2.Tree not in fetched_types
+
+    # Blobs referenced by cached trees are still checked for existence:
+    cas.delete_blob(sample_digest)
+    with pytest.raises(NotFoundError):
+        cache.get_action_result(action_digest)
+
+
+def test_tree_cache_eviction():
+    tree_cache = TreeCache(3)
+
+    tree_digests = [remote_execution_pb2.Digest(hash=name, size_bytes=1) for name in 'abc']
+    blob_digests = [remote_execution_pb2.Digest(hash=name, size_bytes=1) for name in 'xyz']
+
+    tree_cache.put(remote_execution_pb2.Tree, tree_digests[0], blob_digests[:2])
+    tree_cache.put(remote_execution_pb2.Tree, tree_digests[1], blob_digests[:1])
+    assert tree_cache.get(remote_execution_pb2.Tree, tree_digests[0]) is not None
+    # Entries are keyed by message type:
+    assert tree_cache.get(remote_execution_pb2.Directory, tree_digests[0]) is None
+
+    # Going over the limit evicts the least recently used entry:
+    tree_cache.put(remote_execution_pb2.Tree, tree_digests[2], blob_digests[:1])
+    assert tree_cache.get(remote_execution_pb2.Tree, tree_digests[0]) is not None
+    assert tree_cache.get(remote_execution_pb2.Tree, tree_digests[1]) is None
+    assert tree_cache.get(remote_execution_pb2.Tree, tree_digests[2]) is not None
+
+    # Entries bigger than the whole cache are never stored:
+    tree_cache.put(remote_execution_pb2.Tree, tree_digests[1], blob_digests * 2)
+    assert tree_cache.get(remote_execution_pb2.Tree, tree_digests[1]) is None
+
+    # Entries without digests count against the limit too:
+    for tree_digest in tree_digests:
+        tree_cache.put(remote_execution_pb2.Directory, tree_digest, [])
+    assert len(tree_cache._entries) == 3
+    assert tree_cache.get(remote_execution_pb2.Tree, tree_digests[0]) is None
+
+    # A zero limit disables caching, even of empty trees:
+    tree_cache = TreeCache(0)
+    tree_cache.put(remote_execution_pb2.Directory, tree_digests[0], [])
+    assert tree_cache.get(remote_execution_pb2.Directory, tree_digests[0]) is None
+
+
 def test_remote_update():
 
     def __test_update():
@@ -15,6 +15,7 @@
 # pylint: disable=redefined-outer-name
 
 
+from concurrent import futures
 from copy import deepcopy
 import os
 import tempfile
@@ -24,6 +25,9 @@ import pytest
 
 from buildgrid.client.cas import download, upload
 from buildgrid._protos.build.bazel.remote.execution.v2 import remote_execution_pb2
+from buildgrid.server.cas.instance import ByteStreamInstance
+from buildgrid.server.cas.service import ByteStreamService
+from buildgrid.server.cas.storage.lru_memory_cache import LRUMemoryCache
 from buildgrid.utils import create_digest
 
 from ..utils.cas import serve_cas
@@ -157,6 +161,32 @@ def test_upload_file(instance, file_paths):
             assert server.compare_files(digest, file_path)
 
 
+@pytest.mark.parametrize('file_paths', FILES)
+@pytest.mark.parametrize('instance', INTANCES)
+def test_upload_files(instance, file_paths):
+    # Actual test function, to be run in a subprocess:
+    def __test_upload_files(queue, remote, instance, file_paths):
+        # Open a channel to the remote CAS server:
+        channel = grpc.insecure_channel(remote)
+
+        with upload(channel, instance) as uploader:
+            digests = uploader.upload_files(file_paths, queue=len(file_paths) > 1)
+
+        queue.put([digests[file_path].SerializeToString() for file_path in file_paths])
+
+    # Start a minimal CAS server in a subprocess:
+    with serve_cas([instance]) as server:
+        digests = run_in_subprocess(__test_upload_files,
+                                    server.remote, instance, file_paths)
+
+        for file_path, digest_blob in zip(file_paths, digests):
+            digest = remote_execution_pb2.Digest()
+            digest.ParseFromString(digest_blob)
+
+            assert server.has(digest)
+            assert server.compare_files(digest, file_path)
+
+
 @pytest.mark.parametrize('directory_paths', DIRECTORIES)
 @pytest.mark.parametrize('instance', INTANCES)
 def test_upload_directory(instance, directory_paths):
@@ -368,3 +398,72 @@ def test_download_directory(instance, folder_paths):
 
             for digest, path in zip(digests, paths):
                 assert server.compare_directories(digest, path)
+
+
+class _FlakyByteStreamService(ByteStreamService):
+    """ByteStream service dropping every transfer's first request midway."""
+
+    def __init__(self, server):
+        super().__init__(server)
+
+        self.read_offsets, self.write_offsets = [], []
+
+    def Read(self, request, context):
+        self.read_offsets.append(request.read_offset)
+
+        for index, response in enumerate(super().Read(request, context)):
+            if request.read_offset == 0 and index == 1:
+                context.abort(grpc.StatusCode.UNAVAILABLE, "Connection dropped")
+
+            yield response
+
+    def Write(self, requests, context):
+        first_request = next(requests)
+        self.write_offsets.append(first_request.write_offset)
+
+        def __requests():
+            yield first_request
+            if first_request.write_offset == 0:
+                raise grpc.RpcError()
+            yield from requests
+
+        try:
+            return super().Write(__requests(), context)
+        except grpc.RpcError:
+            context.abort(grpc.StatusCode.UNAVAILABLE, "Connection dropped")
+
+
+def test_resume_interrupted_transfers():
+    storage = LRUMemoryCache(64 * 1024 * 1024)
+
+    server = grpc.server(futures.ThreadPoolExecutor(4))
+    bytestream_service = _FlakyByteStreamService(server)
+    bytestream_service.add_instance('', ByteStreamInstance(storage))
+    port = server.add_insecure_port('localhost:0')
+    server.start()
+
+    channel = grpc.insecure_channel('localhost:{}'.format(port))
+    try:
+        blob = os.urandom(5 * 1024 * 1024)
+
+        with upload(channel, backoff=0) as uploader:
+            digest = uploader.put_blob(blob)
+
+        assert storage.get_blob(digest).read() == blob
+        # The write got resumed after the first request:
+        assert len(bytestream_service.write_offsets) == 2
+        assert bytestream_service.write_offsets[1] > 0
+
+        with download(channel, backoff=0) as downloader:
+            assert downloader.get_blob(digest) == blob
+
+        # The read got resumed after the first response:
+        assert bytestream_service.read_offsets == [0, ByteStreamInstance.BLOCK_SIZE]
+
+        with download(channel, retries=0) as downloader:
+            with pytest.raises(ConnectionError):
+                downloader.get_blob(digest)
+
+    finally:
+        channel.close()
+        server.stop(None)
@@ -16,6 +16,7 @@
 
 
 import io
+import time
 from unittest import mock
 
 import grpc
@@ -29,6 +30,7 @@ from buildgrid.server.cas.storage.storage_abc import StorageABC
 from buildgrid.server.cas.instance import ByteStreamInstance, ContentAddressableStorageInstance
 from buildgrid.server.cas import service
 from buildgrid.server.cas.service import ByteStreamService, ContentAddressableStorageService
+from buildgrid.server.cas.tree_cache import TreeCache
 from buildgrid.settings import HASH
 
 
@@ -44,7 +46,6 @@ class SimpleStorage(StorageABC):
 
     def __init__(self, existing_data=None):
         self.data = {}
-        self.map_data = existing_data
         if existing_data:
             for datum in existing_data:
                 self.data[(HASH(datum).hexdigest(), len(datum))] = datum
@@ -72,12 +73,6 @@ class SimpleStorage(StorageABC):
         assert len(data) == digest.size_bytes
         self.data[(digest.hash, digest.size_bytes)] = data
 
-    def get_message(self, digest, message_type):
-        datum = self.data[(digest.hash, digest.size_bytes)]
-        message = re_pb2.Directory()
-        message.directories.extend(self.map_data[datum])
-        return message
-
 
 test_strings = [b"", b"hij"]
 instances = ["", "test_inst"]
@@ -179,6 +174,101 @@ def test_bytestream_write_rejects_wrong_hash(mocked):
     assert not storage.data
 
 
+@pytest.mark.parametrize("instance", instances)
+@mock.patch.object(service, 'bytestream_pb2_grpc', autospec=True)
+def test_bytestream_resume_write(mocked, instance):
+    storage = SimpleStorage()
+
+    bs_instance = ByteStreamInstance(storage)
+    servicer = ByteStreamService(server)
+    servicer.add_instance(instance, bs_instance)
+
+    resource_name = ""
+    if instance != "":
+        resource_name = instance + "/"
+    hash_ = HASH(b'abcdef').hexdigest()
+    resource_name += "uploads/UUID-HERE/blobs/{}/6".format(hash_)
+
+    def __interrupted_requests():
+        yield bytestream_pb2.WriteRequest(resource_name=resource_name, data=b'abc')
+        raise grpc.RpcError()
+
+    with pytest.raises(grpc.RpcError):
+        servicer.Write(__interrupted_requests(), context)
+
+    request = bytestream_pb2.QueryWriteStatusRequest(resource_name=resource_name)
+    response = servicer.QueryWriteStatus(request, context)
+    assert response.committed_size == 3
+    assert not response.complete
+
+    # Writes must resume from the committed size:
+    requests = [
+        bytestream_pb2.WriteRequest(
+            resource_name=resource_name, data=b'cdef', write_offset=2, finish_write=True)
+    ]
+
+    context.reset_mock()
+    servicer.Write(iter(requests), context)
+    context.set_code.assert_called_once_with(grpc.StatusCode.INVALID_ARGUMENT)
+
+    requests = [
+        bytestream_pb2.WriteRequest(
+            resource_name=resource_name, data=b'def', write_offset=3, finish_write=True)
+    ]
+
+    response = servicer.Write(iter(requests), context)
+    assert response.committed_size == 6
+    assert storage.data[(hash_, 6)] == b'abcdef'
+
+    response = servicer.QueryWriteStatus(request, context)
+    assert response.committed_size == 6
+    assert response.complete
+
+
+@pytest.mark.parametrize("instance", instances)
+@mock.patch.object(service, 'bytestream_pb2_grpc', autospec=True)
+def test_bytestream_write_sessions_limits(mocked, instance):
+    storage = SimpleStorage()
+
+    bs_instance = ByteStreamInstance(storage, max_write_sessions_size=4, write_session_timeout=10)
+    servicer = ByteStreamService(server)
+    servicer.add_instance(instance, bs_instance)
+
+    prefix = ""
+    if instance != "":
+        prefix = instance + "/"
+
+    def __interrupt_write(upload_uuid, data):
+        resource_name = prefix + "uploads/{}/blobs/{}/{}".format(
+            upload_uuid, HASH(data + data).hexdigest(), 2 * len(data))
+
+        def __interrupted_requests():
+            yield bytestream_pb2.WriteRequest(resource_name=resource_name, data=data)
+            raise grpc.RpcError()
+
+        with pytest.raises(grpc.RpcError):
+            servicer.Write(__interrupted_requests(), context)
+
+        return bytestream_pb2.QueryWriteStatusRequest(resource_name=resource_name)
+
+    def __is_kept(request):
+        context.reset_mock()
+        servicer.QueryWriteStatus(request, context)
+        return not context.set_code.called
+
+    # Oldest writes are dropped once over the size limit:
+    first_request = __interrupt_write('UUID-1', b'abc')
+    second_request = __interrupt_write('UUID-2', b'def')
+    assert not __is_kept(first_request)
+    assert __is_kept(second_request)
+
+    # Writes are dropped if not resumed in time:
+    with mock.patch('time.monotonic', return_value=time.monotonic() + 100):
+        third_request = __interrupt_write('UUID-3', b'g')
+    assert not __is_kept(second_request)
+    assert __is_kept(third_request)
+
+
 @pytest.mark.parametrize("instance", instances)
 @mock.patch.object(service, 'remote_execution_pb2_grpc', autospec=True)
 def test_cas_find_missing_blobs(mocked, instance):
@@ -276,6 +366,12 @@ def test_cas_batch_read_blobs(mocked, instance):
                 assert response.status.code == code_pb2.NOT_FOUND
 
 
+def _directory_node(name, directory):
+    directory_blob = directory.SerializeToString()
+    digest = re_pb2.Digest(hash=HASH(directory_blob).hexdigest(), size_bytes=len(directory_blob))
+    return re_pb2.DirectoryNode(name=name, digest=digest), directory_blob
+
+
 @pytest.mark.parametrize("instance", instances)
 @mock.patch.object(service, 'remote_execution_pb2_grpc', autospec=True)
 def test_cas_get_tree(mocked, instance):
@@ -285,33 +381,122 @@ def test_cas_get_tree(mocked, instance):
            |--subParentDir
               |--subChildDir
     '''
-    root = re_pb2.Digest(hash=HASH(b'abc').hexdigest(), size_bytes=3)
-    rootDir = re_pb2.DirectoryNode(name=b'abc', digest=root)
-    digest1 = re_pb2.Digest(hash=HASH(b'def').hexdigest(), size_bytes=3)
-    subEmptyDir = re_pb2.DirectoryNode(name=b'def', digest=digest1)
-    digest2 = re_pb2.Digest(hash=HASH(b'ghi').hexdigest(), size_bytes=3)
-    subParentDir = re_pb2.DirectoryNode(name=b'ghi', digest=digest2)
-    digest3 = re_pb2.Digest(hash=HASH(b'xyz').hexdigest(), size_bytes=3)
-    subChildDir = re_pb2.DirectoryNode(name=b'xyz', digest=digest3)
-
-    storage = SimpleStorage({b'abc': [subEmptyDir, subParentDir], b'def': [],
-                            b'ghi': [subChildDir], b'xyz': []})
+    expectedChild = re_pb2.Directory(files=[re_pb2.FileNode(name='child')])
+    subChildDir, childBlob = _directory_node('xyz', expectedChild)
+    expectedParent = re_pb2.Directory(directories=[subChildDir])
+    subParentDir, parentBlob = _directory_node('ghi', expectedParent)
+    expectedEmpty = re_pb2.Directory()
+    subEmptyDir, emptyBlob = _directory_node('def', expectedEmpty)
+    expectedRoot = re_pb2.Directory(directories=[subEmptyDir, subParentDir])
+    rootDir, rootBlob = _directory_node('abc', expectedRoot)
+
+    storage = SimpleStorage([rootBlob, emptyBlob, parentBlob, childBlob])
     cas_instance = ContentAddressableStorageInstance(storage)
     servicer = ContentAddressableStorageService(server)
     servicer.add_instance(instance, cas_instance)
 
     request = re_pb2.GetTreeRequest(
-        instance_name=instance, root_digest=root)
+        instance_name=instance, root_digest=rootDir.digest)
     result = []
     for response in servicer.GetTree(request, context):
         result.extend(response.directories)
 
-    expectedRoot = re_pb2.Directory()
-    expectedRoot.directories.extend([subEmptyDir, subParentDir])
-    expectedEmpty = re_pb2.Directory()
-    expectedParent = re_pb2.Directory()
-    expectedParent.directories.extend([subChildDir])
-    expectedChild = re_pb2.Directory()
-
     expected = [expectedRoot, expectedEmpty, expectedParent, expectedChild]
     assert result == expected
+
+
+@pytest.mark.parametrize("instance", instances)
+@mock.patch.object(service, 'remote_execution_pb2_grpc', autospec=True)
+def test_cas_get_tree_pagination(mocked, instance):
+    '''Directory Structure:
+        |--root
+           |--subDirA
+           |  |--subLeafDir
+           |--subDirB
+              |--subLeafDir
+    '''
+    expectedLeaf = re_pb2.Directory(files=[re_pb2.FileNode(name='leaf')])
+    subLeafDir, leafBlob = _directory_node('leaf', expectedLeaf)
+    expectedA = re_pb2.Directory(directories=[subLeafDir])
+    subDirA, aBlob = _directory_node('a', expectedA)
+    expectedB = re_pb2.Directory(directories=[subLeafDir], files=[re_pb2.FileNode(name='b')])
+    subDirB, bBlob = _directory_node('b', expectedB)
+    expectedRoot = re_pb2.Directory(directories=[subDirA, subDirB])
+    rootDir, rootBlob = _directory_node('root', expectedRoot)
+
+    storage = SimpleStorage([rootBlob, aBlob, bBlob, leafBlob])
+    cas_instance = ContentAddressableStorageInstance(storage)
+    servicer = ContentAddressableStorageService(server)
+    servicer.add_instance(instance, cas_instance)
+
+    request = re_pb2.GetTreeRequest(
+        instance_name=instance, root_digest=rootDir.digest, page_size=2)
+    responses = list(servicer.GetTree(request, context))
+
+    # The shared subtree is only returned once:
+    result = [directory for response in responses for directory in response.directories]
+    assert result == [expectedRoot, expectedA, expectedB, expectedLeaf]
+
+    assert [len(response.directories) for response in responses] == [2, 2]
+    assert responses[0].next_page_token
+    assert not responses[-1].next_page_token
+
+    # Page tokens do not grow with the tree's width:
+    assert responses[0].next_page_token == '{}/{}/2'.format(rootDir.digest.hash,
+                                                            rootDir.digest.size_bytes)
+
+    # Walking can be resumed from a page token:
+    request.page_token = responses[0].next_page_token
+    result = []
+    for response in servicer.GetTree(request, context):
+        result.extend(response.directories)
+    assert result == [expectedB, expectedLeaf]
+
+    # Page tokens are only valid for the tree they were issued for:
+    request.root_digest.CopyFrom(subDirA.digest)
+    context.reset_mock()
+    list(servicer.GetTree(request, context))
+    context.set_code.assert_called_once_with(grpc.StatusCode.INVALID_ARGUMENT)
+
+
+@pytest.mark.parametrize("instance", instances)
+@mock.patch.object(service, 'remote_execution_pb2_grpc', autospec=True)
+def test_cas_get_tree_cached(mocked, instance):
+    expectedLeaf = re_pb2.Directory(files=[re_pb2.FileNode(name='leaf')])
+    subLeafDir, leafBlob = _directory_node('leaf', expectedLeaf)
+    expectedParent = re_pb2.Directory(directories=[subLeafDir])
+    subParentDir, parentBlob = _directory_node('parent', expectedParent)
+    expectedRoot = re_pb2.Directory(directories=[subParentDir])
+    rootDir, rootBlob = _directory_node('root', expectedRoot)
+
+    storage = SimpleStorage([rootBlob, parentBlob, leafBlob])
+    cas_instance = ContentAddressableStorageInstance(storage, tree_cache=TreeCache(16))
+    servicer = ContentAddressableStorageService(server)
+    servicer.add_instance(instance, cas_instance)
+
+    request = re_pb2.GetTreeRequest(
+        instance_name=instance, root_digest=rootDir.digest)
+    expected = [expectedRoot, expectedParent, expectedLeaf]
+
+    with mock.patch.object(storage, 'bulk_read_blobs', wraps=storage.bulk_read_blobs) as bulk_read_blobs:
+        result = [directory for response in servicer.GetTree(request, context)
+                  for directory in response.directories]
+        assert result == expected
+        # One fetch per tree level:
+        assert bulk_read_blobs.call_count == 3
+
+    with mock.patch.object(storage, 'bulk_read_blobs', wraps=storage.bulk_read_blobs) as bulk_read_blobs:
+        result = [directory for response in servicer.GetTree(request, context)
+                  for directory in response.directories]
+        assert result == expected
+        # All directories are fetched at once:
+        assert bulk_read_blobs.call_count == 1
+
+    # Resumed walks skip returned directories straight away:
+    request.page_size = 1
+    request.page_token = list(servicer.GetTree(request, context))[1].next_page_token
+    with mock.patch.object(storage, 'bulk_read_blobs', wraps=storage.bulk_read_blobs) as bulk_read_blobs:
+        result = [directory for response in servicer.GetTree(request, context)
+                  for directory in response.directories]
+        assert result == expected[2:]
+        assert bulk_read_blobs.call_args[0][0] == [subLeafDir.digest]
@@ -15,7 +15,10 @@
 # pylint: disable=redefined-outer-name
 
 
+import os
 import tempfile
+import threading
+import time
 
 import boto3
 import grpc
@@ -30,6 +33,7 @@ from buildgrid.server.cas.storage.remote import RemoteStorage
 from buildgrid.server.cas.storage.lru_memory_cache import LRUMemoryCache
 from buildgrid.server.cas.storage.disk import DiskStorage
 from buildgrid.server.cas.storage.s3 import S3Storage
+from buildgrid.server.cas.storage.sharded import ShardedStorage
 from buildgrid.server.cas.storage.with_cache import WithCacheStorage
 from buildgrid.server.cas.storage.index.sql import SQLIndex
 from buildgrid.settings import HASH
@@ -44,7 +48,8 @@ BLOBS_DIGESTS = [tuple([remote_execution_pb2.Digest(hash=HASH(blob).hexdigest(),
                  for blobs in BLOBS]
 
 
-@pytest.fixture(params=['lru', 'disk', 's3', 'lru_disk', 'disk_s3', 'remote', 'redis', 'sql_index'])
+@pytest.fixture(params=['lru', 'disk', 's3', 'lru_disk', 'disk_s3', 'remote', 'redis', 'sql_index',
+                        'sharded'])
 def any_storage(request):
     if request.param == 'lru':
         yield LRUMemoryCache(256)
@@ -90,6 +95,9 @@ def any_storage(request):
                 storage=storage,
                 connection_string="sqlite:///%s" % db.name,
                 automigrate=True)
+    elif request.param == 'sharded':
+        shards = {'shard-{}'.format(index): LRUMemoryCache(256) for index in range(3)}
+        yield ShardedStorage(shards, replication_factor=2)
 
 
 def write(storage, digest, blob):
@@ -370,3 +378,182 @@ def test_with_cache(blobs_digests):
     assert cache.has_blob(digest3)
     assert cache.get_blob(digest3).read() == blob3
     assert cache.has_blob(digest3)
+
+
+@pytest.mark.parametrize('blobs_digests', [(BLOBS[0], BLOBS_DIGESTS[0])])
+def test_with_cache_write_back(blobs_digests):
+    blobs, digests = blobs_digests
+    blob1, blob2, *_ = blobs
+    digest1, digest2, *_ = digests
+
+    cache = LRUMemoryCache(256)
+    fallback = LRUMemoryCache(256)
+    with_cache_storage = WithCacheStorage(cache, fallback, write_back=True,
+                                          write_back_backoff=0.01)
+
+    # Hold the fallback back, then fail the first upload attempt:
+    fallback_unblocked = threading.Event()
+    fallback_begin_write = fallback.begin_write
+
+    def __blocking_begin_write(digest):
+        fallback_unblocked.wait()
+        if __blocking_begin_write.failed:
+            return fallback_begin_write(digest)
+        __blocking_begin_write.failed = True
+        raise IOError()
+    __blocking_begin_write.failed = False
+
+    with patch.object(fallback, 'begin_write', side_effect=__blocking_begin_write):
+        write(with_cache_storage, digest1, blob1)
+        assert cache.has_blob(digest1)
+        assert not fallback.has_blob(digest1)
+
+        # Pending writes are reported as present:
+        assert with_cache_storage.has_blob(digest1)
+        assert with_cache_storage.missing_blobs([digest1, digest2]) == [digest2]
+        assert with_cache_storage.get_blob(digest1).read() == blob1
+
+        fallback_unblocked.set()
+        with_cache_storage.wait_for_pending_writes()
+
+    # The write made it to the fallback after a retry:
+    assert __blocking_begin_write.failed
+    assert with_cache_storage.pending_writes_count == 0
+    assert fallback.get_blob(digest1).read() == blob1
+
+    results = with_cache_storage.bulk_update_blobs([(digest2, blob2)])
+    assert results[0].code == 0
+    with_cache_storage.wait_for_pending_writes()
+    assert fallback.get_blob(digest2).read() == blob2
+
+
+@pytest.mark.parametrize('blobs_digests', [(BLOBS[0], BLOBS_DIGESTS[0])])
+def test_with_cache_write_back_failures(blobs_digests):
+    blobs, digests = blobs_digests
+    blob1, blob2, *_ = blobs
+    digest1, digest2, *_ = digests
+
+    cache = LRUMemoryCache(256)
+    fallback = LRUMemoryCache(256)
+
+    with tempfile.TemporaryDirectory() as path:
+        journal_path = os.path.join(path, 'journal')
+
+        # Uploads failing every retry, even reading from the cache, stay pending:
+        with patch.object(cache, 'get_blob', side_effect=IOError()):
+            with_cache_storage = WithCacheStorage(cache, fallback, write_back=True,
+                                                  write_back_retries=0, write_back_retry_period=60,
+                                                  write_back_journal=journal_path)
+            write(with_cache_storage, digest1, blob1)
+            write(with_cache_storage, digest2, blob2)
+            with_cache_storage.wait_for_pending_writes()
+
+        assert with_cache_storage.pending_writes_count == 2
+        assert with_cache_storage.missing_blobs([digest1, digest2]) == []
+        assert not fallback.has_blob(digest1)
+        assert not fallback.has_blob(digest2)
+
+        # Writers are still running, deleted blobs are not uploaded anymore:
+        with_cache_storage.delete_blob(digest2)
+        write(with_cache_storage, digest2, blob2)
+        with_cache_storage.wait_for_pending_writes()
+        assert fallback.get_blob(digest2).read() == blob2
+
+        # Pending uploads resume after a restart:
+        with_cache_storage = WithCacheStorage(cache, fallback, write_back=True,
+                                              write_back_journal=journal_path)
+        assert with_cache_storage.has_blob(digest1)
+        for _ in range(100):
+            if with_cache_storage.pending_writes_count == 0:
+                break
+            time.sleep(0.01)
+        assert fallback.get_blob(digest1).read() == blob1
+
+        with open(journal_path) as journal:
+            assert journal.read() == ''
+
+
+@pytest.mark.parametrize('blobs_digests', [(BLOBS[0], BLOBS_DIGESTS[0])])
+def test_with_cache_read_through(blobs_digests):
+    blobs, digests = blobs_digests
+    blob1, blob2, blob3, *_ = blobs
+    digest1, digest2, digest3, *_ = digests
+
+    cache = LRUMemoryCache(256)
+    fallback = LRUMemoryCache(256)
+    with_cache_storage = WithCacheStorage(cache, fallback, trust_cache=True,
+                                          background_promotion=True)
+
+    # Blobs in cache are reported present without querying the fallback:
+    write(cache, digest1, blob1)
+    with patch.object(fallback, 'missing_blobs', wraps=fallback.missing_blobs) as missing_blobs:
+        assert with_cache_storage.has_blob(digest1)
+        assert with_cache_storage.missing_blobs([digest1, digest2]) == [digest2]
+        missing_blobs.assert_called_once_with([digest2])
+
+        assert with_cache_storage.missing_blobs([digest1]) == []
+        missing_blobs.assert_called_once_with([digest2])
+
+    # Partially reading a blob promotes it in the background:
+    write(fallback, digest3, blob3)
+    blob = with_cache_storage.get_blob(digest3)
+    assert blob.read(1) == blob3[:1]
+    blob.close()
+
+    for _ in range(100):
+        if cache.has_blob(digest3):
+            break
+        time.sleep(0.01)
+    assert cache.get_blob(digest3).read() == blob3
+
+    # Bulk reads promote the blobs they fetched without downloading them again:
+    write(fallback, digest2, blob2)
+    with patch.object(fallback, 'get_blob', wraps=fallback.get_blob) as get_blob:
+        blobmap = with_cache_storage.bulk_read_blobs([digest2, digest3])
+        assert {blob_hash: blob.read() for blob_hash, blob in blobmap.items()} == {
+            digest2.hash: blob2, digest3.hash: blob3}
+
+        for _ in range(100):
+            if cache.has_blob(digest2):
+                break
+            time.sleep(0.01)
+        # Only the bulk read fetched it:
+        get_blob.assert_called_once_with(digest2)
+    assert cache.get_blob(digest2).read() == blob2
+
+
+@pytest.mark.parametrize('blobs_digests', [(BLOBS[0], BLOBS_DIGESTS[0])])
+def test_sharded_replication(blobs_digests):
+    blobs, digests = blobs_digests
+
+    shards = {'shard-{}'.format(index): LRUMemoryCache(256) for index in range(4)}
+    sharded_storage = ShardedStorage(shards, replication_factor=2)
+
+    for blob, digest in zip(blobs, digests):
+        write(sharded_storage, digest, blob)
+
+    # Every blob is stored on exactly two shards:
+    for digest in digests:
+        holders = [name for name, shard in shards.items() if shard.has_blob(digest)]
+        assert len(holders) == 2
+        assert sorted(holders) == sorted(sharded_storage._replicas_for(digest))
+
+    # Losing a replica doesn't lose the blob, and reading it repairs the replica:
+    blob, digest = blobs[0], digests[0]
+    primary, secondary = sharded_storage._replicas_for(digest)
+    shards[primary].delete_blob(digest)
+
+    assert sharded_storage.has_blob(digest)
+    assert not sharded_storage.missing_blobs([digest])
+    assert sharded_storage.get_blob(digest).read() == blob
+
+    for _ in range(100):
+        if shards[primary].has_blob(digest):
+            break
+        time.sleep(0.01)
+    assert shards[primary].get_blob(digest).read() == blob
+
+    # Placement only depends on shard names:
+    reordered_storage = ShardedStorage(dict(reversed(list(shards.items()))), replication_factor=2)
+    for digest in digests:
+        assert reordered_storage._replicas_for(digest) == sharded_storage._replicas_for(digest)
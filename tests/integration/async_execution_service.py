@@ -0,0 +1,113 @@
+# Copyright (C) 2019 Bloomberg LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  <http://www.apache.org/licenses/LICENSE-2.0>
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# pylint: disable=redefined-outer-name
+
+
+import asyncio
+import queue
+import sys
+import uuid
+from unittest import mock
+
+import grpc
+import pytest
+
+if sys.version_info < (3, 6):
+    pytest.skip("grpc.aio servicers require Python >= 3.6", allow_module_level=True)
+
+# pylint: disable=wrong-import-position
+from buildgrid._enums import OperationStage
+from buildgrid._protos.build.bazel.remote.execution.v2 import remote_execution_pb2
+from buildgrid._protos.google.longrunning import operations_pb2
+from buildgrid.server import job
+from buildgrid.server.execution import service
+from buildgrid.server.execution.async_service import AsyncExecutionService
+
+from .execution_service import action, action_digest, context, controller, server  # pylint: disable=unused-import
+
+
+@pytest.fixture(params=["mem", "sql"])
+def async_instance(controller, request):
+    with mock.patch.object(service, 'remote_execution_pb2_grpc'):
+        execution_service = AsyncExecutionService(server)
+        execution_service.add_instance("", controller.execution_instance)
+        yield execution_service
+
+
+def _run_until_first_response(response):
+    async def __first_response():
+        try:
+            return await response.__anext__()
+        finally:
+            await response.aclose()
+
+    return asyncio.get_event_loop().run_until_complete(__first_response())
+
+
+@pytest.mark.parametrize("skip_cache_lookup", [True, False])
+def test_async_execute(skip_cache_lookup, async_instance, context):
+    request = remote_execution_pb2.ExecuteRequest(instance_name='',
+                                                  action_digest=action_digest,
+                                                  skip_cache_lookup=skip_cache_lookup)
+    with mock.patch.object(async_instance, '_rpc_termination_callback',
+                           wraps=async_instance._rpc_termination_callback) as termination_callback:
+        result = _run_until_first_response(async_instance.Execute(request, context))
+
+    assert isinstance(result, operations_pb2.Operation)
+    metadata = remote_execution_pb2.ExecuteOperationMetadata()
+    result.metadata.Unpack(metadata)
+    assert metadata.stage == OperationStage.QUEUED.value
+    operation_uuid = result.name.split('/')[-1]
+    assert uuid.UUID(operation_uuid, version=4)
+    assert result.done is False
+
+    # Closing the stream unregisters the peer:
+    termination_callback.assert_called_once_with(context.peer(), '', operation_uuid)
+
+
+def test_async_wrong_execute_instance(async_instance, context):
+    request = remote_execution_pb2.ExecuteRequest(instance_name='blade')
+    _run_until_first_response(async_instance.Execute(request, context))
+
+    context.set_code.assert_called_once_with(grpc.StatusCode.INVALID_ARGUMENT)
+
+
+def test_async_wait_execution(async_instance, controller, context):
+    scheduler = controller.execution_instance._scheduler
+
+    job_name = scheduler.queue_job_action(action, action_digest, skip_cache_lookup=True)
+
+    message_queue = queue.Queue()
+    operation_name = controller.execution_instance.register_job_peer(job_name,
+                                                                     context.peer(),
+                                                                     message_queue)
+
+    scheduler._update_job_operation_stage(job_name, OperationStage.COMPLETED)
+
+    request = remote_execution_pb2.WaitExecutionRequest(name=operation_name)
+    result = _run_until_first_response(async_instance.WaitExecution(request, context))
+
+    assert isinstance(result, operations_pb2.Operation)
+    metadata = remote_execution_pb2.ExecuteOperationMetadata()
+    result.metadata.Unpack(metadata)
+    assert metadata.stage == job.OperationStage.COMPLETED.value
+    assert result.done is True
+
+
+def test_async_wrong_instance_wait_execution(async_instance, context):
+    request = remote_execution_pb2.WaitExecutionRequest(name="blade")
+    _run_until_first_response(async_instance.WaitExecution(request, context))
+
+    context.set_code.assert_called_once_with(grpc.StatusCode.INVALID_ARGUMENT)
@@ -16,6 +16,7 @@
 
 
 import asyncio
+import threading
 
 import grpc
 import pytest
@@ -187,3 +188,60 @@ def test_cancel_leases(instance):
                 pass
 
         assert session.get_pb2().leases[0].state == LeaseState.CANCELLED.value
+
+
+def test_session_updates_do_not_block_tenants():
+    work_release = threading.Event()
+    update_release = threading.Event()
+
+    def __work(lease, context, event):
+        work_release.wait(TIMEOUT)
+        return lease
+
+    class BlockingInterface:
+        interval = TIMEOUT
+        executing_interval = 60
+
+        def __init__(self):
+            self.updates = []
+            self.update_released = None
+
+        def create_bot_session(self, parent, bot_session):
+            bot_session.name = 'bots/session'
+            bot_session.leases.add(id='foo', state=LeaseState.PENDING.value)
+            return bot_session
+
+        def update_bot_session(self, bot_session, update_mask=None):
+            self.updates.append(bot_session)
+            # Long-polls until released:
+            if self.update_released is None:
+                self.update_released = update_release.wait(TIMEOUT)
+            del bot_session.leases[:]
+            return bot_session
+
+    interface = BlockingInterface()
+    session = BotSession('', interface, HardwareInterface(Worker()), __work)
+
+    async def __drive(session_task):
+        await asyncio.sleep(0.1)
+        assert not interface.updates
+
+        # Completions get reported without waiting for `executing_interval`:
+        work_release.set()
+        while not interface.updates:
+            await asyncio.sleep(0.05)
+        assert interface.updates[0].leases[0].state == LeaseState.COMPLETED.value
+
+        # The loop keeps running while the update is pending:
+        update_release.set()
+        while interface.update_released is None:
+            await asyncio.sleep(0.05)
+
+        session_task.cancel()
+
+    loop = asyncio.get_event_loop()
+    session_task = asyncio.ensure_future(session.run())
+    loop.run_until_complete(asyncio.wait_for(__drive(session_task), TIMEOUT))
+    loop.run_until_complete(session_task)
+
+    assert interface.update_released
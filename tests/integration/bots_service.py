@@ -243,6 +243,32 @@ def test_update_leases_with_work(bot_session, context, instance):
     assert response_action == action_digest
 
 
+def test_update_leases_with_completed_work(bot_session, context, instance):
+    request = bots_pb2.CreateBotSessionRequest(parent='',
+                                               bot_session=bot_session)
+
+    action_digests = [remote_execution_pb2.Digest(hash='gaff'),
+                      remote_execution_pb2.Digest(hash='baff')]
+    for action_digest in action_digests:
+        _inject_work(instance._instances[""]._scheduler, action_digest=action_digest)
+
+    response = instance.CreateBotSession(request, context)
+
+    assert len(response.leases) == 1
+    completed_lease_id = response.leases[0].id
+
+    response.leases[0].state = LeaseState.COMPLETED.value
+    request = bots_pb2.UpdateBotSessionRequest(name=response.name,
+                                               bot_session=response)
+
+    response = instance.UpdateBotSession(request, context)
+
+    # The next lease is handed out along with the completion acknowledgement:
+    assert len(response.leases) == 1
+    assert response.leases[0].id != completed_lease_id
+    assert response.leases[0].state == LeaseState.PENDING.value
+
+
 def test_post_bot_event_temp(context, instance):
     request = bots_pb2.PostBotEventTempRequest()
     instance.PostBotEventTemp(request, context)
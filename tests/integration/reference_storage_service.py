@@ -15,6 +15,8 @@
 # pylint: disable=redefined-outer-name
 
 
+import os
+import tempfile
 from unittest import mock
 
 import grpc
@@ -111,3 +113,35 @@ def test_status(allow_updates, context):
     response = instance.Status(request, context)
 
     assert response.allow_updates == allow_updates
+
+
+def test_snapshot(cas):
+    keys = ["plain", "with\ttab", "with\nnewline\t+\tinjected\tdeadbeef/1", "100%"]
+    reference_result = remote_execution_pb2.Digest(hash='deckard')
+
+    with tempfile.TemporaryDirectory() as path:
+        snapshot_path = os.path.join(path, 'refs')
+
+        cache = ReferenceCache(cas, 50, snapshot_path=snapshot_path)
+        for key in keys[:2]:
+            cache.update_reference(key, reference_result)
+
+        # A failed save loses no entry:
+        with mock.patch('os.fsync', side_effect=OSError):
+            with pytest.raises(OSError):
+                cache.save_snapshot()
+        for key in keys[2:]:
+            cache.update_reference(key, reference_result)
+
+        restarted_cache = ReferenceCache(cas, 50, snapshot_path=snapshot_path)
+        assert list(restarted_cache._digest_map) == keys
+        for key in keys:
+            assert restarted_cache.get_digest_reference(key) == reference_result
+
+        restarted_cache.save_snapshot()
+        restarted_cache = ReferenceCache(cas, 50, snapshot_path=snapshot_path)
+        assert list(restarted_cache._digest_map) == keys
+
+        for stopped_cache in (cache, restarted_cache):
+            stopped_cache.stop()
+            assert not stopped_cache._snapshot_thread.is_alive()
@@ -0,0 +1,166 @@
+# Copyright (C) 2019 Bloomberg LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  <http://www.apache.org/licenses/LICENSE-2.0>
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=redefined-outer-name
+
+
+import os
+import signal
+import sys
+import time
+from unittest import mock
+
+import pytest
+
+from buildgrid._app.commands import cmd_server
+from buildgrid._app.settings import parser
+
+
+CONFIGURATION = """
+server:
+  - !channel
+    port: 50051
+    insecure-mode: true
+
+instances:
+  - name: main
+
+    storages:
+      - !lru-storage &main-storage
+        size: 256mb
+
+    services:
+{services}
+"""
+
+
+def _load_configuration(services):
+    return parser.get_parser().safe_load(CONFIGURATION.format(services=services))
+
+
+@pytest.fixture
+def restore_signals():
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGINT, signal.SIGTERM)}
+    yield
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+
+IN_MEMORY_SERVICES = [
+    """
+      - !action-cache
+        storage: *main-storage
+        max-cached-refs: 256
+    """,
+    """
+      - !caching-action-cache
+        action-cache: !action-cache
+          storage: *main-storage
+          max-cached-refs: 256
+        max-cached-refs: 256
+    """,
+    """
+      - !write-once-action-cache
+        action-cache: !caching-action-cache
+          action-cache: !action-cache
+            storage: *main-storage
+            max-cached-refs: 256
+          max-cached-refs: 256
+    """,
+    """
+      - !reference-cache
+        storage: *main-storage
+        max-cached-refs: 256
+    """,
+]
+
+
+@pytest.mark.parametrize('services', IN_MEMORY_SERVICES)
+def test_workers_refuse_in_memory_caches(services, capsys):
+    configuration = _load_configuration(services)
+
+    # A single worker may keep its caches in memory:
+    with mock.patch.object(cmd_server, 'Server') as server_class:
+        cmd_server._create_server_from_config(configuration, workers=1)
+    assert 'reuse_port' not in server_class.call_args[1]
+
+    with mock.patch.object(cmd_server, 'Server') as server_class:
+        with pytest.raises(SystemExit):
+            cmd_server._create_server_from_config(configuration, workers=2)
+    assert not server_class.called
+    assert "keeps its entries in memory" in capsys.readouterr().err
+
+
+def test_workers_refuse_scheduler_services(capsys):
+    configuration = _load_configuration("""
+      - !execution
+        storage: *main-storage
+    """)
+
+    with mock.patch.object(cmd_server, 'Server') as server_class:
+        with pytest.raises(SystemExit):
+            cmd_server._create_server_from_config(configuration, workers=2)
+    assert not server_class.called
+    assert "cannot be served by multiple workers" in capsys.readouterr().err
+
+
+def test_workers_warn_about_in_memory_storage(capsys):
+    configuration = _load_configuration("""
+      - !cas
+        storage: *main-storage
+    """)
+
+    with mock.patch.object(cmd_server, 'Server') as server_class:
+        cmd_server._create_server_from_config(configuration, workers=2)
+    assert server_class.call_args[1]['reuse_port']
+    assert "Warning: Configuration, in-memory storage" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('max_requests', [0, -1, 'many'])
+def test_invalid_concurrency_limits(max_requests, capsys):
+    configuration = _load_configuration("""
+      - !cas
+        storage: *main-storage
+    """)
+    configuration['concurrency-limits'] = {'cas': max_requests}
+
+    with pytest.raises(SystemExit):
+        cmd_server._create_server_from_config(configuration)
+    assert "Error: Configuration" in capsys.readouterr().err
+
+
+def test_start_workers(tmpdir, restore_signals):
+    # Workers serve in forked processes, stopping cleanly:
+    with mock.patch.object(cmd_server, '_serve', return_value=None):
+        assert cmd_server._start_workers('server.conf', 3) == 0
+
+
+def test_start_workers_failure(tmpdir, restore_signals):
+    marker = str(tmpdir.join('failed'))
+
+    def __serve(config, workers):
+        assert (config, workers) == ('server.conf', 2)
+        try:
+            os.close(os.open(marker, os.O_CREAT | os.O_EXCL))
+        except FileExistsError:
+            # The other worker keeps serving until it gets stopped:
+            time.sleep(60)
+            return
+        sys.exit(3)
+
+    # A failing worker stops the other ones, its exit code being returned:
+    start_time = time.monotonic()
+    with mock.patch.object(cmd_server, '_serve', side_effect=__serve):
+        assert cmd_server._start_workers('server.conf', 2) == 3
+    assert time.monotonic() - start_time < 30
@@ -13,6 +13,8 @@
 # limitations under the License.
 
 
+import os
+import sys
 import time
 
 import grpc
@@ -29,11 +31,21 @@ from buildgrid._protos.google.devtools.remoteworkers.v1test2 import bots_pb2
 from buildgrid._protos.google.devtools.remoteworkers.v1test2 import bots_pb2_grpc
 from buildgrid._protos.google.longrunning import operations_pb2
 from buildgrid._protos.google.longrunning import operations_pb2_grpc
+from buildgrid.server._authentication import AuthMetadataMethod, AuthMetadataAlgorithm
+from buildgrid.utils import create_digest
 
 from .utils.utils import run_in_subprocess
 from .utils.server import serve
 
 
+try:
+    import jwt  # pylint: disable=unused-import
+except ImportError:
+    HAVE_JWT = False
+else:
+    HAVE_JWT = True
+
+
 CONFIGURATION = """
 server:
   - !channel
@@ -195,3 +207,69 @@ def test_create_server(monitoring):
             # and also one from after the bot had made its initial connection
             assert "main.instance.bots-count:0|g" in metrics
             assert "main.instance.bots-count:1|g" in metrics
+
+
+@pytest.mark.skipif(sys.version_info < (3, 6), reason="No grpc.aio support")
+@pytest.mark.skipif(not HAVE_JWT, reason="No pyjwt")
+def test_create_aio_server():
+    # Actual test function, to be run in a subprocess:
+    def __test_create_aio_server(queue, remote, token):
+        channel = grpc.insecure_channel(remote)
+        metadata = (('authorization', 'Bearer {}'.format(token)),)
+        results = {}
+
+        command = remote_execution_pb2.Command(arguments=['true'])
+        command_digest = create_digest(command.SerializeToString())
+        action = remote_execution_pb2.Action(command_digest=command_digest, do_not_cache=True)
+        action_digest = create_digest(action.SerializeToString())
+
+        stub = remote_execution_pb2_grpc.ContentAddressableStorageStub(channel)
+        request = remote_execution_pb2.BatchUpdateBlobsRequest(instance_name='main')
+        for message, digest in ((command, command_digest), (action, action_digest)):
+            request.requests.add(digest=digest, data=message.SerializeToString())
+        stub.BatchUpdateBlobs(request, metadata=metadata)
+
+        stub = remote_execution_pb2_grpc.ExecutionStub(channel)
+        request = remote_execution_pb2.ExecuteRequest(instance_name='main',
+                                                      action_digest=action_digest,
+                                                      skip_cache_lookup=True)
+        try:
+            next(stub.Execute(request))
+        except grpc.RpcError as e:
+            results['execute-unauthenticated'] = e.code()
+
+        execute_responses = stub.Execute(request, metadata=metadata)
+        operation = next(execute_responses)
+        results['execute'] = operation.name
+
+        request = remote_execution_pb2.WaitExecutionRequest(name=operation.name)
+        wait_responses = stub.WaitExecution(request, metadata=metadata)
+        results['wait-execution'] = next(wait_responses).name
+
+        wait_responses.cancel()
+        execute_responses.cancel()
+
+        # Synchronous, limited, handlers run in the server's thread pool:
+        stub = remote_execution_pb2_grpc.ActionCacheStub(channel)
+        request = remote_execution_pb2.GetActionResultRequest(instance_name='main',
+                                                              action_digest=action_digest)
+        try:
+            stub.GetActionResult(request, metadata=metadata)
+        except grpc.RpcError as e:
+            results['get-action-result'] = e.code()
+
+        queue.put(results)
+
+    with open(os.path.join(os.path.dirname(__file__), 'auth', 'data', 'jwt-hs256-valid.token')) as f:
+        token = f.read().strip()
+
+    with serve(CONFIGURATION, grpc_aio=True,
+               auth_method=AuthMetadataMethod.JWT, auth_secret='your-256-bit-secret',
+               auth_algorithm=AuthMetadataAlgorithm.JWT_HS256,
+               concurrency_limits={'action-cache': 1}) as (server, _):
+        results = run_in_subprocess(__test_create_aio_server, server.remote, token)
+
+    assert results['execute-unauthenticated'] == grpc.StatusCode.UNAUTHENTICATED
+    assert results['execute'].startswith('main/')
+    assert results['wait-execution'] == results['execute']
+    assert results['get-action-result'] == grpc.StatusCode.NOT_FOUND
@@ -0,0 +1,211 @@
+# Copyright (C) 2019 Bloomberg LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  <http://www.apache.org/licenses/LICENSE-2.0>
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# pylint: disable=redefined-outer-name
+
+
+from concurrent import futures
+import os
+import tempfile
+from unittest import mock
+
+import grpc
+import pytest
+
+from buildgrid.bot.cas_cache import LocalCASCache
+from buildgrid.client.cas import download
+from buildgrid.server.cas.instance import ByteStreamInstance, ContentAddressableStorageInstance
+from buildgrid.server.cas.service import ByteStreamService, ContentAddressableStorageService
+from buildgrid.server.cas.storage.lru_memory_cache import LRUMemoryCache
+from buildgrid.utils import create_digest_from_file, merkle_tree_maker
+
+
+DATA_DIR = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), 'cas', 'data')
+
+
+@pytest.fixture
+def cas():
+    storage = LRUMemoryCache(256 * 1024 * 1024)
+
+    server = grpc.server(futures.ThreadPoolExecutor(4))
+    ByteStreamService(server).add_instance('', ByteStreamInstance(storage))
+    ContentAddressableStorageService(server).add_instance(
+        '', ContentAddressableStorageInstance(storage))
+    port = server.add_insecure_port('localhost:0')
+    server.start()
+
+    channel = grpc.insecure_channel('localhost:{}'.format(port))
+    try:
+        yield storage, channel
+    finally:
+        channel.close()
+        server.stop(None)
+
+
+def _store_folder(storage, folder_path):
+    root_digest = None
+    for node, blob, _ in merkle_tree_maker(folder_path):
+        write_session = storage.begin_write(node.digest)
+        write_session.write(blob)
+        storage.commit_write(node.digest, write_session)
+        root_digest = node.digest
+    return root_digest
+
+
+def _compare_folders(expected_path, staged_path):
+    expected_entries = sorted(os.listdir(expected_path))
+    assert sorted(os.listdir(staged_path)) == expected_entries
+
+    for name in expected_entries:
+        expected_entry = os.path.join(expected_path, name)
+        staged_entry = os.path.join(staged_path, name)
+        if os.path.isdir(expected_entry):
+            _compare_folders(expected_entry, staged_entry)
+        else:
+            with open(expected_entry, 'rb') as expected, open(staged_entry, 'rb') as staged:
+                assert expected.read() == staged.read()
+            assert os.access(expected_entry, os.X_OK) == os.access(staged_entry, os.X_OK)
+
+
+def test_stage_directory(cas):
+    storage, channel = cas
+    root_digest = _store_folder(storage, DATA_DIR)
+
+    with tempfile.TemporaryDirectory() as cache_path:
+        cache = LocalCASCache(cache_path, 1024 * 1024 * 1024)
+
+        for _ in range(2):
+            staged_path = tempfile.mkdtemp(dir=cache.staging_path)
+            with download(channel) as downloader:
+                with mock.patch.object(downloader, 'download_file',
+                                       wraps=downloader.download_file) as download_file:
+                    cache.stage_directory(downloader, root_digest, staged_path)
+                    download_count = download_file.call_count
+
+            _compare_folders(DATA_DIR, staged_path)
+
+        # Everything is served from the cache the second time:
+        assert download_count == 0
+
+        # Cached blobs are picked up on restart:
+        size = cache.size
+        assert size > 0
+        assert LocalCASCache(cache_path, 1024 * 1024 * 1024).size == size
+
+
+def test_eviction(cas):
+    storage, channel = cas
+    root_digest = _store_folder(storage, DATA_DIR)
+
+    with tempfile.TemporaryDirectory() as cache_path:
+        cache = LocalCASCache(cache_path, 16)
+
+        staged_path = tempfile.mkdtemp(dir=cache.staging_path)
+        with download(channel) as downloader:
+            cache.stage_directory(downloader, root_digest, staged_path)
+
+        # Staged files survive eviction:
+        _compare_folders(DATA_DIR, staged_path)
+        assert cache.size <= 16
+
+
+def test_stage_directory_reusing_trees(cas):
+    storage, channel = cas
+    root_digest = _store_folder(storage, DATA_DIR)
+
+    with tempfile.TemporaryDirectory() as cache_path:
+        # Trees are only linked on request:
+        cache = LocalCASCache(cache_path, 1024 * 1024 * 1024, max_trees=8)
+        staged_path = tempfile.mkdtemp(dir=cache.staging_path)
+        with download(channel) as downloader:
+            cache.stage_directory(downloader, root_digest, staged_path)
+        assert not os.path.islink(os.path.join(staged_path, 'hello', 'docs'))
+
+    with tempfile.TemporaryDirectory() as cache_path:
+        cache = LocalCASCache(cache_path, 1024 * 1024 * 1024, max_trees=8, link_trees=True)
+
+        staged_paths = []
+        for _ in range(2):
+            staged_path = tempfile.mkdtemp(dir=cache.staging_path)
+            writable_paths = [os.path.join(staged_path, 'hello', 'utils')]
+            with download(channel) as downloader:
+                cache.stage_directory(downloader, root_digest, staged_path,
+                                      writable_paths=writable_paths)
+
+            _compare_folders(DATA_DIR, staged_path)
+            staged_paths.append(staged_path)
+
+        # Paths written to, and their parents, are staged for real:
+        for staged_path in staged_paths:
+            assert not os.path.islink(os.path.join(staged_path, 'hello'))
+            assert not os.path.islink(os.path.join(staged_path, 'hello', 'utils'))
+
+        # Other subtrees link to the same materialised copy:
+        docs_paths = [os.path.join(staged_path, 'hello', 'docs') for staged_path in staged_paths]
+        assert all(os.path.islink(docs_path) for docs_path in docs_paths)
+        assert os.readlink(docs_paths[0]) == os.readlink(docs_paths[1])
+
+        # Trees in use are not evicted:
+        cache._max_trees = 0
+        cache.release_directory(staged_paths[0])
+        _compare_folders(DATA_DIR, staged_paths[1])
+
+        cache.release_directory(staged_paths[1])
+        assert not os.path.exists(os.readlink(docs_paths[1]))
+
+
+@pytest.mark.parametrize('link_files', [True, False])
+def test_modified_blobs_fetched_again(cas, link_files):
+    storage, channel = cas
+    root_digest = _store_folder(storage, DATA_DIR)
+
+    def __stage(cache):
+        staged_path = tempfile.mkdtemp(dir=cache.staging_path)
+        with download(channel) as downloader:
+            with mock.patch.object(downloader, 'download_file',
+                                   wraps=downloader.download_file) as download_file:
+                cache.stage_directory(downloader, root_digest, staged_path)
+        _compare_folders(DATA_DIR, staged_path)
+        return staged_path, download_file.call_count
+
+    with tempfile.TemporaryDirectory() as cache_path:
+        cache = LocalCASCache(cache_path, 1024 * 1024 * 1024, link_files=link_files)
+        staged_path, _ = __stage(cache)
+
+        # An action writing to one of its inputs, read-only or not:
+        staged_file = os.path.join(staged_path, 'hello', 'hello.c')
+        os.chmod(staged_file, 0o644)
+        with open(staged_file, 'ab') as f:
+            f.write(b'// Modified')
+
+        # Only modified cached blobs are fetched again:
+        _, download_count = __stage(cache)
+        assert download_count == (1 if link_files else 0)
+
+        # Blobs cached by a previous run are hashed before being reused:
+        object_path = cache._object_path(
+            create_digest_from_file(os.path.join(DATA_DIR, 'hello', 'hello.h')).hash)
+        os.chmod(object_path, 0o644)
+        with open(object_path, 'r+b') as f:
+            first_byte = f.read(1)
+            f.seek(0)
+            f.write(b'_' if first_byte != b'_' else b'-')
+
+        cache = LocalCASCache(cache_path, 1024 * 1024 * 1024, link_files=link_files)
+        _, download_count = __stage(cache)
+        assert download_count == 1
+
+        _, download_count = __stage(cache)
+        assert download_count == 0
@@ -0,0 +1,57 @@
+# Copyright (C) 2019 Bloomberg LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  <http://www.apache.org/licenses/LICENSE-2.0>
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+from buildgrid.bot.output_capture import OutputCapture
+from buildgrid.utils import create_digest
+
+
+SCRIPT = "import sys; sys.stdout.write('x' * 10 * 1024 * 1024); sys.stderr.write('error')"
+
+
+@pytest.mark.parametrize('max_size', [None, 1024])
+def test_capture(max_size, tmpdir):
+    process = subprocess.Popen([sys.executable, '-c', SCRIPT],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    chunks = []
+    with OutputCapture(process.stdout, 'stdout', directory=str(tmpdir), max_size=max_size,
+                       callback=chunks.append) as stdout:
+        with OutputCapture(process.stderr, 'stderr', directory=str(tmpdir)) as stderr:
+            assert process.wait() == 0
+            assert stdout.wait(timeout=10) and stderr.wait(timeout=10)
+
+            expected_stdout = b'x' * 10 * 1024 * 1024
+            if max_size is not None:
+                assert stdout.truncated
+                expected_stdout = expected_stdout[:max_size]
+
+            assert stdout.read() == expected_stdout
+            assert stdout.digest == create_digest(expected_stdout)
+            assert stderr.read() == b'error'
+            assert stderr.digest == create_digest(b'error')
+
+            # Callbacks get everything, discarded data included:
+            assert b''.join(chunks) == b'x' * 10 * 1024 * 1024
+
+            spool_path = stdout.path
+            assert os.path.dirname(spool_path) == str(tmpdir)
+
+    assert not os.path.exists(spool_path)
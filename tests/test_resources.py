@@ -0,0 +1,90 @@
+# Copyright (C) 2019 Bloomberg LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  <http://www.apache.org/licenses/LICENSE-2.0>
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# pylint: disable=redefined-outer-name
+
+
+from concurrent import futures
+from unittest import mock
+
+import grpc
+from grpc._server import _Context
+import pytest
+
+from buildgrid.server._resources import ConcurrencyLimit, limit
+
+
+@pytest.fixture
+def context():
+    cxt = mock.MagicMock(spec=_Context)
+    cxt.abort.side_effect = Exception("aborted")
+    yield cxt
+
+
+def test_unlimited():
+    concurrency_limit = ConcurrencyLimit('test')
+    concurrency_limit.init(None)
+
+    for _ in range(100):
+        assert concurrency_limit.request_worker()
+    assert concurrency_limit.query_n_rejected_requests() == 0
+
+
+def test_limit_is_thread_safe():
+    concurrency_limit = ConcurrencyLimit('test')
+    concurrency_limit.init(500)
+
+    def __request_and_release():
+        for _ in range(1000):
+            assert concurrency_limit.request_worker()
+            concurrency_limit.release_worker()
+
+    with futures.ThreadPoolExecutor(8) as executor:
+        for future in [executor.submit(__request_and_release) for _ in range(8)]:
+            future.result()
+
+    assert concurrency_limit.busy_workers == 0
+
+
+def test_requests_over_limit_are_rejected(context):
+    concurrency_limit = ConcurrencyLimit('test')
+    concurrency_limit.init(2)
+
+    class Servicer:
+        @limit(concurrency_limit)
+        def Method(self, request, context):
+            return request
+
+    servicer = Servicer()
+    assert servicer.Method(1, context) == 1
+    assert servicer.Method(2, context) == 2
+    assert concurrency_limit.busy_workers == 2
+
+    with pytest.raises(Exception):
+        servicer.Method(3, context)
+
+    context.abort.assert_called_once()
+    assert context.abort.call_args[0][0] == grpc.StatusCode.RESOURCE_EXHAUSTED
+    trailing_metadata = dict(context.set_trailing_metadata.call_args[0][0])
+    assert int(trailing_metadata['grpc-retry-pushback-ms']) > 0
+
+    assert concurrency_limit.query_n_rejected_requests() == 1
+    assert concurrency_limit.query_n_rejected_requests() == 0
+
+    # Termination callbacks release the workers:
+    for call in context.add_callback.call_args_list:
+        call[0][0]()
+    assert concurrency_limit.busy_workers == 0
+
+    assert servicer.Method(4, context) == 4
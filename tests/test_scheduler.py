@@ -19,6 +19,8 @@ import copy
 import os
 import queue
 import tempfile
+import threading
+import time
 from unittest import mock
 
 import grpc
@@ -209,3 +211,113 @@ def test_requeue_queued_job(controller, context):
     job = scheduler.data_store.get_job_by_name(job_name)
     assert job.lease in leases
     assert job.operation_stage == OperationStage.EXECUTING
+
+
+class BlockingActionCache:
+    """Action cache answering batch lookups only once released."""
+
+    allow_updates = False
+
+    def __init__(self, action_results):
+        self.action_results = action_results
+        self.released = threading.Event()
+        self.looked_up = []
+
+    def get_action_results(self, action_digests):
+        self.released.wait()
+        self.looked_up.extend(action_digests)
+        return {action_digest.hash: self.action_results[action_digest.hash]
+                for action_digest in action_digests if action_digest.hash in self.action_results}
+
+
+@pytest.mark.parametrize('impl', ['sql', 'mem'])
+def test_cache_check_workers(impl, tmpdir):
+    storage = lru_memory_cache.LRUMemoryCache(1024 * 1024)
+    if impl == "sql":
+        data_store = SQLDataStore(storage, connection_string="sqlite:///%s" % tmpdir.join('jobs.db'),
+                                  automigrate=True)
+    elif impl == "mem":
+        data_store = MemoryDataStore(storage)
+
+    cached_action = remote_execution_pb2.Action(command_digest=command_digest)
+    cached_action_digest = create_digest(cached_action.SerializeToString())
+    missed_action = remote_execution_pb2.Action(command_digest=command_digest,
+                                                input_root_digest=command_digest)
+    missed_action_digest = create_digest(missed_action.SerializeToString())
+
+    action_cache = BlockingActionCache({
+        cached_action_digest.hash: remote_execution_pb2.ActionResult(exit_code=0)})
+    controller = ExecutionController(data_store, storage=storage, action_cache=action_cache,
+                                     cache_check_workers=1)
+    scheduler = controller.execution_instance._scheduler
+
+    cached_job_name = scheduler.queue_job_action(cached_action, cached_action_digest)
+    missed_job_name = scheduler.queue_job_action(missed_action, missed_action_digest)
+
+    # Jobs wait for the cache lookup without blocking the caller:
+    for job_name in (cached_job_name, missed_job_name):
+        job = scheduler.data_store.get_job_by_name(job_name)
+        assert job.operation_stage == OperationStage.CACHE_CHECK
+
+    action_cache.released.set()
+
+    def __resolved(job_name):
+        job = scheduler.data_store.get_job_by_name(job_name)
+        return job.operation_stage != OperationStage.CACHE_CHECK
+
+    deadline = time.time() + 5
+    while not all(__resolved(name) for name in (cached_job_name, missed_job_name)):
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+    job = scheduler.data_store.get_job_by_name(cached_job_name)
+    assert job.operation_stage == OperationStage.COMPLETED
+    assert job.holds_cached_result
+
+    job = scheduler.data_store.get_job_by_name(missed_job_name)
+    assert job.operation_stage == OperationStage.QUEUED
+
+    leases = scheduler.request_job_leases({})
+    assert [lease.id for lease in leases] == [missed_job_name]
+
+
+@pytest.mark.parametrize('cache_check_workers', [1, 0])
+def test_cache_check_jobs_resumed_on_restart(cache_check_workers, tmpdir):
+    storage = lru_memory_cache.LRUMemoryCache(1024 * 1024)
+    connection_string = "sqlite:///%s" % tmpdir.join('jobs.db')
+
+    action = remote_execution_pb2.Action(command_digest=command_digest)
+    action_digest = create_digest(action.SerializeToString())
+
+    # The first server never gets to look the job up:
+    action_cache = BlockingActionCache({})
+    data_store = SQLDataStore(storage, connection_string=connection_string, automigrate=True)
+    controller = ExecutionController(data_store, storage=storage, action_cache=action_cache,
+                                     cache_check_workers=1)
+    scheduler = controller.execution_instance._scheduler
+
+    job_name = scheduler.queue_job_action(action, action_digest)
+    job = scheduler.data_store.get_job_by_name(job_name)
+    assert job.operation_stage == OperationStage.CACHE_CHECK
+
+    # Restart on the same database:
+    action_cache = BlockingActionCache({})
+    action_cache.released.set()
+    data_store = SQLDataStore(storage, connection_string=connection_string, automigrate=True)
+    controller = ExecutionController(data_store, storage=storage, action_cache=action_cache,
+                                     cache_check_workers=cache_check_workers)
+    scheduler = controller.execution_instance._scheduler
+
+    deadline = time.time() + 5
+    while scheduler.data_store.get_job_by_name(job_name).operation_stage == OperationStage.CACHE_CHECK:
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+    job = scheduler.data_store.get_job_by_name(job_name)
+    assert job.operation_stage == OperationStage.QUEUED
+
+    # Later requests for the same action get deduplicated on a runnable job:
+    assert scheduler.queue_job_action(action, action_digest) == job_name
+
+    leases = scheduler.request_job_leases({})
+    assert [lease.id for lease in leases] == [job_name]
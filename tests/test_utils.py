@@ -14,13 +14,15 @@
 
 
 from urllib.parse import urlparse
+import os
 
 import pytest
 
 from buildgrid._protos.build.bazel.remote.execution.v2 import remote_execution_pb2
 from buildgrid.utils import BrowserURL
 from buildgrid.utils import get_hash_type
-from buildgrid.utils import create_digest, parse_digest
+from buildgrid.settings import MAX_REQUEST_SIZE
+from buildgrid.utils import create_digest, create_digest_from_file, merkle_tree_maker, parse_digest
 
 
 BLOBS = (b'', b'non-empty-blob',)
@@ -64,6 +66,16 @@ def test_create_digest(blob, digest_hash, digest_size):
     assert blob_digest.size_bytes == digest_size
 
 
+@pytest.mark.parametrize('blob', (b'', b'non-empty-blob', b'0123456789' * MAX_REQUEST_SIZE,))
+def test_create_digest_from_file(blob, tmpdir):
+    file_path = str(tmpdir.join('blob'))
+    with open(file_path, 'wb') as byte_file:
+        byte_file.write(blob)
+
+    # Generate a Digest message from the file, read chunk by chunk:
+    assert create_digest_from_file(file_path) == create_digest(blob)
+
+
 @pytest.mark.parametrize('string,digest_hash,digest_size,validity', STRING_DATA)
 def test_parse_digest(string, digest_hash, digest_size, validity):
     # Generate a Digest message from given string:
@@ -104,3 +116,17 @@ def test_browser_url_initialization(instance, digest_hash, digest_size):
     assert parsed_url.path.find('type') > 0
     assert parsed_url.path.find(digest_hash) > 0
     assert parsed_url.path.find(str(digest_size)) > 0
+
+
+def test_merkle_tree_maker_without_file_blobs():
+    data_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cas', 'data')
+
+    loaded_nodes = list(merkle_tree_maker(data_path))
+    hashed_nodes = list(merkle_tree_maker(data_path, file_blobs=False))
+
+    assert [node for node, _, _ in hashed_nodes] == [node for node, _, _ in loaded_nodes]
+    for (node, blob, _), (_, loaded_blob, _) in zip(hashed_nodes, loaded_nodes):
+        if node.DESCRIPTOR is remote_execution_pb2.FileNode.DESCRIPTOR:
+            assert blob is None
+        else:
+            assert blob == loaded_blob
@@ -27,10 +27,10 @@ from buildgrid.server._monitoring import MonitoringOutputType, MonitoringOutputF
 
 
 @contextmanager
-def serve(configuration, monitor=False):
+def serve(configuration, monitor=False, **server_kwargs):
     _, path = tempfile.mkstemp()
     try:
-        server = TestServer(configuration, monitor, path)
+        server = TestServer(configuration, monitor, path, **server_kwargs)
         yield server, path
     finally:
         server.quit()
@@ -39,27 +39,29 @@ def serve(configuration, monitor=False):
 
 class TestServer:
 
-    def __init__(self, configuration, monitor=False, endpoint_location=None):
+    def __init__(self, configuration, monitor=False, endpoint_location=None, **server_kwargs):
 
         self.configuration = configuration
 
         self.__queue = multiprocessing.Queue()
         self.__process = multiprocessing.Process(
             target=TestServer.serve,
-            args=(self.__queue, self.configuration, monitor, endpoint_location))
+            args=(self.__queue, self.configuration, monitor, endpoint_location),
+            kwargs=server_kwargs)
         self.__process.start()
 
         self.port = self.__queue.get()
         self.remote = 'localhost:{}'.format(self.port)
 
     @classmethod
-    def serve(cls, queue, configuration, monitor, endpoint_location):
+    def serve(cls, queue, configuration, monitor, endpoint_location, **server_kwargs):
         pytest_cov.embed.cleanup_on_sigterm()
 
         server = Server(monitor=monitor,
                         mon_endpoint_type=MonitoringOutputType.FILE,
                         mon_endpoint_location=endpoint_location,
-                        mon_serialisation_format=MonitoringOutputFormat.STATSD)
+                        mon_serialisation_format=MonitoringOutputFormat.STATSD,
+                        **server_kwargs)
 
         def __signal_handler(signum, frame):
             server.stop()